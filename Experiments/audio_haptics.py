@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Audio to haptics streaming.
+
+Description:
+    Reads 16 bit PCM from a WAV file, a raw file or a pipe, and turns every WINDOW_MS window into
+    a rumble: the low band energy (below LOW_CUTOFF Hz) drives the strong motor, the high band
+    (above HIGH_CUTOFF Hz) the weak one, mapped from FLOOR_DB..0 dBFS to the full magnitude.
+
+    Audio is processed a block of windows at a time. With numpy the band energies of a block
+    come from one windowed rfft over all its windows; without it a block mean (low) and a first
+    difference (high) estimate them with C level sum()/map() passes, no per sample Python code.
+
+    The pairs go to a haptic_playback.StreamEffect, spread out over the block's duration, and
+    the playback manager writes them to the device with the other effects. A value plays at
+    most one block plus one manager tick after its last sample arrived, the effect drops values
+    rather than fall behind.
+
+Usage:
+    ./audio_haptics.py music.wav /dev/input/event14
+    pw-record --format s16 --rate 48000 --channels 2 - | ./audio_haptics.py - /dev/input/event14
+    ./audio_haptics.py --benchmark    # Latency and CPU against a fake device, synthetic audio through a pipe
+"""
+
+import argparse
+import array
+import logging
+import math
+import os
+import random
+import stat
+import sys
+import threading
+import time
+import wave
+from operator import mul, sub
+
+import haptic_playback
+import haptics_engine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Falls back to the stdlib estimate
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+WINDOW_MS = 10
+BLOCK_WINDOWS = 2
+LOW_CUTOFF = 200
+HIGH_CUTOFF = 2000
+FLOOR_DB = -45.0
+FULL_SCALE = 32768.0
+MAX_MAGNITUDE = 0xFFFF
+# Priority of the stream in 'priority' mode, below the game effects of rumble_sim
+STREAM_PRIORITY = -1
+
+
+def to_magnitude(power, gain=1.0):
+    """
+    Maps a mean square sample power to a motor magnitude.
+    """
+    if power <= 0:
+        return 0
+    level = (10 * math.log10(power / FULL_SCALE ** 2) - FLOOR_DB) / -FLOOR_DB
+    return int(min(max(level * gain, 0.0), 1.0) * MAX_MAGNITUDE)
+
+
+class BandAnalyzer:
+    """
+    Low and high band power of each window of a block.
+
+    Args:
+        rate (int): Sample rate.
+        window (int): Samples per window.
+    """
+
+    def __init__(self, rate=SAMPLE_RATE, window=SAMPLE_RATE * WINDOW_MS // 1000):
+        self.rate = rate
+        self.window = window
+        # Block mean length of the stdlib low band, its first null is at rate / decimation
+        self.decimation = max(1, rate // (2 * LOW_CUTOFF))
+        if numpy is not None:
+            self.taper = numpy.hanning(window)
+            frequencies = numpy.fft.rfftfreq(window, 1 / rate)
+            self.low_bins = (frequencies > 0) & (frequencies < LOW_CUTOFF)
+            self.high_bins = frequencies > HIGH_CUTOFF
+            # Two sided rfft power to mean square per sample, with the taper's power loss
+            self.scale = 2 / (window * window * numpy.mean(self.taper ** 2))
+
+    def powers(self, mono):
+        """
+        Args:
+            mono (array or numpy array): Samples of whole windows.
+
+        Returns:
+            list: (low power, high power) per window.
+        """
+        if numpy is not None:
+            frames = numpy.asarray(mono, dtype=numpy.float64).reshape(-1, self.window)
+            frames = (frames - frames.mean(axis=1, keepdims=True)) * self.taper
+            spectrum = numpy.abs(numpy.fft.rfft(frames, axis=1)) ** 2 * self.scale
+            return list(zip(spectrum[:, self.low_bins].sum(axis=1).tolist(),
+                            spectrum[:, self.high_bins].sum(axis=1).tolist()))
+        powers = []
+        window = self.window
+        decimation = self.decimation
+        for start in range(0, len(mono) - window + 1, window):
+            samples = mono[start:start + window]
+            mean = sum(samples) / window
+            means = [sum(samples[index:index + decimation]) / decimation for index in range(0, window, decimation)]
+            low = max(sum(map(mul, means, means)) / len(means) - mean * mean, 0.0)
+            difference = list(map(sub, samples[1:], samples[:-1]))
+            # A first difference passes white noise at twice its power, bass hardly at all
+            high = sum(map(mul, difference, difference)) / (2 * (window - 1))
+            powers.append((low, high))
+        return powers
+
+
+def to_mono(data, channels):
+    """
+    Returns:
+        array or numpy array: The channels of 16 bit little endian PCM averaged.
+    """
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype='<i2')
+        return samples.reshape(-1, channels).mean(axis=1)
+    samples = array.array('h', data)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if channels == 1:
+        return samples
+    mono = array.array('d', samples[0::channels])
+    for channel in range(1, channels):
+        mono = array.array('d', map(float.__add__, mono, map(float, samples[channel::channels])))
+    return array.array('d', map((1 / channels).__mul__, mono))
+
+
+def open_source(path, rate, channels):
+    """
+    Opens a WAV file, a raw PCM file or '-' for stdin.
+
+    Returns:
+        tuple: (binary file, rate, channels, realtime) where realtime is False for files that
+        have to be paced to play in real time.
+    """
+    if path == '-':
+        source = sys.stdin.buffer
+    else:
+        source = open(path, 'rb')
+        if source.read(4) == b'RIFF':
+            source.seek(0)
+            reader = wave.open(source)
+            if reader.getsampwidth() != 2:
+                raise ValueError(f"{path}: only 16 bit PCM is supported")
+            return reader, reader.getframerate(), reader.getnchannels(), False
+        source.seek(0)
+    realtime = not stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+    return source, rate, channels, realtime
+
+
+def read_block(source, size):
+    """
+    Reads size bytes, less only at the end of the input.
+    """
+    if isinstance(source, wave.Wave_read):
+        return source.readframes(size // (2 * source.getnchannels()))
+    chunks = []
+    while size:
+        chunk = source.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def stream(source, effect, rate=SAMPLE_RATE, channels=CHANNELS, window_ms=WINDOW_MS, block_windows=BLOCK_WINDOWS,
+           realtime=True, strong_gain=1.0, weak_gain=1.0, stop=None):
+    """
+    Feeds the audio of source to effect until the input ends or stop is set.
+
+    Args:
+        source: Binary file or wave.Wave_read.
+        effect (StreamEffect): Receives the (strong, weak) pairs.
+        realtime (bool): The input arrives in real time (a pipe), else reads are paced.
+        stop (threading.Event): Ends the stream early.
+
+    Returns:
+        float: Thread CPU seconds spent on the analysis.
+    """
+    window = rate * window_ms // 1000
+    step = window / rate
+    block_bytes = window * block_windows * channels * 2
+    analyzer = BandAnalyzer(rate, window)
+    cpu = 0.0
+    start = time.monotonic()
+    blocks = 0
+    try:
+        while stop is None or not stop.is_set():
+            if not realtime:
+                time.sleep(max(start + blocks * block_windows * step - time.monotonic(), 0.0))
+            data = read_block(source, block_bytes)
+            arrival = time.monotonic()
+            usable = len(data) - len(data) % (window * channels * 2)
+            if not usable:
+                break
+            cpu_start = time.thread_time()
+            amplitudes = [(to_magnitude(low, strong_gain), to_magnitude(high, weak_gain))
+                          for low, high in analyzer.powers(to_mono(data[:usable], channels))]
+            cpu += time.thread_time() - cpu_start
+            effect.push(amplitudes, arrival, step, arrival)
+            blocks += 1
+    finally:
+        effect.close()
+    return cpu
+
+
+def start_stream(manager, path, rate=SAMPLE_RATE, channels=CHANNELS, priority=STREAM_PRIORITY):
+    """
+    Plays the audio of path on the manager from a thread.
+
+    Returns:
+        PlaybackHandle: Cancelling it stops the stream.
+    """
+    source, rate, channels, realtime = open_source(path, rate, channels)
+    effect = haptic_playback.StreamEffect()
+    handle = manager.play(effect, priority, block=True)
+    stop = threading.Event()
+
+    def run():
+        try:
+            stream(source, effect, rate, channels, realtime=realtime, stop=stop)
+        except (OSError, ValueError, EOFError) as e:
+            logging.error(f"Audio stream failed: {e}")
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+
+    # The stream thread only stops when asked, a cancelled handle is checked once per tick
+    threading.Thread(target=lambda: (handle.wait(), stop.set()), daemon=True).start()
+    threading.Thread(target=run, name='audio-haptics', daemon=True).start()
+    return handle
+
+
+def synthetic_audio(seconds, rate=SAMPLE_RATE, seed=1):
+    """
+    Stereo PCM with a 50 Hz kick every 500 ms and a noise hi-hat every 125 ms.
+    """
+    rng = random.Random(seed)
+    samples = array.array('h')
+    for index in range(int(seconds * rate)):
+        t = index / rate
+        kick = math.exp(-(t % 0.5) * 20) * math.sin(2 * math.pi * 50 * t) * 20000
+        hat = math.exp(-(t % 0.125) * 60) * rng.uniform(-1, 1) * 6000
+        value = int(max(min(kick + hat, 32767), -32768))
+        samples.append(value)
+        samples.append(value)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def benchmark(seconds, window_ms, block_windows):
+    from fake_evdev import FakeRumbleDevice
+
+    effect = haptic_playback.StreamEffect()
+    latencies = []
+
+    class LatencyProbe(FakeRumbleDevice):
+        # Time from the arrival of the samples behind a value to its FF write
+        def play(self, effect_id, value=1):
+            super().play(effect_id, value)
+            if effect.arrival is not None:
+                latencies.append(time.monotonic() - effect.arrival)
+
+    audio = synthetic_audio(seconds)
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        # A live source: 10 ms of audio every 10 ms
+        chunk = SAMPLE_RATE * CHANNELS * 2 // 100
+        start = time.monotonic()
+        with os.fdopen(write_fd, 'wb', buffering=0) as pipe:
+            for index, offset in enumerate(range(0, len(audio), chunk)):
+                time.sleep(max(start + index * 0.01 - time.monotonic(), 0.0))
+                pipe.write(audio[offset:offset + chunk])
+
+    device = LatencyProbe()
+    manager = haptic_playback.PlaybackManager(device)
+    handle = manager.play(effect)
+    feeder = threading.Thread(target=feed, daemon=True)
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    feeder.start()
+    with os.fdopen(read_fd, 'rb', buffering=0) as source:
+        analysis_cpu = stream(source, effect, window_ms=window_ms, block_windows=block_windows)
+    handle.wait()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    manager.close()
+
+    latencies.sort()
+    print(f"{seconds:.0f} s of 48 kHz stereo, {window_ms} ms windows, {block_windows} per block, "
+          f"{'numpy' if numpy is not None else 'stdlib'} analysis")
+    print(f"Sample to FF write: mean {sum(latencies) / len(latencies) * 1000:.1f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms "
+          f"({len(latencies)} writes, {manager.updates} effect updates)")
+    print(f"Analysis CPU: {analysis_cpu / seconds * 100:.2f}% of a core, "
+          f"process CPU incl. the feeder and writer threads: {cpu / wall * 100:.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream audio to the controller rumble')
+    parser.add_argument('input', nargs='?', help="WAV file, raw 16 bit PCM file, or '-' for stdin.")
+    parser.add_argument('device', nargs='?', help='Event device of the controller, i.e. /dev/input/event14.')
+    parser.add_argument('--rate', type=int, default=SAMPLE_RATE, help='Sample rate of raw PCM.')
+    parser.add_argument('--channels', type=int, default=CHANNELS, help='Channels of raw PCM.')
+    parser.add_argument('--window_ms', type=int, choices=range(10, 21), default=WINDOW_MS, metavar='10-20')
+    parser.add_argument('--block_windows', type=int, default=BLOCK_WINDOWS, help='Windows analysed per block.')
+    parser.add_argument('--strong_gain', type=float, default=1.0)
+    parser.add_argument('--weak_gain', type=float, default=1.0)
+    parser.add_argument('--benchmark', action='store_true', help='Synthetic audio through a pipe to a fake device.')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Audio length for --benchmark.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.seconds, args.window_ms, args.block_windows)
+        return
+    if not args.input or not args.device:
+        parser.error('an input and a device are needed')
+    source, rate, channels, realtime = open_source(args.input, args.rate, args.channels)
+    device = haptics_engine.EvdevRumbleDevice(args.device)
+    manager = haptic_playback.PlaybackManager(device)
+    effect = haptic_playback.StreamEffect()
+    manager.play(effect)
+    try:
+        stream(source, effect, rate, channels, args.window_ms, args.block_windows, realtime,
+               args.strong_gain, args.weak_gain)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.close()
+        device.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
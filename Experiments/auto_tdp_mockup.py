@@ -1,57 +1,294 @@
 #!/usr/bin/env python3
+"""
+Auto TDP mockup, follows the frame times MangoHud logs.
 
-import time
-import os
-import pandas as pd
+Description:
+    MangoHud writes one CSV per logging session and keeps appending a row per frame (or per
+    log interval) to it. LogFollower keeps the newest log open and every tick reads only the
+    bytes appended since the last one, so a tick costs the same whether the log is 1 MB or
+    500 MB. A new log is noticed through inotify (sysfs_watch.PatternWatch), or where that is
+    not available by the log directory's mtime changing; only then is the directory listed.
+
+    The moving average is over a bounded window, see take_action() for what is done with it.
+
+Usage:
+    ./auto_tdp_mockup.py                         # Follows /home/deck/*.csv
+    ./auto_tdp_mockup.py --pattern '/tmp/mangohud/*.csv'
+    ./auto_tdp_mockup.py --benchmark             # Tick cost as a log grows to --size_mb
+"""
+
+import argparse
+import collections
 import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sysfs_watch
 
 # Configure the path and file pattern for CSV files
-csv_file_pattern = '/home/deck/*.csv'
+CSV_FILE_PATTERN = '/home/deck/*.csv'
+WINDOW_SIZE = 5  # The number of samples to consider for the moving average
+UPDATE_INTERVAL = 0.5  # Time interval to update (in seconds)
+FRAMETIME_COLUMN = 'frametime'
+# Bytes read per tick at most, a backlog beyond it is skipped, only recent frames matter
+MAX_READ = 1 << 20
+HEADER_LIMIT = 64 << 10
+
 
-# Function to find the latest CSV file based on modification time
 def find_latest_csv_file(pattern):
     list_of_files = glob.glob(pattern)
     if not list_of_files:
         return None
-    latest_file = max(list_of_files, key=os.path.getmtime)
-    return latest_file
+    return max(list_of_files, key=os.path.getmtime)
+
+
+class CsvTail:
+    """
+    Reads the rows appended to a MangoHud CSV.
+
+    Args:
+        path (str): The log.
+        from_start (bool): Return the rows already in the file too, else only new ones.
+
+    Raises:
+        OSError: If the file can not be opened.
+    """
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.file = open(path, 'rb', buffering=0)
+        self.column = self._find_column()
+        self.partial = b''
+        self.offset = 0
+        self._skip_line = False
+        if not from_start:
+            self._seek(os.fstat(self.file.fileno()).st_size)
+
+    def _find_column(self):
+        """
+        Returns:
+            int: Index of the frametime column from the header near the top, 1 if there is none yet.
+        """
+        head = self.file.read(HEADER_LIMIT)
+        for line in head.split(b'\n')[:-1]:
+            fields = line.strip().split(b',')
+            if FRAMETIME_COLUMN.encode() in fields:
+                return fields.index(FRAMETIME_COLUMN.encode())
+        return 1
+
+    def _seek(self, offset):
+        # Starting in the middle of a row skips it
+        self.offset, self.partial = offset, b''
+        self._skip_line = offset > 0 and os.pread(self.file.fileno(), 1, offset - 1) != b'\n'
+
+    def read(self):
+        """
+        Returns:
+            list: Frame times of the complete rows appended since the last call.
+        """
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.offset:
+            logging.info(f"{self.path} was truncated, reading it from the start")
+            self.offset, self.partial, self._skip_line = 0, b'', False
+        if size - self.offset > MAX_READ:
+            # Fell behind, i.e. suspended; the rows in between are too old to act on
+            self._seek(size - MAX_READ)
+        if size == self.offset:
+            return []
+        data = os.pread(self.file.fileno(), size - self.offset, self.offset)
+        self.offset += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if self._skip_line:
+            lines = lines[1:]
+            self._skip_line = False
+        column = self.column
+        frametimes = []
+        for line in lines:
+            fields = line.split(b',', column + 1)
+            try:
+                frametimes.append(float(fields[column]))
+            except (IndexError, ValueError):
+                # System info and header rows
+                if FRAMETIME_COLUMN.encode() in line.split(b','):
+                    self.column = column = line.strip().split(b',').index(FRAMETIME_COLUMN.encode())
+        return frametimes
+
+    def close(self):
+        self.file.close()
+
+
+class LogFollower:
+    """
+    Follows the newest log matching pattern, switching when a new one appears.
+
+    Args:
+        pattern (str): Glob of the logs, the directory part must not contain wildcards.
+        window_size (int): Frame times kept for the moving average.
+    """
+
+    def __init__(self, pattern=CSV_FILE_PATTERN, window_size=WINDOW_SIZE):
+        self.pattern = pattern
+        self.directory = os.path.dirname(pattern) or '.'
+        self.frametimes = collections.deque(maxlen=window_size)
+        self.tail = None
+        self._directory_mtime = None
+        try:
+            self.watch = sysfs_watch.PatternWatch(pattern)
+        except OSError as e:
+            logging.warning(f"No inotify for {self.directory} ({e}), checking its mtime instead")
+            self.watch = None
+        self._switch(from_start=False)
+
+    def _changed(self):
+        if self.watch is not None:
+            return self.watch.read_events()
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return False
+        changed, self._directory_mtime = mtime != self._directory_mtime, mtime
+        return changed
+
+    def _switch(self, from_start=True):
+        # New logs are read from their first row, the one open at startup from its end
+        latest = find_latest_csv_file(self.pattern)
+        if latest is None or (self.tail is not None and latest == self.tail.path):
+            return
+        try:
+            tail = CsvTail(latest, from_start)
+        except OSError as e:
+            logging.error(f"Can not open {latest}: {e}")
+            return
+        if self.tail is not None:
+            self.tail.close()
+        self.tail = tail
+        self.frametimes.clear()
+        logging.info(f"Following {latest}")
+
+    def poll(self):
+        """
+        Reads what was logged since the last poll.
+
+        Returns:
+            list: The new frame times.
+        """
+        if self._changed():
+            self._switch()
+        if self.tail is None:
+            return []
+        frametimes = self.tail.read()
+        self.frametimes.extend(frametimes)
+        return frametimes
+
+    def moving_average(self):
+        if not self.frametimes:
+            return None
+        return sum(self.frametimes) / len(self.frametimes)
+
+    def fileno(self):
+        return self.watch.fileno() if self.watch is not None else None
+
+    def close(self):
+        if self.tail is not None:
+            self.tail.close()
+        if self.watch is not None:
+            self.watch.close()
 
-# Function to calculate moving average of a list
-def moving_average(data, window_size):
-    if len(data) < window_size:
-        return sum(data) / len(data)
-    return sum(data[-window_size:]) / window_size
 
 # Function to take action based on the moving average value
 def take_action(moving_avg):
-    # This function is a placeholder for the action taken based on the moving average.
-    # Implement the specific logic based on your requirements.
+    # This function is a placeholder for the action taken based on the moving average,
+    # tdp_governor.py sets the TDP from the frame times instead.
     print(f"Moving average of frame time: {moving_avg}")
 
-# Main loop that runs continuously
-frametime_window = []
-window_size = 5  # The number of samples to consider for the moving average
-update_interval = 0.5  # Time interval to update (in seconds)
-
-try:
-    while True:
-        latest_csv_file = find_latest_csv_file(csv_file_pattern)
-        print(f"Latest CSV file: {latest_csv_file}")
-        if latest_csv_file:
-            # Read the last line of the latest CSV file
-            last_line = pd.read_csv(latest_csv_file, skiprows=lambda x: x not in [0,-1], header=None)  # Read only the first and last lines
-            frametime = last_line.iloc[-1, 1]  # Assuming the frametime is the second column (index 1)
-            frametime_window.append(frametime)  # Append to the frametime window
-            print(f"Frame time: {frametime}")   
-            # Calculate moving average of frametime
-            moving_avg = moving_average(frametime_window, window_size)
-            print(f"Moving average of frame time: {moving_avg}")
-            # Take action based on moving average value
-            take_action(moving_avg)
-
-        # Wait for a specified interval before next update
-        time.sleep(update_interval)
-except KeyboardInterrupt:
-    print("Program stopped by the user.")
-except Exception as e:
-    print(f"Error: {e}")
\ No newline at end of file
+
+def benchmark(size_mb, ticks=20, rows_per_tick=30):
+    """
+    Grows a MangoHud like log to size_mb and times follower ticks at several sizes, next to
+    what the old loop did per tick: glob and stat the logs, then a Python call per line of the
+    log to pick the last row (pd.read_csv's skiprows callable).
+    """
+    header = (b'os,cpu,gpu,ram,kernel,driver,cpuscheduler\n'
+              b'Linux,AMD Ryzen Z1 Extreme,AMD Radeon,16GB,6.8,Mesa,schedutil\n'
+              b'fps,frametime,cpu_load,gpu_load,cpu_temp,gpu_temp,gpu_core_clock,gpu_mem_clock,'
+              b'gpu_vram_used,gpu_power,ram_used,swap_used,process_rss,elapsed\n')
+    row = b'60.1,16.6389,34.2,88.1,71,66,2600,1000,3.1,14.2,6.4,0.0,1.2,%d\n'
+    filler = b''.join(row % index for index in range(8192))
+    checkpoints = [mb for mb in (1, 10, 50, 100, 200, 500) if mb < size_mb] + [size_mb]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'Game_2024-01-01_12-00-00.csv')
+        with open(path, 'wb') as log:
+            log.write(header)
+        follower = LogFollower(os.path.join(directory, '*.csv'))
+        print(f"Watching with {'inotify' if follower.watch is not None else 'directory mtime'}")
+        print(f"{'log MB':>7} {'follower tick':>14} {'rows/tick':>10} {'old loop tick':>14}")
+        with open(path, 'ab', buffering=0) as log:
+            for checkpoint in checkpoints:
+                while os.path.getsize(path) < checkpoint << 20:
+                    log.write(filler)
+                follower.poll()
+                elapsed = 0.0
+                rows = 0
+                for tick in range(ticks):
+                    log.write(b''.join(row % index for index in range(rows_per_tick)))
+                    start = time.perf_counter()
+                    rows += len(follower.poll())
+                    follower.moving_average()
+                    elapsed += time.perf_counter() - start
+                old = ''
+                if checkpoint <= 100:
+                    start = time.perf_counter()
+                    latest = find_latest_csv_file(follower.pattern)
+                    skiprows = lambda x: x not in [0, -1]
+                    with open(latest, 'rb') as csv:
+                        [line for index, line in enumerate(csv) if not skiprows(index)]
+                    old = f"{(time.perf_counter() - start) * 1000:11.1f} ms"
+                print(f"{checkpoint:>7} {elapsed / ticks * 1e6:11.1f} us {rows / ticks:>10.0f} {old:>14}")
+
+        # A new session starts a new log
+        new_path = os.path.join(directory, 'Game_2024-01-01_13-00-00.csv')
+        with open(new_path, 'wb') as log:
+            log.write(header + row % 0)
+        frametimes = follower.poll()
+        print(f"New log: following {os.path.basename(follower.tail.path)}, first poll read {len(frametimes)} row(s)")
+        follower.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Follow MangoHud frame time logs')
+    parser.add_argument('--pattern', default=CSV_FILE_PATTERN, help='Glob of the MangoHud CSV logs.')
+    parser.add_argument('--window_size', type=int, default=WINDOW_SIZE, help='Frame times in the moving average.')
+    parser.add_argument('--interval', type=float, default=UPDATE_INTERVAL, help='Seconds between updates.')
+    parser.add_argument('--benchmark', action='store_true', help='Time the follower on a growing temporary log.')
+    parser.add_argument('--size_mb', type=int, default=300, help='Final log size for --benchmark.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.size_mb)
+        return
+
+    follower = LogFollower(args.pattern, args.window_size)
+    try:
+        while True:
+            frametimes = follower.poll()
+            if frametimes:
+                print(f"Frame time: {frametimes[-1]}")
+                # Take action based on moving average value
+                take_action(follower.moving_average())
+            # Wait for a specified interval before next update
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("Program stopped by the user.")
+    finally:
+        follower.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Fake force feedback event device.
+
+Description:
+    Stands in for /dev/input/eventX so the haptics code can run without a controller. It has
+    the same upload()/erase()/play() interface as haptics_engine.EvdevRumbleDevice, keeps the
+    uploaded FF effects by id like the kernel does (id -1 allocates a new one, an existing id is
+    updated in place), and counts the ioctls and writes with their timestamps.
+
+    ioctl_latency mimics the time an upload or erase takes on the real device (the driver sends
+    a report to the controller).
+"""
+
+import struct
+import threading
+import time
+
+from haptics_engine import FF_EFFECT
+
+
+class FakeRumbleDevice:
+    """
+    In-memory FF device.
+
+    Args:
+        max_effects (int): Effect slots of the device, like ff_effects_max.
+        ioctl_latency (float): Seconds per upload/erase.
+    """
+
+    def __init__(self, max_effects=16, ioctl_latency=0.0):
+        self.max_effects = max_effects
+        self.ioctl_latency = ioctl_latency
+        self.effects = {}
+        self.uploads = 0
+        self.erases = 0
+        self.writes = 0
+        self.played = []  # (time, effect id, value, strong, weak, length ms)
+        self._lock = threading.Lock()
+
+    @property
+    def ioctls(self):
+        return self.uploads + self.erases
+
+    def upload(self, effect):
+        """
+        Uploads or updates an effect, writes the id back into effect like EVIOCSFF.
+
+        Returns:
+            int: The effect id.
+
+        Raises:
+            OSError: If a new effect does not fit or the id is unknown.
+        """
+        with self._lock:
+            if self.ioctl_latency:
+                time.sleep(self.ioctl_latency)
+            self.uploads += 1
+            effect_type, effect_id, _, _, _, length, _, strong, weak = FF_EFFECT.unpack_from(effect)
+            if effect_id == -1:
+                free = [index for index in range(self.max_effects) if index not in self.effects]
+                if not free:
+                    raise OSError(28, "No space left on device")
+                effect_id = free[0]
+                struct.pack_into('<h', effect, 2, effect_id)
+            elif effect_id not in self.effects:
+                raise OSError(22, "Invalid argument")
+            self.effects[effect_id] = (strong, weak, length)
+            return effect_id
+
+    def erase(self, effect_id):
+        with self._lock:
+            if self.ioctl_latency:
+                time.sleep(self.ioctl_latency)
+            self.erases += 1
+            if self.effects.pop(effect_id, None) is None:
+                raise OSError(22, "Invalid argument")
+
+    def play(self, effect_id, value=1):
+        with self._lock:
+            if effect_id not in self.effects:
+                raise OSError(22, "Invalid argument")
+            self.writes += 1
+            self.played.append((time.monotonic(), effect_id, value) + self.effects[effect_id])
+
+    def close(self):
+        pass
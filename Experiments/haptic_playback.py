@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Haptic playback manager with software mixing.
+
+Description:
+    One writer thread owns the rumble device. Effects are submitted through a bounded queue and
+    each gets a PlaybackHandle to cancel or wait on it, there is no shared "vibration active" flag.
+    Every TICK the writer samples the active effects, combines their amplitudes and only touches
+    the device when the result changes. It plays the result on a pool of FF effects uploaded at
+    start, like haptics_engine.HapticsEngine: a slot that already holds the magnitudes and length
+    is played as is, otherwise one is updated in place (one EVIOCSFF).
+
+    When the effects know how long the result holds (timelines, constant effects with a
+    duration) it is played with exactly that replay length, so it ends on its own without a stop
+    write and repeated pulses reuse their slot. Otherwise it is played with a length of HOLD and
+    replayed while the output holds, so the rumble stops on its own if the writer dies.
+
+    mode 'mix' adds the amplitudes of overlapping effects (clamped), mode 'priority' plays only the
+    highest priority effect (the newest one on a tie), the others keep running muted and are
+    heard again once it ends.
+
+Usage:
+    ./haptic_playback.py --simulate             # Mixing, preemption and cancellation on a fake device, checked
+    ./haptic_playback.py /dev/input/event14 --pattern heartbeat --pattern raindrops
+"""
+
+import argparse
+import collections
+import itertools
+import logging
+import math
+import os
+import queue
+import select
+import threading
+import time
+
+import haptics_engine
+
+TICK = 0.01
+# Replay length of the device effect, the writer replays it every HOLD / 2 while the output holds
+HOLD = 0.1
+QUEUE_SIZE = 8
+MAX_MAGNITUDE = 0xFFFF
+
+
+class ConstantEffect:
+    """
+    A steady rumble, until cancelled if duration is None.
+    """
+
+    def __init__(self, strong, weak, duration=None):
+        self.strong = min(strong, MAX_MAGNITUDE)
+        self.weak = min(weak, MAX_MAGNITUDE)
+        self.duration = duration
+        self.ticks = None
+
+    def compile(self, tick):
+        self.ticks = None if self.duration is None else math.ceil(self.duration / tick)
+
+    def amplitude(self, index):
+        if self.ticks is not None and index >= self.ticks:
+            return None
+        return self.strong, self.weak
+
+    def steady(self, index):
+        """
+        Returns:
+            int: Ticks from index on the amplitude stays the same, None if not known.
+        """
+        return None if self.ticks is None else self.ticks - index
+
+
+class TimelineEffect:
+    """
+    A haptics_engine.Timeline, sampled once per tick when compiled.
+    """
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.frames = ()
+        self.runs = ()
+
+    def compile(self, tick):
+        # Rounded to whole ticks, 1.05 / 0.01 is 104.999...
+        strong = [0] * round(self.timeline.duration / tick)
+        weak = [0] * len(strong)
+        for offset, _, (event_strong, event_weak, length), _ in self.timeline.events:
+            for index in range(round(offset / tick), min(round((offset + length / 1000) / tick), len(strong))):
+                strong[index] = min(strong[index] + event_strong, MAX_MAGNITUDE)
+                weak[index] = min(weak[index] + event_weak, MAX_MAGNITUDE)
+        self.frames = tuple(zip(strong, weak))
+        # Ticks each frame is repeated for from there on
+        runs = [1] * len(self.frames)
+        for index in range(len(self.frames) - 2, -1, -1):
+            if self.frames[index] == self.frames[index + 1]:
+                runs[index] = runs[index + 1] + 1
+        self.runs = tuple(runs)
+
+    def amplitude(self, index):
+        return self.frames[index] if index < len(self.frames) else None
+
+    def steady(self, index):
+        return self.runs[index] if index < len(self.runs) else None
+
+
+class StreamEffect:
+    """
+    Amplitudes pushed while it plays, i.e. by audio_haptics. Each pushed value is due at its
+    own time and the latest due one plays; at most max_pending wait, the oldest are dropped if
+    the producer runs ahead, so the delay stays bounded. Ends once closed and drained.
+
+    arrival is the time the input behind the playing value arrived, for latency measurements.
+    """
+
+    def __init__(self, max_pending=8, clock=time.monotonic):
+        self.pending = collections.deque(maxlen=max_pending)
+        self.clock = clock
+        self.current = (0, 0)
+        self.arrival = None
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def compile(self, tick):
+        pass
+
+    def steady(self, index):
+        return None
+
+    def push(self, amplitudes, due, step, arrival):
+        """
+        Args:
+            amplitudes (list): (strong, weak) pairs.
+            due (float): clock() time the first one is due, the next ones follow every step seconds.
+            arrival (float): clock() time their input arrived.
+        """
+        with self._lock:
+            for index, amplitude in enumerate(amplitudes):
+                self.pending.append((due + index * step, amplitude, arrival))
+
+    def close(self):
+        self.closed = True
+
+    def amplitude(self, index):
+        now = self.clock()
+        with self._lock:
+            while self.pending and self.pending[0][0] <= now:
+                _, self.current, self.arrival = self.pending.popleft()
+            if self.closed and not self.pending:
+                return None
+        return self.current
+
+
+class PlaybackHandle:
+    """
+    One submitted effect. state is 'queued', 'playing', 'finished' or 'cancelled'.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, effect, priority):
+        self.id = next(self._ids)
+        self.effect = effect
+        self.priority = priority
+        self.state = 'queued'
+        self.start = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """
+        Stops the effect within a tick, or before it starts if still queued.
+        """
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        """
+        Returns:
+            bool: True once the effect finished or was cancelled.
+        """
+        return self._done.wait(timeout)
+
+    def _finish(self, state):
+        self.state = state
+        self._done.set()
+
+
+class PlaybackManager:
+    """
+    Mixes the submitted effects onto a pool of device effects from a single writer thread.
+
+    Args:
+        device: haptics_engine.EvdevRumbleDevice or fake_evdev.FakeRumbleDevice.
+        mode (str): 'mix' or 'priority'.
+        tick (float): Seconds between amplitude updates.
+        queue_size (int): Effects that can wait for the writer.
+        clock (callable): Monotonic time.
+        pool_size (int): Device effects uploaded once and reused.
+    """
+
+    def __init__(self, device, mode='mix', tick=TICK, queue_size=QUEUE_SIZE, clock=time.monotonic,
+                 pool_size=haptics_engine.POOL_SIZE):
+        if mode not in ('mix', 'priority'):
+            raise ValueError(f"Unknown mode {mode!r}")
+        self.device = device
+        self.mode = mode
+        self.tick = tick
+        self.clock = clock
+        self.pool = haptics_engine.EffectPool(device, pool_size)
+        self.used = [0.0] * pool_size
+        self.output = (0, 0)
+        self.playing = None  # Slot playing the output
+        self.playing_until = 0.0  # When it ends on its own
+        self.replay = False  # Played with a length of HOLD, replayed while the output holds
+        self.updates = 0
+        self.writes = 0
+        self._queue = queue.Queue(queue_size)
+        self._handles = set()
+        self._lock = threading.Lock()
+        # The writer sleeps in select() on this pipe like the HapticsEngine scheduler, a
+        # Queue.get() timeout overshoots by ms and the ticks would drift off the effects' grid
+        self._wake_read, self._wake_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._thread = threading.Thread(target=self._run, name='haptic-playback', daemon=True)
+        self._thread.start()
+
+    def play(self, effect, priority=0, block=False, timeout=None):
+        """
+        Submits an effect.
+
+        Args:
+            effect: ConstantEffect, TimelineEffect or StreamEffect.
+            priority (int): Higher preempts lower in 'priority' mode.
+            block (bool): Wait for room in the queue instead of failing.
+            timeout (float): Seconds to wait with block.
+
+        Returns:
+            PlaybackHandle: To cancel or wait on the effect.
+
+        Raises:
+            queue.Full: If the queue is full.
+        """
+        effect.compile(self.tick)
+        handle = PlaybackHandle(effect, priority)
+        with self._lock:
+            self._handles.add(handle)
+        try:
+            self._queue.put(handle, block, timeout)
+        except queue.Full:
+            with self._lock:
+                self._handles.discard(handle)
+            raise
+        self._wake()
+        return handle
+
+    def stop_all(self):
+        with self._lock:
+            handles = list(self._handles)
+        for handle in handles:
+            handle.cancel()
+
+    def close(self):
+        self.stop_all()
+        self._queue.put(None)
+        self._wake()
+        self._thread.join()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        self.pool.close()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass  # Already woken
+
+    def _mix(self, amplitudes):
+        """
+        Args:
+            amplitudes (list): (handle, amplitude, time the amplitude changes or None).
+
+        Returns:
+            tuple: (output, time it changes or None if not known)
+        """
+        if not amplitudes:
+            return (0, 0), None
+        if self.mode == 'priority':
+            amplitudes = [max(amplitudes, key=lambda entry: (entry[0].priority, entry[0].start))]
+            output = amplitudes[0][1]
+        else:
+            output = (min(sum(strong for _, (strong, _), _ in amplitudes), MAX_MAGNITUDE),
+                      min(sum(weak for _, (_, weak), _ in amplitudes), MAX_MAGNITUDE))
+        changes = [change for _, _, change in amplitudes]
+        return output, None if None in changes else min(changes)
+
+    def _slot(self, params, now):
+        """
+        Returns:
+            int: A slot holding params, updated in place if none does: the playing one, which
+            is replaced anyway, or else the least recently used.
+        """
+        holds = self.pool.holds
+        if params in holds:
+            slot = holds.index(params)
+        else:
+            slot = self.playing if self.playing is not None else min(range(len(self.pool)), key=self.used.__getitem__)
+            self.pool.update(slot, params)
+            self.updates += 1
+        self.used[slot] = now
+        return slot
+
+    def _write(self, output, change, now):
+        """
+        Brings the device to output.
+
+        Args:
+            output (tuple): (strong, weak).
+            change (float): When output changes next, None if not known.
+            now (float): The tick's time.
+        """
+        # An effect ending within half a tick of now counts as ended, it was played for this long
+        playing = self.playing is not None and self.playing_until > now + self.tick / 2
+        if output == self.output and (output == (0, 0) or (playing and not (
+                self.replay and self.playing_until - now < HOLD / 2))):
+            return
+        if output == (0, 0):
+            if playing:
+                self.pool.play(self.playing, 0)
+                self.writes += 1
+            self.playing = None
+            self.output = output
+            return
+        self.replay = change is None
+        # The remaining ticks of the frame index now falls in, however late in it the writer is
+        length = HOLD if self.replay else max(math.ceil((change - now) / self.tick - 1e-6), 1) * self.tick
+        slot = self._slot((*output, round(length * 1000)), now)
+        if playing and slot != self.playing:
+            self.pool.play(self.playing, 0)
+            self.writes += 1
+        self.pool.play(slot)
+        self.writes += 1
+        self.playing = slot
+        self.playing_until = now + length
+        self.output = output
+
+    def _finish(self, handle, state):
+        handle._finish(state)
+        with self._lock:
+            self._handles.discard(handle)
+
+    def _run(self):
+        active = []
+        next_tick = None
+        while True:
+            timeout = None if next_tick is None else next_tick - self.clock()
+            if timeout is None or timeout > 0:
+                if select.select([self._wake_read], [], [], timeout)[0]:
+                    os.read(self._wake_read, 512)
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                item = False
+            while item is not False:
+                if item is None:
+                    for handle in active:
+                        self._finish(handle, 'cancelled')
+                    try:
+                        self._write((0, 0), None, self.clock())
+                    except OSError as e:
+                        logging.error(f"Failed to stop the rumble: {e}")
+                    return
+                if item.cancelled:
+                    self._finish(item, 'cancelled')
+                else:
+                    item.state = 'playing'
+                    item.start = self.clock()
+                    active.append(item)
+                    next_tick = item.start if next_tick is None else next_tick
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            now = self.clock()
+            if next_tick is None or now < next_tick:
+                continue
+            amplitudes = []
+            for handle in list(active):
+                index = int((now - handle.start) / self.tick)
+                amplitude = None if handle.cancelled else handle.effect.amplitude(index)
+                if amplitude is None:
+                    active.remove(handle)
+                    self._finish(handle, 'cancelled' if handle.cancelled else 'finished')
+                else:
+                    steady = handle.effect.steady(index)
+                    change = None if steady is None else handle.start + (index + steady) * self.tick
+                    amplitudes.append((handle, amplitude, change))
+            try:
+                self._write(*self._mix(amplitudes), now)
+            except OSError as e:
+                logging.error(f"Rumble device write failed: {e}")
+            # Ticks missed while busy are skipped, not caught up
+            next_tick = max(next_tick + self.tick, now) if active else None
+
+
+def simulate():
+    """
+    Mixing, preemption, cancellation and a full queue on a fake device, printing the strong
+    magnitude the device was set to every 100 ms and checking it.
+
+    A 2 s background rumble (priority 0), the explosion at 0.5 s (priority 1) and raindrops at
+    1 s (priority 2), cancelled at 1.5 s.
+
+    Returns:
+        int: Number of failed checks.
+    """
+    from fake_evdev import FakeRumbleDevice
+
+    failures = 0
+
+    def check(condition, message):
+        nonlocal failures
+        if not condition:
+            failures += 1
+            print(f"FAILED: {message}")
+
+    def strong_at(device, now):
+        # Effects play for their length or until stopped, the kernel adds up the playing ones.
+        # Not clamped, two slots playing at once would show
+        playing = {}
+        for played_at, effect_id, value, effect_strong, _, length in device.played:
+            if played_at > now:
+                break
+            playing[effect_id] = (played_at + length / 1000, effect_strong) if value else (0, 0)
+        return sum(magnitude for until, magnitude in playing.values() if until > now)
+
+    rain_strengths = {0, 0x800, 0x1000, 0x1800}
+    # The explosion's last step (0xFFFF >> 5), playing from 1.6 s to its end at 1.8 s, sampled at 1.7 s
+    explosion_tail = MAX_MAGNITUDE >> 5
+    for mode in ('mix', 'priority'):
+        device = FakeRumbleDevice()
+        manager = PlaybackManager(device, mode)
+        start = time.monotonic()
+        background = manager.play(ConstantEffect(0x3000, 0x3000, 2.0), priority=0)
+        time.sleep(0.5)
+        manager.play(TimelineEffect(haptics_engine.explosion()), priority=1)
+        time.sleep(0.5)
+        rain = manager.play(TimelineEffect(haptics_engine.raindrops()), priority=2)
+        time.sleep(0.5)
+        rain.cancel()
+        background.wait()
+        time.sleep(0.2)
+        trace = [strong_at(device, start + index / 10) for index in range(22)]
+        print(f"{mode:9} strong/0x1000 per 100 ms: {' '.join(f'{min(value, MAX_MAGNITUDE) >> 12:x}' for value in trace)}")
+        print(f"{'':9} rain: {rain.state}, background: {background.state}, "
+              f"uploads: {manager.updates}, writes: {manager.writes}, ticks: {int(2.0 / TICK)}")
+        manager.close()
+
+        # Sampled mid phase, clear of the few ms the sleeps above are off by
+        played = [(played_at - start, strong, weak) for played_at, _, value, strong, weak, _ in device.played if value]
+        check(trace[3] == 0x3000, f"{mode}: background alone should be 0x3000 at 0.3 s, got {trace[3]:#x}")
+        check(background.state == 'finished', f"{mode}: background is {background.state}, not finished")
+        check(rain.state == 'cancelled', f"{mode}: rain is {rain.state}, not cancelled")
+        check(trace[21] == 0, f"{mode}: something still plays at 2.1 s: {trace[21]:#x}")
+        if mode == 'mix':
+            # Blast 0xFFFF + background 0x3000 on both motors, clamped
+            blast = [(strong, weak) for at, strong, weak in played if at <= 0.6][-1:]
+            check(blast == [(MAX_MAGNITUDE, MAX_MAGNITUDE)] and trace[6] == MAX_MAGNITUDE,
+                  f"mix: blast + background should clamp to 0xFFFF, played {blast}, heard {trace[6]:#x}")
+            check(trace[12] > 0x3000, f"mix: rain + explosion + background should exceed 0x3000 at 1.2 s, got {trace[12]:#x}")
+            check(trace[17] == 0x3000 + explosion_tail,
+                  f"mix: only background + explosion should play after the rain was cancelled, got {trace[17]:#x}")
+        else:
+            # The explosion mutes the background, the raindrops mute both, the explosion and
+            # then the background resume
+            check(trace[6] == MAX_MAGNITUDE, f"priority: the explosion should play alone at 0.6 s, got {trace[6]:#x}")
+            check(all(strong in rain_strengths for at, strong, _ in played if 1.05 < at < 1.45),
+                  "priority: something other than the raindrops played while they did")
+            check(trace[17] == explosion_tail, f"priority: the explosion should resume after the rain, got {trace[17]:#x}")
+            check(trace[19] == 0x3000, f"priority: the background should resume at 1.9 s, got {trace[19]:#x}")
+
+    # A stalled device keeps the writer busy, the queue fills up behind it
+    class StalledDevice(FakeRumbleDevice):
+        def __init__(self):
+            super().__init__()
+            self.stall = False
+            self.stalled = threading.Event()
+            self.release = threading.Event()
+
+        def upload(self, effect):
+            if self.stall:
+                self.stalled.set()
+                self.release.wait()
+            return super().upload(effect)
+
+    queue_size = 2
+    device = StalledDevice()
+    manager = PlaybackManager(device, queue_size=queue_size)
+    device.stall = True
+    manager.play(ConstantEffect(0x1000, 0x1000, 0.1))
+    check(device.stalled.wait(1.0), "the writer never reached the device")
+    accepted = 0
+    try:
+        for _ in range(queue_size + 3):
+            manager.play(ConstantEffect(0x1000, 0x1000, 0.1))
+            accepted += 1
+    except queue.Full:
+        print(f"Queue of {queue_size}: play() raised queue.Full after {accepted} effects while the writer was busy")
+    check(accepted == queue_size, f"queue.Full should come after {queue_size} queued effects, came after {accepted}")
+    device.release.set()
+    manager.close()
+
+    print(f"{'All checks passed' if not failures else f'{failures} check(s) failed'}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Haptic playback manager')
+    parser.add_argument('device', nargs='?', help='Event device of the controller, i.e. /dev/input/event14.')
+    parser.add_argument('--pattern', action='append', choices=tuple(haptics_engine.PATTERNS),
+                        help='Pattern to play, repeat to play several at once.')
+    parser.add_argument('--mode', choices=('mix', 'priority'), default='mix')
+    parser.add_argument('--simulate', action='store_true', help='Run the scenarios on a fake device.')
+    args = parser.parse_args()
+
+    if args.simulate:
+        if simulate():
+            raise SystemExit(1)
+        return
+    if not args.device:
+        parser.error('a device or --simulate is needed')
+    device = haptics_engine.EvdevRumbleDevice(args.device)
+    manager = PlaybackManager(device, args.mode)
+    try:
+        handles = [manager.play(TimelineEffect(haptics_engine.PATTERNS[name]()), priority)
+                   for priority, name in enumerate(args.pattern or ['heartbeat'])]
+        for handle in handles:
+            handle.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.close()
+        device.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
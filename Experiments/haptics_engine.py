@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Timeline haptics engine for the controller rumble.
+
+Description:
+    rumble_sim.py used to upload a new FF effect for every pulse, erase it afterwards and time the
+    pattern with chained time.sleep() calls, so every pulse cost two ioctls and the pattern
+    drifted by the time they took. HapticsEngine uploads a small pool of rumble effects once
+    (EffectPool, haptic_playback uses it too) and updates a slot in place (one EVIOCSFF on the
+    same id, none if it already holds the same magnitudes and length). Patterns are compiled once into a Timeline of (offset, slot, effect),
+    slot updates are moved ahead of their event, and one scheduler thread plays it against
+    absolute deadlines.
+
+    The device is written to with the kernel interface directly (EVIOCSFF/EVIOCRMFF ioctls and
+    input_event writes), the fake_evdev.FakeRumbleDevice has the same interface.
+
+Usage:
+    ./haptics_engine.py /dev/input/event14 --pattern heartbeat
+    ./haptics_engine.py --benchmark --ioctl_latency 0.002   # Engine vs the old rumble_sim calls, fake device
+"""
+
+import argparse
+import fcntl
+import heapq
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+EV_FF = 0x15
+FF_RUMBLE = 0x50
+# struct ff_effect with the rumble union member: type, id, direction, trigger, replay, strong, weak
+FF_EFFECT = struct.Struct('<HhHHHHH2xHH28x')
+# _IOW('E', 0x80, struct ff_effect) and _IOW('E', 0x81, int)
+EVIOCSFF = 0x40000000 | (FF_EFFECT.size << 16) | (ord('E') << 8) | 0x80
+EVIOCRMFF = 0x40044581
+INPUT_EVENT = struct.Struct('llHHi')
+
+POOL_SIZE = 4
+MAX_MAGNITUDE = 0xFFFF
+# Lead time before the first event of a pattern, so it is not late by the scheduling itself
+START_LEAD = 0.005
+# A slot is updated up to this long before its event (once its previous effect ended), so only
+# the play write is left for the deadline
+UPLOAD_LEAD = 0.05
+
+
+class EvdevRumbleDevice:
+    """
+    A /dev/input/eventX device with force feedback.
+
+    Args:
+        device (str or int): Event device path, or an open fd (i.e. evdev.InputDevice.fd).
+    """
+
+    def __init__(self, device):
+        self.owned = not isinstance(device, int)
+        self.fd = os.open(device, os.O_RDWR) if self.owned else device
+
+    def upload(self, effect):
+        """
+        Uploads effect (a bytearray of FF_EFFECT), an id of -1 allocates a new effect.
+
+        Returns:
+            int: The effect id, also written back into effect.
+        """
+        fcntl.ioctl(self.fd, EVIOCSFF, effect, True)
+        return struct.unpack_from('<h', effect, 2)[0]
+
+    def erase(self, effect_id):
+        fcntl.ioctl(self.fd, EVIOCRMFF, effect_id)
+
+    def play(self, effect_id, value=1):
+        os.write(self.fd, INPUT_EVENT.pack(0, 0, EV_FF, effect_id, value))
+
+    def close(self):
+        if self.owned:
+            os.close(self.fd)
+
+
+class EffectPool:
+    """
+    Rumble effects uploaded once and updated in place, shared by HapticsEngine and
+    haptic_playback.PlaybackManager.
+
+    Args:
+        device: EvdevRumbleDevice or fake_evdev.FakeRumbleDevice.
+        size (int): Effects to upload.
+
+    Raises:
+        OSError: If the device has no room for them, the ones already uploaded are erased.
+    """
+
+    def __init__(self, device, size=POOL_SIZE):
+        self.device = device
+        self.effects = []
+        self.ids = []
+        self.holds = []  # (strong, weak, length ms) per slot
+        try:
+            for _ in range(size):
+                effect = bytearray(FF_EFFECT.size)
+                FF_EFFECT.pack_into(effect, 0, FF_RUMBLE, -1, 0, 0, 0, 1, 0, 0, 0)
+                self.ids.append(device.upload(effect))
+                self.effects.append(effect)
+                self.holds.append((0, 0, 1))
+        except OSError:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, slot, params):
+        """
+        Makes a slot hold params, (strong, weak, length ms), with one EVIOCSFF on its id.
+
+        Returns:
+            bool: True if it was uploaded, False if the slot held params already.
+        """
+        if self.holds[slot] == params:
+            return False
+        strong, weak, length = params
+        FF_EFFECT.pack_into(self.effects[slot], 0, FF_RUMBLE, self.ids[slot], 0, 0, 0, length, 0, strong, weak)
+        self.device.upload(self.effects[slot])
+        self.holds[slot] = params
+        return True
+
+    def play(self, slot, value=1):
+        self.device.play(self.ids[slot], value)
+
+    def stop(self):
+        for effect_id in self.ids:
+            self.device.play(effect_id, 0)
+
+    def close(self):
+        for effect_id in self.ids:
+            try:
+                self.device.erase(effect_id)
+            except OSError:
+                pass
+        self.ids = []
+
+
+class Timeline:
+    """
+    A pattern compiled for a pool of effect slots.
+
+    Args:
+        name (str): Pattern name.
+        events (list): (offset seconds, strong, weak, length ms), magnitudes 0-0xFFFF.
+        pool_size (int): Slots to spread overlapping events over.
+
+    events holds (offset, slot, (strong, weak, length), upload offset or None) per event.
+    """
+
+    def __init__(self, name, events, pool_size=POOL_SIZE):
+        self.name = name
+        events = sorted(events)
+        self.duration = max((offset + length / 1000 for offset, _, _, length in events), default=0.0)
+        # The slots are free before the pattern, so its first updates can go ahead of it too
+        busy_until = [-UPLOAD_LEAD] * pool_size
+        holds = [None] * pool_size
+        compiled = []
+        for offset, strong, weak, length in events:
+            params = (min(strong, MAX_MAGNITUDE), min(weak, MAX_MAGNITUDE), length)
+            free = [slot for slot in range(pool_size) if busy_until[slot] <= offset]
+            # A free slot already holding the effect needs no upload, else the longest free one,
+            # if all are playing the one that ends first is cut short
+            same = [slot for slot in free if holds[slot] == params]
+            if same:
+                slot = same[0]
+            elif free:
+                slot = min(free, key=lambda slot: busy_until[slot])
+            else:
+                slot = min(range(pool_size), key=lambda slot: busy_until[slot])
+            upload_at = None if holds[slot] == params else max(busy_until[slot], offset - UPLOAD_LEAD)
+            busy_until[slot] = offset + length / 1000
+            holds[slot] = params
+            compiled.append((offset, slot, params, upload_at))
+        self.events = tuple(compiled)
+        # Time needed before the first event for the updates ahead of it
+        self.lead = -min((event[3] for event in compiled if event[3] is not None), default=0.0)
+
+
+def heartbeat(count=10, strength=0x8000):
+    """
+    Lub-dub every 0.8 s, a strong and a softer 120 ms beat.
+    """
+    events = []
+    for beat in range(count):
+        events.append((beat * 0.8, strength, strength, 120))
+        events.append((beat * 0.8 + 0.25, strength // 2, strength // 2, 100))
+    return Timeline('heartbeat', events)
+
+
+def explosion(strength=0xFFFF, steps=5):
+    """
+    A 300 ms blast, then the shockwave halving in 200 ms steps.
+    """
+    events = [(0.0, strength, strength, 300)]
+    for step in range(1, steps + 1):
+        events.append((0.3 + (step - 1) * 0.2, strength >> step, strength >> (step + 1), 200))
+    return Timeline('explosion', events)
+
+
+def raindrops(count=20, seed=1):
+    """
+    Short weak drops at uneven intervals, the same ones for the same seed.
+    """
+    rng = random.Random(seed)
+    events = []
+    offset = 0.0
+    for _ in range(count):
+        strength = rng.choice((0x1000, 0x2000, 0x3000))
+        events.append((offset, strength // 2, strength, 50))
+        offset += rng.uniform(0.08, 0.3)
+    return Timeline('raindrops', events)
+
+
+def muddy(duration=2.0, strength=0xFFFF):
+    """
+    rumble_sim's strong_muddy_vibration: 500 ms pulses halving down to 0x2000, then again.
+    """
+    events = []
+    for step in range(int(duration / 0.5)):
+        events.append((step * 0.5, strength, strength, 500))
+        strength = strength // 2 if strength > 0x2000 else 0xFFFF
+    return Timeline('muddy', events)
+
+
+PATTERNS = {'heartbeat': heartbeat, 'explosion': explosion, 'raindrops': raindrops, 'muddy': muddy}
+
+
+class PatternStats:
+    """
+    ioctls, writes and start time errors of one played pattern.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.uploads = 0
+        self.erases = 0
+        self.writes = 0
+        self.lateness = []
+
+    def report(self):
+        late = self.lateness or [0.0]
+        return {
+            'pattern': self.name,
+            'events': len(self.lateness),
+            'ioctls': self.uploads + self.erases,
+            'writes': self.writes,
+            'jitter_mean_ms': sum(late) / len(late) * 1000,
+            'jitter_max_ms': max(late) * 1000,
+        }
+
+
+class HapticsEngine:
+    """
+    Plays compiled timelines on a pool of effect slots from one scheduler thread.
+
+    Args:
+        device: EvdevRumbleDevice or fake_evdev.FakeRumbleDevice.
+        pool_size (int): Effects uploaded once and reused.
+    """
+
+    def __init__(self, device, pool_size=POOL_SIZE):
+        self.device = device
+        self.pool = EffectPool(device, pool_size)
+        self.stats = {}
+        self._queue = []  # (deadline, sequence, slot, params, stats, play)
+        self._sequence = 0
+        self._firing = False
+        self._condition = threading.Condition()
+        # The scheduler sleeps in select() on this pipe, Condition.wait() timeouts overshoot by ms
+        self._wake_read, self._wake_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='haptics', daemon=True)
+        self._thread.start()
+
+    def play(self, timeline, start=None):
+        """
+        Schedules a timeline, start is a time.monotonic() value (as soon as the slot updates
+        ahead of the first event allow by default).
+
+        Returns:
+            PatternStats: Filled in while the pattern plays.
+        """
+        if len(timeline.events) and max(event[1] for event in timeline.events) >= len(self.pool):
+            raise ValueError(f"{timeline.name} was compiled for more than {len(self.pool)} slots")
+        start = time.monotonic() + max(START_LEAD, timeline.lead) if start is None else start
+        stats = PatternStats(timeline.name)
+        self.stats[timeline.name] = stats
+        with self._condition:
+            for offset, slot, params, upload_at in timeline.events:
+                if upload_at is not None and upload_at < offset:
+                    self._sequence += 1
+                    heapq.heappush(self._queue, (start + upload_at, self._sequence, slot, params, stats, False))
+                self._sequence += 1
+                heapq.heappush(self._queue, (start + offset, self._sequence, slot, params, stats, True))
+        self._wake()
+        return stats
+
+    def stop(self):
+        """
+        Drops the scheduled events and stops the playing effects.
+        """
+        with self._condition:
+            self._queue.clear()
+        self.pool.stop()
+
+    def wait(self):
+        """
+        Blocks until the scheduled events were played.
+        """
+        with self._condition:
+            while self._queue or self._firing:
+                self._condition.wait()
+
+    def close(self):
+        self.stop()
+        with self._condition:
+            self._running = False
+        self._wake()
+        self._thread.join()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        self.pool.close()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass  # Already woken
+
+    def _fire(self, deadline, slot, params, stats, play):
+        # The slot can hold something else if another pattern used it in between
+        if self.pool.update(slot, params):
+            stats.uploads += 1
+        if not play:
+            return
+        self.pool.play(slot)
+        stats.writes += 1
+        stats.lateness.append(time.monotonic() - deadline)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                if timeout is None or timeout > 0:
+                    entry = None
+                else:
+                    entry = heapq.heappop(self._queue)
+                    self._firing = True
+            if entry is None:
+                if select.select([self._wake_read], [], [], timeout)[0]:
+                    os.read(self._wake_read, 512)
+                continue
+            deadline, _, slot, params, stats, play = entry
+            try:
+                self._fire(deadline, slot, params, stats, play)
+            except OSError as e:
+                logging.error(f"Failed to play the {stats.name} effect: {e}")
+            with self._condition:
+                self._firing = False
+                self._condition.notify_all()
+
+
+def play_like_rumble_sim(device, timeline):
+    """
+    Plays a timeline the way rumble_sim.py did before haptic_playback: a new effect per event,
+    played, erased after its length and the next one after a sleep for the gap, as the baseline
+    of the benchmark.
+
+    Returns:
+        PatternStats: The ioctls and the start time errors against the timeline.
+    """
+    stats = PatternStats(timeline.name)
+    start = time.monotonic() + START_LEAD
+    time.sleep(START_LEAD)
+    previous_end = 0.0
+    for offset, _, (strong, weak, length), _ in timeline.events:
+        time.sleep(max(offset - previous_end, 0.0))
+        effect = bytearray(FF_EFFECT.pack(FF_RUMBLE, -1, 0, 0, 0, length, 0, strong, weak))
+        effect_id = device.upload(effect)
+        device.play(effect_id, 1)
+        stats.lateness.append(time.monotonic() - (start + offset))
+        stats.uploads += 1
+        stats.writes += 1
+        # Overlapping events can not overlap here, pulse_effect sleeps the whole length
+        time.sleep(length / 1000)
+        device.erase(effect_id)
+        stats.erases += 1
+        previous_end = offset + length / 1000
+    return stats
+
+
+def benchmark(ioctl_latency):
+    from fake_evdev import FakeRumbleDevice
+    results = []
+    for name, build in PATTERNS.items():
+        timeline = build()
+        results.append(('rumble_sim', play_like_rumble_sim(FakeRumbleDevice(ioctl_latency=ioctl_latency), timeline).report()))
+        device = FakeRumbleDevice(ioctl_latency=ioctl_latency)
+        engine = HapticsEngine(device)
+        pool_ioctls = device.ioctls
+        stats = engine.play(timeline)
+        engine.wait()
+        engine.close()
+        report = stats.report()
+        report['ioctls'] = f"{report['ioctls']} (+{pool_ioctls} pool, {device.ioctls - pool_ioctls - report['ioctls']} close)"
+        results.append(('engine', report))
+    print(f"ioctl latency: {ioctl_latency * 1000:.1f} ms")
+    print(f"{'':11}{'pattern':10}{'events':>7}  {'ioctls':<20}{'writes':>7}{'jitter mean':>14}{'max':>12}")
+    for runner, report in results:
+        print(f"{runner:11}{report['pattern']:10}{report['events']:>7}  {str(report['ioctls']):<20}{report['writes']:>7}"
+              f"{report['jitter_mean_ms']:>11.2f} ms{report['jitter_max_ms']:>9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timeline haptics engine')
+    parser.add_argument('device', nargs='?', help='Event device of the controller, i.e. /dev/input/event14.')
+    parser.add_argument('--pattern', choices=tuple(PATTERNS), default='heartbeat')
+    parser.add_argument('--fake', action='store_true', help='Play on a fake device.')
+    parser.add_argument('--benchmark', action='store_true', help='Compare with the old rumble_sim.py calls on a fake device.')
+    parser.add_argument('--ioctl_latency', type=float, default=0.002, help='Fake seconds per upload/erase.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.ioctl_latency)
+        return
+    if args.fake:
+        from fake_evdev import FakeRumbleDevice
+        device = FakeRumbleDevice(ioctl_latency=args.ioctl_latency)
+    elif args.device:
+        device = EvdevRumbleDevice(args.device)
+    else:
+        parser.error('a device or --fake is needed')
+    engine = HapticsEngine(device)
+    try:
+        stats = engine.play(PATTERNS[args.pattern]())
+        engine.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+        device.close()
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Closed loop TDP governor.
+
+Description:
+    Finds the lowest TDP that holds a target frame rate and sets it with
+    legiongo_control.set_tdp_value, from the frame times auto_tdp_mockup.LogFollower reads out
+    of the MangoHud log.
+
+    Every update looks at the median frame time of the last WINDOW seconds measured under the
+    current limit, single stutters do not move it, a frame rate below the cap does:
+
+    - above the budget by more than VIOLATION_MARGIN: raise, proportionally to the miss, at
+      most once per RAISE_INTERVAL. The wattage that failed becomes a floor that is not probed
+      again for BACKOFF seconds, doubled every time it fails again.
+    - within HOLD_MARGIN of the budget for LOWER_INTERVAL: probe one watt lower.
+    - in between: keep the limit (hysteresis).
+
+    With the game capped at the target (MangoHud fps_limit) frame times only show whether the
+    target holds, not the headroom, which is why the governor probes down and backs off.
+
+    slow and steady get the wattage, fast FAST_HEADROOM more for short bursts. The TDP can
+    only be set in Custom Mode (wmi_interface.md), the governor switches to it at startup and
+    checks it every MODE_CHECK_INTERVAL, Legion L + Y switches to another mode behind its back.
+
+    --simulate runs a scripted session on GameModel instead of the hardware: a capped game
+    whose scenes need different power for the target, comparing the governor with fixed TDPs.
+
+Usage:
+    ./tdp_governor.py --target_fps 60                     # Follows /home/deck/*.csv
+    ./tdp_governor.py --simulate --target_fps 60
+"""
+
+import argparse
+import collections
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import auto_tdp_mockup
+import legiongo_control
+
+TARGET_FPS = 60
+MIN_WATTS = 5
+MAX_WATTS = 30
+# set_tdp_value's accepted range
+TDP_LIMITS = (3, 40)
+FAST_HEADROOM = 5
+WINDOW = 2.0
+SETTLE = 0.5  # Frames this soon after a change still ran under the old limit
+PERCENTILE = 0.5
+HOLD_MARGIN = 0.02
+VIOLATION_MARGIN = 0.04
+# Frames this much over the budget count as late in --simulate
+LATE_MARGIN = 0.10
+RAISE_INTERVAL = 1.0
+LOWER_INTERVAL = 4.0
+MAX_RAISE = 5
+BACKOFF = 20.0
+MAX_BACKOFF = 160.0
+UPDATE_INTERVAL = 0.5
+# Smart fan mode the TDP writes need
+CUSTOM_MODE = 255
+MODE_CHECK_INTERVAL = 10.0
+# Steady TDP of Balanced mode, in --simulate
+BALANCED_WATTS = 15
+
+
+class TdpGovernor:
+    """
+    Args:
+        target_fps (float): Frame rate to hold.
+        set_tdp (callable): set_tdp(mode, watts), legiongo_control.set_tdp_value. Returns None
+            when the limit could not be set.
+        min_watts (int): Lowest limit it sets.
+        max_watts (int): Highest limit it sets, also the starting one.
+        clock (callable): Seconds, time.monotonic or the simulator's clock.
+        set_mode (callable): set_mode(mode), legiongo_control.set_smart_fan_mode. Returns None on failure.
+        get_mode (callable): legiongo_control.get_smart_fan_mode, None if it could not be read.
+
+    Raises:
+        ValueError: If the TDP range is not supported.
+        OSError: If Custom Mode could not be set.
+    """
+
+    def __init__(self, target_fps=TARGET_FPS, set_tdp=legiongo_control.set_tdp_value, min_watts=MIN_WATTS,
+                 max_watts=MAX_WATTS, clock=time.monotonic, set_mode=legiongo_control.set_smart_fan_mode,
+                 get_mode=legiongo_control.get_smart_fan_mode):
+        if not TDP_LIMITS[0] <= min_watts <= max_watts <= TDP_LIMITS[1] - FAST_HEADROOM:
+            raise ValueError(f"TDP range {min_watts}-{max_watts} W is outside "
+                             f"{TDP_LIMITS[0]}-{TDP_LIMITS[1] - FAST_HEADROOM} W")
+        # Outside Custom Mode the TDP writes succeed but do nothing
+        if set_mode(CUSTOM_MODE) is None:
+            raise OSError("Failed to switch to Custom Mode, the TDP can not be set")
+        self.budget = 1000.0 / target_fps
+        self.set_tdp = set_tdp
+        self.set_mode = set_mode
+        self.get_mode = get_mode
+        self.mode_checked_at = clock()
+        self.mode_changes = 0
+        self.min_watts = min_watts
+        self.max_watts = max_watts
+        self.clock = clock
+        self.samples = collections.deque()  # (time, frame time ms)
+        self.failures = collections.Counter()  # Wattage: times the target failed at it
+        self.floor = None
+        self.floor_until = 0.0
+        self.watts = None
+        self.in_sync = False  # False after a partly failed apply, the modes may differ from watts
+        self.changes = 0
+        self.changed_at = -math.inf
+        self.held_since = None
+        self.apply(max_watts)
+
+    def apply(self, watts):
+        """
+        Sets slow/steady to watts and fast FAST_HEADROOM above.
+
+        The limit only counts as changed once all three modes were set. Otherwise the current one
+        is kept, so the next update decides again and apply() retries.
+
+        Returns:
+            bool: True if the TDP is now watts.
+        """
+        watts = min(max(watts, self.min_watts), self.max_watts)
+        if watts == self.watts and self.in_sync:
+            return True
+        failed = [mode for mode, value in (('slow', watts), ('steady', watts), ('fast', watts + FAST_HEADROOM))
+                  if self.set_tdp(mode, value) is None]
+        if failed:
+            logging.warning(f"Failed to set the {', '.join(failed)} TDP to {watts} W, retrying on the next update")
+            self.in_sync = False
+            return False
+        logging.debug(f"TDP {self.watts} -> {watts} W")
+        self.watts = watts
+        self.in_sync = True
+        self.changes += 1
+        self.changed_at = self.clock()
+        self.held_since = None
+        self.samples.clear()
+        return True
+
+    def check_mode(self, now):
+        """
+        Goes back to Custom Mode if something else switched the smart fan mode, and sets the
+        limit again, the mode switch replaced it.
+
+        Returns:
+            bool: False if the TDP can not be set right now.
+        """
+        if now - self.mode_checked_at < MODE_CHECK_INTERVAL:
+            return True
+        self.mode_checked_at = now
+        mode = self.get_mode()
+        if mode is None or mode == CUSTOM_MODE:
+            return True
+        logging.warning(f"Smart fan mode changed to {mode}, switching back to Custom Mode")
+        self.mode_changes += 1
+        self.in_sync = False
+        if self.set_mode(CUSTOM_MODE) is None:
+            # Checked again on the next update
+            self.mode_checked_at = -math.inf
+            return False
+        return self.apply(self.watts if self.watts is not None else self.max_watts)
+
+    def frame_time(self):
+        """
+        Returns:
+            float: PERCENTILE frame time in ms of the window, None without frames.
+        """
+        if not self.samples:
+            return None
+        times = sorted(sample for _, sample in self.samples)
+        return times[min(int(len(times) * PERCENTILE), len(times) - 1)]
+
+    def update(self, frametimes):
+        """
+        Adds the frame times logged since the last update and adjusts the TDP.
+
+        Args:
+            frametimes (list): Frame times in ms.
+        """
+        now = self.clock()
+        if not self.check_mode(now):
+            return
+        if self.watts is None and not self.apply(self.max_watts):
+            # The starting limit was never set
+            return
+        if now - self.changed_at >= SETTLE:
+            self.samples.extend((now, frametime) for frametime in frametimes)
+        while self.samples and self.samples[0][0] < now - WINDOW:
+            self.samples.popleft()
+        # Judge a limit only on a window full of frames rendered under it
+        if now - self.changed_at < SETTLE + WINDOW / 2:
+            return
+        frametime = self.frame_time()
+        if frametime is None:
+            return
+
+        if frametime > self.budget * (1 + VIOLATION_MARGIN):
+            self.held_since = None
+            if now - self.changed_at < RAISE_INTERVAL or self.watts >= self.max_watts:
+                return
+            self.failures[self.watts] += 1
+            self.floor = self.watts
+            self.floor_until = now + min(BACKOFF * 2 ** (self.failures[self.watts] - 1), MAX_BACKOFF)
+            raise_by = min(max(1, round(self.watts * (frametime / self.budget - 1))), MAX_RAISE)
+            self.apply(self.watts + raise_by)
+        elif frametime <= self.budget * (1 + HOLD_MARGIN):
+            if self.held_since is None:
+                self.held_since = now
+            if now - self.held_since < LOWER_INTERVAL or now - self.changed_at < LOWER_INTERVAL:
+                return
+            lower = self.watts - 1
+            if self.floor is not None and lower <= self.floor and now < self.floor_until:
+                return
+            self.apply(lower)
+        else:
+            self.held_since = None
+
+
+class GameModel:
+    """
+    Deterministic stand in for a game capped at target_fps.
+
+    Each scene needs some power to render at the target. Below that the frame rate falls with
+    ((limit - IDLE) / (need - IDLE)) ** ALPHA, above it the frame cap holds but the boost clocks
+    still burn BOOST_WASTE of the unused headroom, as an APU does racing to idle between frames.
+
+    Args:
+        target_fps (float): The frame cap.
+        seed (int): Frame time jitter seed.
+    """
+
+    IDLE = 4.0
+    ALPHA = 0.6
+    BOOST_WASTE = 0.35
+    JITTER = 0.03
+    SPIKE_CHANCE = 0.01
+    SPIKE = 1.8
+    # (scene, seconds, watts needed for the target)
+    SCENES = (('menu', 60, 7), ('explore', 180, 14), ('combat', 120, 22), ('cutscene', 60, 10),
+              ('boss', 90, 27), ('explore', 90, 15))
+
+    def __init__(self, target_fps=TARGET_FPS, seed=1):
+        self.target_fps = target_fps
+        self.rng = random.Random(seed)
+        self.limit = MAX_WATTS
+        self._frames = 0.0
+
+    @property
+    def duration(self):
+        return sum(seconds for _, seconds, _ in self.SCENES)
+
+    def need(self, t):
+        for _, seconds, need in self.SCENES:
+            if t < seconds:
+                return need
+            t -= seconds
+        return self.SCENES[-1][2]
+
+    def step(self, t, dt):
+        """
+        Returns:
+            tuple: (frame times in ms rendered during dt, watts drawn).
+        """
+        need = self.need(t)
+        if self.limit >= need:
+            fps = self.target_fps
+            watts = need + self.BOOST_WASTE * (self.limit - need)
+        else:
+            fps = self.target_fps * ((self.limit - self.IDLE) / (need - self.IDLE)) ** self.ALPHA
+            watts = self.limit
+        self._frames += fps * dt
+        count = int(self._frames)
+        self._frames -= count
+        frametimes = []
+        for _ in range(count):
+            frametime = 1000.0 / fps * (1 + self.rng.gauss(0, self.JITTER))
+            if self.rng.random() < self.SPIKE_CHANCE:
+                frametime *= self.SPIKE
+            frametimes.append(frametime)
+        return frametimes, watts
+
+
+def simulate(target_fps, watts=None, dt=0.1, seed=1, hotkey_at=None):
+    """
+    Plays the GameModel session at a fixed TDP, or under the governor if watts is None.
+
+    Args:
+        hotkey_at (float): Seconds into the session Legion L + Y switches to Balanced mode,
+            which limits the game to BALANCED_WATTS.
+
+    Returns:
+        dict: joules, frames, violations (frames over the budget by more than LATE_MARGIN),
+        changes, set_tdp_calls and mode_changes (mode switches the governor undid).
+    """
+    game = GameModel(target_fps, seed)
+    now = [0.0]
+    calls = []
+    smart_fan_mode = [2]
+
+    def set_tdp(mode, value):
+        calls.append((now[0], mode, value))
+        # Accepted but ignored outside Custom Mode, like the firmware does
+        if mode == 'steady' and smart_fan_mode[0] == CUSTOM_MODE:
+            game.limit = value
+        return '0'
+
+    def set_mode(mode):
+        smart_fan_mode[0] = mode
+        return '0'
+
+    governor = None
+    if watts is None:
+        governor = TdpGovernor(target_fps, set_tdp, clock=lambda: now[0], set_mode=set_mode,
+                               get_mode=lambda: smart_fan_mode[0])
+    else:
+        game.limit = watts
+    budget = 1000.0 / target_fps * (1 + LATE_MARGIN)
+    joules = frames = violations = 0
+    pending = []
+    steps_per_update = round(UPDATE_INTERVAL / dt)
+    for index in range(round(game.duration / dt)):
+        now[0] = index * dt
+        if hotkey_at is not None and abs(now[0] - hotkey_at) < dt / 2:
+            smart_fan_mode[0] = 2
+            game.limit = BALANCED_WATTS
+        frametimes, drawn = game.step(now[0], dt)
+        joules += drawn * dt
+        frames += len(frametimes)
+        violations += sum(frametime > budget for frametime in frametimes)
+        pending.extend(frametimes)
+        if governor is not None and index % steps_per_update == steps_per_update - 1:
+            now[0] = (index + 1) * dt
+            governor.update(pending)
+            pending = []
+    return {'joules': joules, 'frames': frames, 'violations': violations,
+            'changes': governor.changes if governor else 0, 'set_tdp_calls': len(calls),
+            'mode_changes': governor.mode_changes if governor else 0}
+
+
+def benchmark(target_fps, fixed=(MAX_WATTS, 20, 15)):
+    duration = GameModel(target_fps).duration
+    baseline = simulate(target_fps, fixed[0])
+    print(f"{duration} s scripted session at {target_fps} FPS, GameModel scenes need "
+          f"{', '.join(f'{need} W' for _, _, need in GameModel.SCENES)}")
+    print(f"{'TDP':>10} {'energy':>9} {'avg W':>6} {'saved':>6} {'avg FPS':>8} {'late frames':>12} {'changes':>8} {'set_tdp':>8}")
+    hotkey_at = sum(seconds for _, seconds, _ in GameModel.SCENES[:4])
+    runs = [(f'{value} W', value, None) for value in fixed] + [('governor', None, None), ('L+Y', None, hotkey_at)]
+    for label, watts, hotkey in runs:
+        result = simulate(target_fps, watts, hotkey_at=hotkey)
+        print(f"{label:>10} {result['joules'] / 1000:7.2f}kJ {result['joules'] / duration:6.1f} "
+              f"{(1 - result['joules'] / baseline['joules']) * 100:5.1f}% "
+              f"{result['frames'] / duration:8.1f} {result['violations'] / result['frames'] * 100:11.2f}% {result['changes']:>8} {result['set_tdp_calls']:>8}")
+    print(f"L+Y: the governor under Legion L + Y switching to Balanced ({BALANCED_WATTS} W) at {hotkey_at} s, "
+          f"in the boss scene, it went back to Custom Mode {result['mode_changes']} time(s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed loop TDP governor on MangoHud frame times')
+    parser.add_argument('--target_fps', type=float, default=TARGET_FPS, help='Frame rate to hold.')
+    parser.add_argument('--min_watts', type=int, default=MIN_WATTS)
+    parser.add_argument('--max_watts', type=int, default=MAX_WATTS)
+    parser.add_argument('--pattern', default=auto_tdp_mockup.CSV_FILE_PATTERN, help='Glob of the MangoHud CSV logs.')
+    parser.add_argument('--simulate', action='store_true', help='Compare with fixed TDPs on the game model, no hardware.')
+    parser.add_argument('--verbose', action='store_true', help='Log every TDP change.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if args.simulate:
+        benchmark(args.target_fps)
+        return
+
+    try:
+        governor = TdpGovernor(args.target_fps, min_watts=args.min_watts, max_watts=args.max_watts)
+    except OSError as e:
+        logging.error(f"Can not start the TDP governor: {e}")
+        raise SystemExit(1)
+    follower = auto_tdp_mockup.LogFollower(args.pattern)
+    try:
+        while True:
+            governor.update(follower.poll())
+            time.sleep(UPDATE_INTERVAL)
+    except KeyboardInterrupt:
+        print("Program stopped by the user.")
+    finally:
+        follower.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -1,9 +1,16 @@
 import os
-import subprocess
 import logging
+import math
 import sys
 import time
 
+# The shared modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import acpi_transport
+import state_cache
+import status_snapshot
+import wmi_codec
+
 """
 This script provides a Python interface to the ACPI interface of the Lenovo Legion Go.
 """
@@ -14,20 +21,43 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 def execute_acpi_command(command):
     """
     Executes an ACPI command and returns the output.
-    Uses subprocess for robust command execution.
+    Uses the shared in-process transport, /proc/acpi/call stays open between calls.
 
     Args:
-        command (str): The ACPI command to be executed.
+        command (str): The ACPI command to be executed, built with wmi_codec.
     
     Returns:
-        str: The output from the ACPI command execution.
+        str: The response from the ACPI command execution.
     """
     try:
-        result = subprocess.run(command, shell=True, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error executing command: {e.stderr}")
+        return acpi_transport.get_transport().call(command)
+    except acpi_transport.AcpiCallError as e:
+        logging.error(f"Error executing command: {e}")
         return None
+
+def execute_and_decode(command, description, cache_key=None):
+    """
+    Executes an ACPI command and decodes its response into an int.
+
+    Args:
+        command (str): The ACPI command to be executed, built with wmi_codec.
+        description (str): What is being read, used in the error message.
+        cache_key (str): Record the value in the device state cache under this key.
+
+    Returns:
+        int: The decoded value, or "N/A" if the call or the decoding fails.
+    """
+    output = execute_acpi_command(command)
+    if output is None:
+        return "N/A"
+    try:
+        value = wmi_codec.decode_int(output)
+    except wmi_codec.WmiDecodeError:
+        logging.error(f"Failed to parse {description}.")
+        return "N/A"
+    if cache_key:
+        state_cache.get_cache().update(cache_key, value)
+    return value
     
 def parse_fan_curve(raw_data):
     """
@@ -37,32 +67,7 @@ def parse_fan_curve(raw_data):
     try:
         logging.info("Starting to parse fan curve data.")
 
-        # Find the start and end of the hex data block
-        hex_data_start = raw_data.find('{')
-        hex_data_end = raw_data.find('}') + 1
-        if hex_data_start == -1 or hex_data_end == -1:
-            raise ValueError("Invalid data format")
-
-        logging.info(f"Extracted hex data block: {raw_data[hex_data_start:hex_data_end]}")
-
-        # Extract and clean up the hex data
-        hex_data = raw_data[hex_data_start:hex_data_end].strip('{}').split(', ')
-        data_values = []
-        for i in range(0, len(hex_data), 4):  # Process every 4 bytes
-            hex_group = ''.join(hex_data[i:i+4]).replace('0x', '').replace(' ', '')
-            # Reverse the order of bytes for little endian format
-            hex_group = ''.join(reversed([hex_group[j:j+2] for j in range(0, len(hex_group), 2)]))
-            logging.info(f"Hex group to convert: {hex_group}")
-            int_value = int(hex_group, 16)
-            data_values.append(int_value)
-
-        logging.info(f"Parsed data values: {data_values}")
-
-        # Extracting fan speeds and temperatures
-        speeds_length = data_values[0]
-        fan_speeds = data_values[1:speeds_length + 1]
-        temps_length = data_values[speeds_length + 1]
-        temperatures = data_values[speeds_length + 2: speeds_length + 2 + temps_length]
+        fan_speeds, temperatures = wmi_codec.decode_fan_table(raw_data)
 
         logging.info(f"Fan speeds: {fan_speeds}")
         logging.info(f"Temperatures: {temperatures}")
@@ -82,8 +87,9 @@ def retrieve_fan_curve():
     """
     Retrieves the fan curve from the ACPI interface and returns the parsed output.
     """
-    command = "echo '\\_SB.GZFD.WMAB 0 0x05 0x0000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    raw_data = execute_acpi_command(command)
+    raw_data = execute_acpi_command(wmi_codec.GET_FAN_TABLE_COMMAND)
+    if raw_data is None:
+        return None
     return parse_fan_curve(raw_data)
 
 #echo '\_SB.GZFD.WMAE 0 0x11 0x04020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call
@@ -92,19 +98,9 @@ def get_full_fan_speed():
     Full fan speed is the maximum fan speed that can be set.
 
     Returns:
-        str: ?
+        int: 1 if full fan speed mode is on, 0 if it is off.
     """
-    command = "echo '\\_SB.GZFD.WMAE 0 0x11 0x04020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    # Assuming the output is a hexadecimal value
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+6]
-    try:
-        fan_speed = output  # Convert from hex to decimal
-        return fan_speed
-    except ValueError:
-        logging.error("Failed to parse fan speed.")
-        return "N/A"
+    return execute_and_decode(wmi_codec.encode_get_feature('full_fan_speed'), "full fan speed status", 'full_fan_speed')
 # FFSS Full speed mode set on /off
 # echo '\_SB.GZFD.WMAE 0 0x12 0x0104020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call
 # echo '\_SB.GZFD.WMAE 0 0x12 0x0004020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call
@@ -118,9 +114,9 @@ def set_full_fan_speed(enable):
     Returns:
         str: The result of the operation.
     """
-    status = '0x01' if enable else '0x00'
-    command = f"echo '\\_SB.GZFD.WMAE 0 0x12 {status}04020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    return execute_acpi_command(command)
+    value = 1 if enable else 0
+    command = wmi_codec.encode_set_feature('full_fan_speed', value)
+    return state_cache.get_cache().write_through('full_fan_speed', value, lambda: execute_acpi_command(command))
 
 def set_fan_curve(fan_table):
     """
@@ -133,18 +129,11 @@ def set_fan_curve(fan_table):
     Returns:
         str: The output from setting the new fan curve.
     """
-    # Assuming Fan ID and Sensor ID are both 0 (as they are ignored)
-    fan_id_sensor_id = '0x00, 0x00'
-
-    # Assuming the temperature array length and values are ignored but required
-    temp_array_length = '0x0A, 0x00, 0x00, 0x00'  # Length 10 in hex
-    temp_values = ', '.join([f'0x{temp:02x}, 0x00' for temp in range(0, 101, 10)]) + ', 0x00'
-
-    # Fan speed values in uint16 format with null termination
-    fan_speed_values = ', '.join([f'0x{speed:02x}, 0x00' for speed in fan_table]) + ', 0x00'
-
-    # Constructing the full command
-    command = f"echo '\\_SB.GZFD.WMAB 0 0x06 {{{fan_id_sensor_id}, {temp_array_length}, {fan_speed_values}, {temp_array_length}, {temp_values}}}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    try:
+        command = wmi_codec.encode_set_fan_table(fan_table)
+    except ValueError as e:
+        logging.error(f"Invalid fan curve: {e}")
+        return None
     return execute_acpi_command(command)
 
 
@@ -161,16 +150,16 @@ def set_tdp_value(mode, wattage):
     Returns:
         str: The output from setting the TDP value.
     """
-    mode_mappings = {'Slow': '0x01', 'Steady': '0x02', 'Fast': '0x03'}
-    mode_code = mode_mappings.get(mode, '0x02')  # Default to 'Steady' if mode is not found
+    feature = wmi_codec.TDP_FEATURES.get(mode.lower(), 'steady_tdp')  # Default to 'Steady' if mode is not found
 
     # Create the command with the desired format
-    command = f"echo '\\_SB.GZFD.WMAE 0 0x12 {{0x00, 0xFF, {mode_code}, 0x01, {wattage}, 0x00, 0x00, 0x00}}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_set_feature(feature, wattage)
 
     # Logging the command
     logging.info(f"Command to set TDP value: {command}")
 
-    output = execute_acpi_command(command)
+    # Skipped if the firmware already holds this wattage
+    output = state_cache.get_cache().write_through(feature, wattage, lambda: execute_acpi_command(command))
 
     # Logging the output
     logging.info(f"Output from setting TDP value: {output}")
@@ -187,8 +176,7 @@ def set_overclocking_status(enable):
     Returns:
         str: The result of the overclocking operation.
     """
-    status = '0x01' if enable else '0x00'
-    command = f"echo '\\_SB.GZFD.WMAE 0 0x33 {status}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_call('WMAE', 0x33, 1 if enable else 0)
     return execute_acpi_command(command)
 
 def get_gpu_overclocking_status():
@@ -198,7 +186,7 @@ def get_gpu_overclocking_status():
     Returns:
         str: GPU overclocking status.
     """
-    command = "echo '\\_SB.GZFD.WMAE 0 0x04' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_call('WMAE', 0x04)
     return execute_acpi_command(command)
 
 def set_thermal_mode(mode_id):
@@ -211,7 +199,7 @@ def set_thermal_mode(mode_id):
     Returns:
         str: The result of the operation.
     """
-    command = f"echo '\\_SB.GZFD.WMAA 0 0x03 {mode_id}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_set_thermal_table_id(mode_id)
     return execute_acpi_command(command)
 
 def get_current_thermal_mode():
@@ -221,8 +209,7 @@ def get_current_thermal_mode():
     Returns:
         str: The current thermal mode.
     """
-    command = "echo '\\_SB.GZFD.WMAA 0 0x02' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    return execute_acpi_command(command)
+    return execute_acpi_command(wmi_codec.GET_THERMAL_TABLE_ID_COMMAND)
 
 def set_smart_fan_mode(mode_value):
     """
@@ -243,8 +230,14 @@ def set_smart_fan_mode(mode_value):
     Returns:
         str: The result of the operation. Returns None if an error occurs.
     """
-    command = f"echo '\\_SB.GZFD.WMAA 0 0x2C {mode_value}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    return execute_acpi_command(command)
+    command = wmi_codec.encode_set_smart_fan_mode(mode_value)
+    cache = state_cache.get_cache()
+    output = cache.write_through('smart_fan_mode', mode_value, lambda: execute_acpi_command(command))
+    if output != state_cache.UNCHANGED:
+        # Switching modes reconfigures the platform, do not trust the cached TDP values
+        for feature in wmi_codec.TDP_FEATURES.values():
+            cache.invalidate(feature)
+    return output
 
 
 def get_smart_fan_mode():
@@ -254,19 +247,15 @@ def get_smart_fan_mode():
     This function retrieves the current setting of the Smart Fan mode as specified in the WMI documentation.
 
     Returns:
-        str: The current Smart Fan Mode. The return value corresponds to:
-             - '0': Quiet Mode
-             - '1': Balanced Mode
-             - '2': Performance Mode
-             - '224': Extreme Mode
-             - '255': Custom Mode
-             Returns None if an error occurs.
-    """
-    command = "echo '\\_SB.GZFD.WMAA 0 0x2D' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+5]
-    return output
+        int: The current Smart Fan Mode. The return value corresponds to:
+             - 0: Quiet Mode
+             - 1: Balanced Mode
+             - 2: Performance Mode
+             - 224: Extreme Mode
+             - 255: Custom Mode
+             Returns "N/A" if an error occurs.
+    """
+    return execute_and_decode(wmi_codec.GET_SMART_FAN_MODE_COMMAND, "Smart Fan Mode")
 
 
 def get_smart_fan_setting_mode():
@@ -276,69 +265,38 @@ def get_smart_fan_setting_mode():
     This function retrieves the specific setting or configuration of the Smart Fan.
 
     Returns:
-        str: The current Smart Fan Setting Mode. The return value might require interpretation based on the system's BIOS.
+        int: The current Smart Fan Setting Mode. The return value might require interpretation based on the system's BIOS.
              Known values might include various numeric codes representing specific fan curves or settings.
-             Returns None if an error occurs.
+             Returns "N/A" if an error occurs.
     """
-    command = "echo '\\_SB.GZFD.WMAA 0 0x2E' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+5]
-    return output
+    return execute_and_decode(wmi_codec.GET_SMART_FAN_SETTING_MODE_COMMAND, "Smart Fan Setting Mode")
 
 
 def get_fan_speed():
     """
-    Get the current fan speed in %.
+    Get the current fan speed.
 
     Returns:
-        str: The current fan speed in %.
+        int: The current fan speed in RPM, the firmware returns it as {FANL, FANH}.
     """
-    command = "echo '\\_SB.GZFD.WMAE 0 0x11 0x04030001' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-
-    # Assuming the output is a hexadecimal value
-    first_brace_position = output.find('{')
-    output = output[first_brace_position+1:first_brace_position+5]
-    try:
-        fan_speed = int(output, 16)  # Convert from hex to decimal
-        return fan_speed
-    except ValueError:
-        logging.error("Failed to parse fan speed.")
-        return "N/A"
+    return execute_and_decode(wmi_codec.encode_get_feature('fan_speed'), "fan speed")
     
 def get_cpu_temperature():
     """
     Get the current CPU temperature.
 
     Returns:
-        str: The current CPU temperature.
+        int: The current CPU temperature.
     """
-    command = "echo '\\_SB.GZFD.WMAE 0 0x11 0x05040000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+5]
-    try:
-        return int(output, 16) # Convert from hex to decimal
-    except ValueError:
-        logging.error("Failed to parse CPU temperature.")
-        return "N/A"
+    return execute_and_decode(wmi_codec.encode_get_feature('cpu_temperature'), "CPU temperature")
 def get_gpu_temperature():
     """
     Get the current GPU temperature.
 
     Returns:
-        str: The current GPU temperature.
+        int: The current GPU temperature.
     """
-    command = "echo '\\_SB.GZFD.WMAE 0 0x11 0x05050000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+5]
-    try:
-        return int(output, 16) # Convert from hex to decimal
-    except ValueError:
-        logging.error("Failed to parse GPU temperature.")
-        return "N/A"
+    return execute_and_decode(wmi_codec.encode_get_feature('gpu_temperature'), "GPU temperature")
 
 def get_tdp_value(mode):
     """
@@ -348,23 +306,14 @@ def get_tdp_value(mode):
         mode (str): The TDP mode ('Slow', 'Steady', 'Fast').
 
     Returns:
-        str: The output from retrieving the TDP value, or None if an error occurs.
+        int: The TDP value, or None if an error occurs.
     """
-    mode_mappings = {'Slow': '01', 'Steady': '02', 'Fast': '03'}
-    mode_code = mode_mappings.get(mode, '02')  # Default to 'Steady' if mode is not found
-
-    # Using the format without braces for simplicity
-    command = f"echo '\\_SB.GZFD.WMAE 0 0x11 0x01{mode_code}FF00' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    response = execute_acpi_command(command)
-
-
-    if response:
-        # Parse the response to extract the TDP value
-        # Implement the parsing logic based on the response format
-        return response
-    else:
+    feature = wmi_codec.TDP_FEATURES.get(mode.lower(), 'steady_tdp')  # Default to 'Steady' if mode is not found
+    value = execute_and_decode(wmi_codec.encode_get_feature(feature), f"{mode} TDP value", feature)
+    if value == "N/A":
         logging.error("Failed to retrieve TDP value.")
         return None
+    return value
 
 def get_all_tdp_values():
     """
@@ -373,18 +322,12 @@ def get_all_tdp_values():
     Returns:
         str: A formatted string containing the TDP values for all modes.
     """
-    mode_mappings = {'Slow': '01', 'Steady': '02', 'Fast': '03'}
     tdp_values = []
 
-    for mode, code in mode_mappings.items():
-        command = f"echo '\\_SB.GZFD.WMAE 0 0x11 0x01{code}FF00' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-        response = execute_acpi_command(command)
-        first_newline_position = response.find('\n')
-        response = response[first_newline_position+1:first_newline_position+5]
-        response = int(response, 16) # Convert from hex to decimal
+    for mode in ('Slow', 'Steady', 'Fast'):
+        response = get_tdp_value(mode)
 
         if response:
-            # Add parsing logic here if necessary
             tdp_values.append(f"{mode} mode: {response}")
         else:
             tdp_values.append(f"{mode} mode: Failed to retrieve value")
@@ -410,7 +353,7 @@ def set_lighting_status(lighting_id, state_type, brightness_level):
     Returns:
         str: The output from setting the lighting status.
     """
-    command = f"echo '\\_SB.GZFD.WMAF 0 0x02 {{{lighting_id}, {state_type}, {brightness_level}}}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_set_lighting(lighting_id, state_type, brightness_level)
     return execute_acpi_command(command)
 
 def get_lighting_status(lighting_id):
@@ -421,13 +364,16 @@ def get_lighting_status(lighting_id):
         lighting_id (int): The ID of the lighting component to check.
 
     Returns:
-        str: The current lighting status of the specified component.
+        int or bytes: The current lighting status of the specified component, as returned by the firmware.
     """
-    command = f"echo '\\_SB.GZFD.WMAF 0 0x01 {lighting_id}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+15]
-    return output
+    output = execute_acpi_command(wmi_codec.encode_get_lighting(lighting_id))
+    if output is None:
+        return "N/A"
+    try:
+        return wmi_codec.decode_response(output)
+    except wmi_codec.WmiDecodeError:
+        logging.error("Failed to parse lighting status.")
+        return "N/A"
 
 def input_fan_curve():
     """
@@ -470,30 +416,54 @@ def input_lighting_id():
     """
     return int(input("Enter Lighting ID: "))
 
-def continuously_update_status():
+def input_refresh_rate():
     """
-    Continuously update and display system status information every second.
+    Collects the status refresh rate, asks again until it is a positive number.
+    Returns:
+        float: The rate in Hz, 1 if nothing was entered.
+    """
+    while True:
+        rate = input("Enter refresh rate in Hz (default 1): ").strip()
+        if not rate:
+            return 1.0
+        try:
+            value = float(rate)
+        except ValueError:
+            value = None
+        if value is not None and value > 0 and math.isfinite(value):
+            return value
+        print("The refresh rate must be a positive number.")
+
+def continuously_update_status(interval=1.0):
+    """
+    Continuously update and display system status information.
+    All values are read in one batch per refresh, see status_snapshot.
+
+    Args:
+        interval (float): Seconds between refreshes, 0.1 gives a 10 Hz refresh.
     """
     try:
         while True:
-            fan_speed = get_fan_speed()
-            cpu_temp = get_cpu_temperature()
-            # gpu_temp = get_gpu_temperature()
-            smart_fan_mode = get_smart_fan_mode()
-            lighting_status = get_lighting_status(3)
-            tdp_values = get_all_tdp_values()
+            try:
+                snapshot = status_snapshot.read_status_snapshot()
+            except acpi_transport.AcpiCallError as e:
+                logging.error(f"Failed to read status: {e}")
+                time.sleep(interval)
+                continue
             # Clear the screen for better readability
             os.system('cls' if os.name == 'nt' else 'clear')
 
-            print(f"Fan Speed: {fan_speed} %")
-            print(f"CPU Temperature: {cpu_temp}°C")
-            # print(f"GPU Temperature: {gpu_temp}°C")
-            print(f"Smart Fan Mode: {smart_fan_mode}")
-            print(f"Power Button Lighting Status: {lighting_status}")
-            print(f"TDP Values for custom mode:\n{tdp_values}")
-
-            # Wait for 1 second before updating the values again
-            time.sleep(1)
+            print(f"Fan Speed: {snapshot.fan_speed} RPM")
+            print(f"CPU Temperature: {snapshot.cpu_temperature}°C")
+            # print(f"GPU Temperature: {snapshot.gpu_temperature}°C")
+            print(f"Smart Fan Mode: {snapshot.smart_fan_mode}")
+            print(f"Power Button Lighting Status: {snapshot.power_button_lighting}")
+            print(f"TDP Values for custom mode:\nSlow mode: {snapshot.slow_tdp}\nSteady mode: {snapshot.steady_tdp}\nFast mode: {snapshot.fast_tdp}")
+            print(f"Refresh: {snapshot.format_timings()}")
+            print(f"State cache: {state_cache.get_cache().stats}")
+
+            # Wait for the rest of the interval before updating the values again
+            time.sleep(max(0.0, interval - snapshot.total_time))
     except KeyboardInterrupt:
         print("Status update stopped.")
 
@@ -559,6 +529,7 @@ if __name__ == "__main__":
         print("26. Get Full Fan Speed Mode Status")
         print("27. Set Dock Mode")
         print("28. Set Undock Mode")
+        print("29. Refresh Cached Device State")
 
 
         choice = input("Enter your choice: ")
@@ -648,7 +619,7 @@ if __name__ == "__main__":
             logging.info("Exiting script.")
             break
         elif choice == '16':
-            continuously_update_status()
+            continuously_update_status(1 / input_refresh_rate())
         elif choice == '17':
             set_overclocking_status(True)
         elif choice == '18':
@@ -673,6 +644,9 @@ if __name__ == "__main__":
             dock_mode()
         elif choice == '28':
             undock_mode()
+        elif choice == '29':
+            state_cache.get_cache().invalidate()
+            logging.info(f"Device state cache cleared. {state_cache.get_cache().stats}")
 
         
         else:
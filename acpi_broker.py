@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Legion Go ACPI broker.
+
+Description:
+    Long running root daemon that owns /proc/acpi/call and serves ACPI requests to the other
+    scripts over a local Unix socket. acpi_call only has one result buffer, so every write and
+    its read-back are done under one lock, requests from different clients can not interleave.
+
+    legiongo_control.py, legion_fan_helper.py and the Legacy tool pick the broker up through
+    acpi_transport.get_transport() when its socket exists, they then no longer need sudo.
+
+Protocol:
+    One JSON object per line in both directions. Every request has an "op" and an optional
+    "id" that is echoed back. Replies are {"id": .., "ok": true, "result": ..} or
+    {"id": .., "ok": false, "error": ".."}.
+
+    {"op": "call", "command": "\\_SB.GZFD.WMAA 0 0x2D"}     Raw GZFD call, returns the response string
+    {"op": "batch", "commands": [..]}                     Raw GZFD calls in one go, returns [[response, seconds], ..]
+    {"op": "get", "feature": "cpu_temperature"}            WMAE get, returns an int
+    {"op": "set", "feature": "steady_tdp", "value": 16}    WMAE set
+    {"op": "get_smart_fan_mode"}                          Returns an int
+    {"op": "set_smart_fan_mode", "value": 255}
+    {"op": "get_fan_table"}                               Returns {"speeds": [..], "temperatures": [..]}
+    {"op": "set_fan_table", "speeds": [..]}
+    {"op": "stats"}                                       Returns the ACPI call latency counters
+
+Usage:
+    sudo ./acpi_broker.py
+    ./acpi_broker.py --fake --socket /tmp/legion_acpi_broker.sock   # No hardware needed
+    ACPI_BROKER_SOCKET=/tmp/legion_acpi_broker.sock ./legiongo_control.py --get-tdp ALL
+"""
+
+import argparse
+import errno
+import grp
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import socketserver
+import stat
+import threading
+
+import acpi_transport
+import wmi_codec
+
+# Only the Lenovo WMI methods may be called through the broker, it runs as root
+ALLOWED_CALL_PATTERN = re.compile(r'^\\_SB\.GZFD\.WM(AA|AB|AE|AF) 0 0x[0-9A-Fa-f]{1,2}( [^\n]*)?$')
+
+
+class BrokerError(Exception):
+    """
+    Raised for invalid requests, the message is sent back to the client.
+    """
+
+
+def _call(transport, command):
+    if not ALLOWED_CALL_PATTERN.match(command):
+        raise BrokerError(f"Command not allowed: {command}")
+    return transport.call(command)
+
+
+def _batch(transport, commands):
+    if not isinstance(commands, list):
+        raise BrokerError("commands must be a list")
+    for command in commands:
+        if not ALLOWED_CALL_PATTERN.match(str(command)):
+            raise BrokerError(f"Command not allowed: {command}")
+    return transport.call_batch([str(command) for command in commands])
+
+
+def _get(transport, request):
+    feature = request.get('feature')
+    if feature not in wmi_codec.FEATURES:
+        raise BrokerError(f"Unknown feature: {feature}")
+    return wmi_codec.decode_int(transport.call(wmi_codec.encode_get_feature(feature)))
+
+
+def _set(transport, request):
+    feature = request.get('feature')
+    if feature not in wmi_codec.FEATURES:
+        raise BrokerError(f"Unknown feature: {feature}")
+    return transport.call(wmi_codec.encode_set_feature(feature, int(request['value'])))
+
+
+def _get_smart_fan_mode(transport, request):
+    return wmi_codec.decode_int(transport.call(wmi_codec.GET_SMART_FAN_MODE_COMMAND))
+
+
+def _set_smart_fan_mode(transport, request):
+    value = int(request['value'])
+    if value not in wmi_codec.SMART_FAN_MODES:
+        raise BrokerError(f"Invalid Smart Fan Mode: {value}")
+    return transport.call(wmi_codec.encode_set_smart_fan_mode(value))
+
+
+def _get_fan_table(transport, request):
+    speeds, temperatures = wmi_codec.decode_fan_table(transport.call(wmi_codec.GET_FAN_TABLE_COMMAND))
+    return {'speeds': speeds, 'temperatures': temperatures}
+
+
+def _set_fan_table(transport, request):
+    return transport.call(wmi_codec.encode_set_fan_table([int(speed) for speed in request['speeds']]))
+
+
+def _stats(transport, request):
+    stats = transport.stats
+    return {'count': stats.count, 'average_ms': stats.average_time * 1000, 'max_ms': stats.max_time * 1000}
+
+
+OPERATIONS = {
+    'call': lambda transport, request: _call(transport, str(request.get('command', ''))),
+    'batch': lambda transport, request: _batch(transport, request.get('commands')),
+    'get': _get,
+    'set': _set,
+    'get_smart_fan_mode': _get_smart_fan_mode,
+    'set_smart_fan_mode': _set_smart_fan_mode,
+    'get_fan_table': _get_fan_table,
+    'set_fan_table': _set_fan_table,
+    'stats': _stats,
+}
+
+
+def handle_request(transport, line):
+    """
+    Runs one JSON-lines request against the transport.
+
+    Args:
+        transport: The transport that owns the ACPI device.
+        line (bytes): One request line.
+
+    Returns:
+        dict: The reply.
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise BrokerError("Request must be a JSON object")
+        request_id = request.get('id')
+        operation = OPERATIONS.get(request.get('op'))
+        if operation is None:
+            raise BrokerError(f"Unknown op: {request.get('op')}")
+        return {'id': request_id, 'ok': True, 'result': operation(transport, request)}
+    except (BrokerError, ValueError, KeyError, TypeError, OSError) as e:
+        # ValueError covers bad JSON, bad values and WmiDecodeError
+        return {'id': request_id, 'ok': False, 'error': str(e)}
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = handle_request(self.server.transport, line)
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server, one thread per client. The transport lock serializes the ACPI calls.
+
+    Args:
+        socket_path (str): Where to create the socket, an existing stale socket is removed.
+        transport: The transport that owns the ACPI device.
+        mode (int): Socket file permissions.
+        group (str): Group that may use the socket, None to keep the current group.
+
+    Raises:
+        OSError: If another broker is listening on socket_path.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, transport, mode=0o660, group=None):
+        self._remove_stale_socket(socket_path)
+        self.transport = transport
+        super().__init__(socket_path, BrokerRequestHandler)
+        if group:
+            os.chown(socket_path, -1, grp.getgrnam(group).gr_gid)
+        os.chmod(socket_path, mode)
+
+    @staticmethod
+    def _remove_stale_socket(socket_path):
+        # Only a socket nobody listens on is stale, removing a live one would orphan its broker
+        try:
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise OSError(errno.EEXIST, f"{socket_path} exists and is not a socket")
+        except FileNotFoundError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except FileNotFoundError:
+            return
+        except ConnectionRefusedError:
+            logging.info(f"Removing stale socket {socket_path}")
+            os.remove(socket_path)
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, f"Another ACPI broker is listening on {socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go ACPI broker')
+    parser.add_argument('--socket', default=acpi_transport.ACPI_BROKER_SOCKET, help='Unix socket to listen on.')
+    parser.add_argument('--device', default=acpi_transport.ACPI_CALL_PATH, help='acpi_call device node.')
+    parser.add_argument('--group', help='Group allowed to use the socket, i.e. wheel. Defaults to root only.')
+    parser.add_argument('--fake', action='store_true', help='Serve a fake /proc/acpi/call, no hardware needed.')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.fake:
+        import fake_acpi_call
+        transport = fake_acpi_call.FakeAcpiCall()
+    else:
+        transport = acpi_transport.AcpiCallTransport(args.device).open()
+
+    try:
+        server = BrokerServer(args.socket, transport, mode=0o660 if args.group else 0o600, group=args.group)
+    except OSError as e:
+        logging.error(f"Can not listen on {args.socket}: {e}")
+        raise SystemExit(1)
+    # serve_forever has to be stopped from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info(f"ACPI broker listening on {args.socket} ({transport.name} transport)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        transport.close()
+        logging.info(f"ACPI broker stopped, {transport.stats}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
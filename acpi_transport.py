@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+ACPI call transport for the Legion Go.
+
+Description:
+    Talks to the acpi_call kernel module through /proc/acpi/call without spawning a shell.
+    The device node is opened once and kept open for the life of the process, every call
+    is a write followed by a read-back on the same file descriptor.
+
+    The old pipeline (echo | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call) is kept as
+    SubprocessTransport, it is used as a fallback when the current user can not open the
+    device node and as the baseline for the latency comparison.
+
+    When the ACPI broker (acpi_broker.py) is running, get_transport() returns a BrokerTransport
+    instead, which forwards every call to the broker over its Unix socket.
+
+Usage:
+    ./acpi_transport.py "\\_SB.GZFD.WMAA 0 0x2D"
+    ./acpi_transport.py --benchmark 50 "\\_SB.GZFD.WMAE 0 0x11 0x05040000"
+    ./acpi_transport.py --device /tmp/fake_acpi_call --benchmark 50 "\\_SB.GZFD.WMAA 0 0x2D"
+
+    The device path can also be set with the ACPI_CALL_PATH environment variable, so a temp
+    file or FIFO can stand in for /proc/acpi/call when there is no hardware. Both hand the
+    command back as the response. A FIFO can not seek, it is written and read in sequence, and
+    it does not work with the tee/cat baseline of --benchmark, cat waits for a writer forever.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import stat
+import subprocess
+import threading
+import time
+
+ACPI_CALL_PATH = os.environ.get('ACPI_CALL_PATH', '/proc/acpi/call')
+
+# acpi_call needs to be built with a larger buffer for the fan table, read up to this many bytes
+ACPI_CALL_BUFFER_SIZE = 4096
+
+ACPI_BROKER_SOCKET = os.environ.get('ACPI_BROKER_SOCKET', '/run/legion_acpi_broker.sock')
+
+
+class AcpiCallError(OSError):
+    """
+    Raised when an ACPI call could not be written to or read back from the device.
+    """
+
+
+class AcpiCallStats:
+    """
+    Per transport latency counters, all times are in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    @property
+    def average_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def __str__(self):
+        return (f"calls: {self.count}, avg: {self.average_time * 1000:.3f} ms, "
+                f"max: {self.max_time * 1000:.3f} ms, last: {self.last_time * 1000:.3f} ms")
+
+
+class AcpiCallTransport:
+    """
+    Keeps the acpi_call device open and does the write and read-back in-process.
+
+    Args:
+        path (str): The acpi_call device node, defaults to ACPI_CALL_PATH.
+    """
+
+    name = 'in-process'
+
+    def __init__(self, path=ACPI_CALL_PATH):
+        self.path = path
+        self.stats = AcpiCallStats()
+        self._fd = None
+        self._regular_file = False
+        self._seekable = True
+        # acpi_call has a single result buffer, a write and its read-back must not interleave
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR)
+            mode = os.fstat(self._fd).st_mode
+            self._regular_file = stat.S_ISREG(mode)
+            # A FIFO stand-in can not seek, it hands back what was written to it
+            self._seekable = not stat.S_ISFIFO(mode)
+            logging.debug(f"Opened ACPI call device: {self.path}")
+        return self
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def call(self, command):
+        """
+        Writes an ACPI command and returns the response.
+
+        Args:
+            command (str): The ACPI method call, i.e. "\\_SB.GZFD.WMAA 0 0x2D".
+
+        Returns:
+            str: The response from acpi_call, without the echoed command.
+        """
+        with self._lock:
+            self.open()
+            response, elapsed = self._call_locked(command)
+        logging.debug(f"ACPI call ({self.name}) took {elapsed * 1000:.3f} ms")
+        return response
+
+    def call_batch(self, commands):
+        """
+        Runs several ACPI commands back to back while holding the device once.
+
+        Args:
+            commands (list): ACPI method calls.
+
+        Returns:
+            list: (response, elapsed seconds) per command, in order.
+        """
+        with self._lock:
+            self.open()
+            return [self._call_locked(command) for command in commands]
+
+    def _call_locked(self, command):
+        start = time.perf_counter()
+        try:
+            if not self._seekable:
+                os.write(self._fd, command.encode())
+                response = os.read(self._fd, ACPI_CALL_BUFFER_SIZE)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, command.encode())
+                if self._regular_file:
+                    # A plain file stand-in keeps the old tail around, cut it off
+                    os.ftruncate(self._fd, len(command))
+                response = os.pread(self._fd, ACPI_CALL_BUFFER_SIZE, 0)
+        except OSError as e:
+            # Drop the descriptor so the next call reopens the device
+            self.close()
+            raise AcpiCallError(e.errno, f"ACPI call failed: {command}: {e.strerror}") from e
+        elapsed = time.perf_counter() - start
+        self.stats.record(elapsed)
+        return response.decode(errors='replace').strip('\x00').strip(), elapsed
+
+
+class SubprocessTransport:
+    """
+    The original shell pipeline, kept as a fallback and as the benchmark baseline.
+
+    Args:
+        path (str): The acpi_call device node, defaults to ACPI_CALL_PATH.
+        use_sudo (bool): Prefix tee and cat with sudo.
+    """
+
+    name = 'subprocess'
+
+    def __init__(self, path=ACPI_CALL_PATH, use_sudo=True):
+        self.path = path
+        self.use_sudo = use_sudo
+        self.stats = AcpiCallStats()
+        self._lock = threading.Lock()
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def call(self, command):
+        sudo = 'sudo ' if self.use_sudo else ''
+        pipeline = f"echo '{command}' | {sudo}tee {self.path}; {sudo}cat {self.path}"
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                result = subprocess.run(pipeline, shell=True, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except subprocess.CalledProcessError as e:
+                raise AcpiCallError(e.returncode, f"ACPI call failed: {command}: {e.stderr.strip()}") from e
+            elapsed = time.perf_counter() - start
+            self.stats.record(elapsed)
+
+        logging.debug(f"ACPI call ({self.name}) took {elapsed * 1000:.3f} ms")
+        # tee echoes the command on the first line, the response follows
+        output = result.stdout.strip()
+        first_newline_position = output.find('\n')
+        return output[first_newline_position + 1:].strip('\x00').strip() if first_newline_position != -1 else ''
+
+    def call_batch(self, commands):
+        """
+        Runs several ACPI commands in one shell pipeline, one sudo for the whole batch.
+        The firmware time is not visible from here, every command gets an equal share of the total.
+        """
+        sudo = 'sudo ' if self.use_sudo else ''
+        # tee goes to /dev/null so only the responses, one block per command, reach stdout
+        script = '; '.join(f"echo '{command}' | tee {self.path} > /dev/null; cat {self.path}; echo; echo {self._SEPARATOR}"
+                           for command in commands)
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                result = subprocess.run(f"{sudo}sh -c \"{script}\"", shell=True, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except subprocess.CalledProcessError as e:
+                raise AcpiCallError(e.returncode, f"ACPI batch failed: {e.stderr.strip()}") from e
+            elapsed = time.perf_counter() - start
+            for _ in commands:
+                self.stats.record(elapsed / len(commands))
+
+        responses = result.stdout.split(self._SEPARATOR)[:len(commands)]
+        return [(response.strip('\x00').strip(), elapsed / len(commands)) for response in responses]
+
+    _SEPARATOR = '--acpi-call-end--'
+
+
+class BrokerTransport:
+    """
+    Forwards ACPI calls to acpi_broker.py over its Unix socket, one JSON object per line.
+    The connection is kept open and reopened once if the broker went away.
+
+    Args:
+        socket_path (str): The broker socket, defaults to ACPI_BROKER_SOCKET.
+        timeout (float): Seconds to wait for a reply.
+    """
+
+    name = 'broker'
+
+    def __init__(self, socket_path=ACPI_BROKER_SOCKET, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.stats = AcpiCallStats()
+        self._socket = None
+        self._reader = None
+        self._request_id = 0
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._socket = sock
+            self._reader = sock.makefile('rb')
+            logging.debug(f"Connected to ACPI broker: {self.socket_path}")
+        return self
+
+    def close(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            self._socket = None
+            self._reader = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def request(self, op, **params):
+        """
+        Sends one request to the broker and returns its result.
+
+        Args:
+            op (str): The broker operation, see acpi_broker.OPERATIONS.
+            params: The operation parameters.
+
+        Returns:
+            The decoded result of the operation.
+
+        Raises:
+            AcpiCallError: If the broker can not be reached or reports an error.
+        """
+        with self._lock:
+            self._request_id += 1
+            message = dict(params, op=op, id=self._request_id)
+            start = time.perf_counter()
+            for attempt in range(2):
+                try:
+                    self.open()
+                    self._socket.sendall(json.dumps(message).encode() + b'\n')
+                    line = self._reader.readline()
+                    if not line:
+                        raise ConnectionResetError("ACPI broker closed the connection")
+                    break
+                except OSError as e:
+                    self.close()
+                    if attempt:
+                        raise AcpiCallError(e.errno, f"ACPI broker unreachable: {e}") from e
+            elapsed = time.perf_counter() - start
+            self.stats.record(elapsed)
+
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise AcpiCallError(f"ACPI broker error: {reply.get('error')}")
+        logging.debug(f"ACPI call ({self.name}) took {elapsed * 1000:.3f} ms")
+        return reply.get('result')
+
+    def call(self, command):
+        return self.request('call', command=command)
+
+    def call_batch(self, commands):
+        """
+        Runs several ACPI commands in one broker round-trip, the broker reports the time of each call.
+        """
+        return [tuple(item) for item in self.request('batch', commands=list(commands))]
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_transport(path=None):
+    """
+    Returns the process wide transport, opening the device on first use.
+    Prefers the ACPI broker when its socket exists, then the device itself, and falls back
+    to the sudo pipeline when the device can not be opened directly.
+
+    Args:
+        path (str): Override the device path, only used on the first call.
+
+    Returns:
+        BrokerTransport, AcpiCallTransport or SubprocessTransport: The shared transport.
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None and path is None and os.path.exists(ACPI_BROKER_SOCKET):
+            try:
+                _default_transport = BrokerTransport(ACPI_BROKER_SOCKET).open()
+            except OSError as e:
+                logging.warning(f"Can not connect to the ACPI broker at {ACPI_BROKER_SOCKET} ({e}), using the device directly.")
+        if _default_transport is None:
+            path = path or ACPI_CALL_PATH
+            try:
+                _default_transport = AcpiCallTransport(path).open()
+            except OSError as e:
+                logging.warning(f"Can not open {path} directly ({e.strerror}), falling back to sudo tee/cat.")
+                _default_transport = SubprocessTransport(path)
+        return _default_transport
+
+
+def set_transport(transport):
+    """
+    Replaces the process wide transport, i.e. with one pointing at a stand-in device.
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is not None and _default_transport is not transport:
+            _default_transport.close()
+        _default_transport = transport
+
+
+def benchmark(command, iterations=20, path=ACPI_CALL_PATH, use_sudo=True):
+    """
+    Runs the same command through both transports and returns their stats.
+
+    Args:
+        command (str): The ACPI method call to repeat.
+        iterations (int): Number of calls per transport.
+        path (str): The acpi_call device node.
+        use_sudo (bool): Use sudo in the subprocess pipeline.
+
+    Returns:
+        dict: Transport name to AcpiCallStats.
+    """
+    results = {}
+    for transport in (AcpiCallTransport(path), SubprocessTransport(path, use_sudo=use_sudo)):
+        with transport:
+            for _ in range(iterations):
+                transport.call(command)
+        results[transport.name] = transport.stats
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go ACPI call transport')
+    parser.add_argument('command', help='ACPI method call, i.e. "\\_SB.GZFD.WMAA 0 0x2D"')
+    parser.add_argument('--device', default=ACPI_CALL_PATH, help='acpi_call device node, or a stand-in file/FIFO.')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='Run the command N times through both transports and report the latency.')
+    parser.add_argument('--no-sudo', action='store_true', help='Do not use sudo in the subprocess pipeline.')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.benchmark:
+        for name, stats in benchmark(args.command, args.benchmark, args.device, not args.no_sudo).items():
+            print(f"{name:>10}: {stats}")
+    else:
+        with AcpiCallTransport(args.device) as transport:
+            print(transport.call(args.command))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
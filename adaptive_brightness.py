@@ -21,7 +21,9 @@ Modify the following variables to adjust the algorithm:
     - sensor_shift: This value shifts the curve left/right.(This might be better to adjust rather than the sensitivity factor)
 
 
-    Some profiles, which are not implemented yet, but can be used as a reference:
+    Profiles, see brightness_profiles.py. Select one with --profile, or --profile auto to switch by time of day
+    (--profile_switch time) or by ambient light (--profile_switch als). Changes made with the control commands and
+    brightness set by hand are saved per profile and refit its curve. The built in profiles:
     Profile: reading
     Configuration Without Shift: {'sensitivity_factor': 0.8, 'min_brightness_level': 100, 'step': 50}
     Suggested Sensor Shift Range: 0 to 100
@@ -91,6 +93,13 @@ Modify the following variables to adjust the algorithm:
     sudo systemctl reload adaptie-brightness.service  # This will run the resume subcommand
 
 
+    Command socket:
+
+    /tmp/adaptive_brightness.sock: helper_adaptive_brightness.py and brightness_commands.py send commands here,
+    the reply holds the configuration after the commands were applied.
+
+    example: ./brightness_commands.py increase x5   # Raises the minimum brightness by 250 in one go
+
     Sysfs control files:
     
     /tmp/adaptive_brightness_pause.flag: Pause flag file, if this file exists, the service will pause brightness adjustments.
@@ -102,18 +111,9 @@ Modify the following variables to adjust the algorithm:
 """
 # Constant for pause flag file
 PAUSE_FLAG_FILE_PATH = '/tmp/adaptive_brightness_pause.flag'
+# How often the pause flag is checked when inotify is not available
+PAUSE_POLL_INTERVAL = 5
 
-CONTROL_FILE_PATH = '/tmp/adaptive_brightness_control.txt'
-
-def check_for_commands():
-    try:
-        with open(CONTROL_FILE_PATH, 'r') as file:
-            command = file.read().strip()
-        os.remove(CONTROL_FILE_PATH) # Clear the command after reading
-        return command
-    except FileNotFoundError:
-        return None
-    
 # Constants for stability detection\
 
 # This is delta value for the moving average to be considered stable, if the delta is within this value for STABILITY_DURATION amount of time, the cooldown will be increased to reduce constant brightness changes, flickering, etc. This also prevents the brightness from changing too quickly, and applies hysterisis.
@@ -127,46 +127,39 @@ import sys
 import logging
 import time
 from time import sleep
-from math import log
-from threading import Lock
 import argparse
+import selectors
+import signal
+
+import als_reader
+import brightness_commands
+import brightness_curve
+import brightness_profiles
+import brightness_ramp
+import state_cache
+import sysfs_watch
+from sensor_filter import SensorFilter
 
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def calculate_brightness_from_sensor(sensor_value, max_sensor_value=2752, sensitivity_factor=1.0, min_brightness_level=400, max_brightness_level=2752, sensor_shift=0):
-    logging.debug(f"Received sensor value: {sensor_value}, sensitivity_factor: {sensitivity_factor}, min_brightness_level: {min_brightness_level}, max_brightness_level: {max_brightness_level}, sensor_shift: {sensor_shift}")
-
-    # Adjust the sensor value based on the sensor shift
-    adjusted_sensor_value = max(sensor_value - sensor_shift, 0)
-    logging.debug(f"Adjusted sensor value: {adjusted_sensor_value}")
-
-    # If adjusted sensor value is very low, return the minimum brightness level
-    if adjusted_sensor_value <= 0:
-        logging.debug(f"Returning min_brightness_level: {min_brightness_level} due to low adjusted sensor value")
-        return min_brightness_level
-
-    # Calculate the logarithmic scaling
-    log_scale = log(1 + adjusted_sensor_value) / log(1 + max_sensor_value - sensor_shift)
-    
-    # Apply sensitivity factor
-    log_scale *= sensitivity_factor
-
-    # Scale the adjusted value to the range between min_brightness_level and max_brightness_level
-    brightness_range = max_brightness_level - min_brightness_level
-    target_brightness = int(log_scale * brightness_range) + min_brightness_level
-
-    # Ensure the brightness does not exceed the max brightness level and is not below the min brightness level
-    final_brightness = max(min(target_brightness, max_brightness_level), min_brightness_level)
-    logging.debug(f"Calculated target brightness: {final_brightness}")
+    # The curve is precomputed per parameter set, see brightness_curve.py
+    curve = brightness_curve.get_curve(max_sensor_value, sensitivity_factor, min_brightness_level, max_brightness_level, sensor_shift)
+    final_brightness = curve.lookup(sensor_value)
+    logging.debug("Sensor value: %s, sensitivity_factor: %s, min_brightness_level: %s, max_brightness_level: %s, sensor_shift: %s, target brightness: %s",
+                  sensor_value, sensitivity_factor, min_brightness_level, max_brightness_level, sensor_shift, final_brightness)
     return final_brightness
 
 def read_brightness(backlight_device):
     brightness_path = f'/sys/class/backlight/{backlight_device}/brightness'
     try:
         with open(brightness_path, 'r') as file:
-            return int(file.read().strip())
+            brightness = int(file.read().strip())
+        # Keeps the cache honest when the brightness was changed outside this script
+        state_cache.get_cache().update(brightness_path, brightness)
+        return brightness
     except OSError as e:
         logging.error(f"Failed to read brightness: {e}")
         sys.exit(1)
@@ -174,21 +167,36 @@ def read_brightness(backlight_device):
 def write_brightness(backlight_device, brightness, max_backlight_value=4095):
     brightness_path = f'/sys/class/backlight/{backlight_device}/brightness'
     brightness = max(0, min(brightness, max_backlight_value))
+    cache = state_cache.get_cache()
+    if not cache.should_write(brightness_path, brightness):
+        return True
     try:
         with open(brightness_path, 'w') as file:
             file.write(str(brightness))
     except OSError as e:
         logging.error(f"Failed to write brightness: {e}")
         return False
+    cache.record_write(brightness_path, brightness)
     return True
 
 
-def adjust_display_brightness(sensor_reading, backlight_device, max_sensor_value=2752, max_backlight_value=4095, step=10, sensitivity_factor=1.0, min_brightness_level=10, sensor_shift=0):
+def set_ramp_target(ramp, target_brightness, step, max_backlight_value=4095, read_current=None):
+    # Hand the target to the ramp thread, a ramp in flight is retargeted
+    target_brightness = max(0, min(target_brightness, max_backlight_value))
+    ramp.set_rate(brightness_ramp.rate_for_step(step))
+    ramp.set_target(target_brightness, current=None if ramp.ramping or read_current is None else read_current())
+
+
+def adjust_display_brightness(sensor_reading, backlight_device, max_sensor_value=2752, max_backlight_value=4095, step=10, sensitivity_factor=1.0, min_brightness_level=10, sensor_shift=0, ramp=None):
     logging.debug("Adjusting display brightness")
     logging.debug(f"Min brightness: {min_brightness_level}")
     target_brightness = calculate_brightness_from_sensor(sensor_reading, max_sensor_value, sensitivity_factor, min_brightness_level, max_backlight_value, sensor_shift)
     logging.debug(f"Target brightness: {target_brightness}")
 
+    if ramp is not None:
+        set_ramp_target(ramp, target_brightness, step, max_backlight_value, lambda: read_brightness(backlight_device))
+        return
+
     current_brightness = read_brightness(backlight_device)
     logging.debug(f"Current brightness: {current_brightness}")
 
@@ -242,110 +250,413 @@ def locate_backlight_device():
         sys.exit(1)
 
 
-def run_main_loop(backlight_device, sensitivity_factor, num_readings, max_sensor_value, min_brightness_level, pause, stability_threshold=STABILITY_THRESHOLD, stability_duration=STABILITY_DURATION, step=10, sensor_shift=0):
-    lock = Lock()
-    als_device = locate_als_device()
-    sensor_file1 = f'/sys/bus/iio/devices/{als_device}/in_intensity_both_raw'
-    sensor_file2 = f'/sys/bus/iio/devices/{als_device}/in_illuminance_raw'
+# Commands whose result is saved in the active profile
+PROFILE_COMMANDS = ('increase', 'decrease', 'increase_shift', 'decrease_shift', 'increase_sensitivity', 'decrease_sensitivity')
+
 
-    readings = []
+class BrightnessSettings:
+    """
+    The settings the control commands change.
+    """
 
-    last_change_time = time.monotonic()
-    stable_value = None
-    cooldown_period = 1 # Start with 1 second cooldown period
+    def __init__(self, min_brightness_level, sensitivity_factor, sensor_shift, pause=False, step=50, profiles=None):
+        self.min_brightness_level = min_brightness_level
+        self.sensitivity_factor = sensitivity_factor
+        self.sensor_shift = sensor_shift
+        self.pause = pause
+        self.step = step
+        self.profiles = profiles
+        if profiles is not None:
+            self.load_profile(profiles.active)
 
+    def load_profile(self, profile):
+        self.min_brightness_level = profile.min_brightness_level
+        self.sensitivity_factor = profile.sensitivity_factor
+        self.sensor_shift = profile.sensor_shift
+        self.step = profile.step
 
-    while True:
-        if os.path.exists(PAUSE_FLAG_FILE_PATH):
-            logging.info("Brightness adjustment is paused due to flag file at {}".format(PAUSE_FLAG_FILE_PATH))
-            sleep(5)
-        command = check_for_commands()
+    def apply_command(self, command):
         if command == "increase":
-            min_brightness_level += 50
-            logging.info(f"Min brightness level increased to: {min_brightness_level}")
+            self.min_brightness_level += 50
+            logging.info(f"Min brightness level increased to: {self.min_brightness_level}")
         elif command == "decrease":
-            min_brightness_level -= 50
-            logging.info(f"Min brightness level decreased to: {min_brightness_level}")
+            self.min_brightness_level -= 50
+            logging.info(f"Min brightness level decreased to: {self.min_brightness_level}")
+        elif command == "reset" and self.profiles is not None:
+            self.load_profile(self.profiles.reset_active())
+            logging.info(f"Profile '{self.profiles.active.name}' reset to: {self.profiles.active.settings()}")
         elif command == "reset":
-            min_brightness_level = 400
-            sensitivity_factor = 1.0
-            sensor_shift = 0
-            logging.info(f"Min brightness level reset to: {min_brightness_level}")
-            logging.info(f"Sensitivity factor reset to: {sensitivity_factor}")
-            logging.info(f"Sensor shift reset to: {sensor_shift}")
+            self.min_brightness_level = 400
+            self.sensitivity_factor = 1.0
+            self.sensor_shift = 0
+            logging.info(f"Min brightness level reset to: {self.min_brightness_level}")
+            logging.info(f"Sensitivity factor reset to: {self.sensitivity_factor}")
+            logging.info(f"Sensor shift reset to: {self.sensor_shift}")
         elif command == "increase_shift":
-            sensor_shift += 1
-            logging.info(f"Sensor shift increased to: {sensor_shift}")
+            self.sensor_shift += 1
+            logging.info(f"Sensor shift increased to: {self.sensor_shift}")
         elif command == "decrease_shift":
-            sensor_shift -= 1
-            logging.info(f"Sensor shift decreased to: {sensor_shift}")
+            self.sensor_shift -= 1
+            logging.info(f"Sensor shift decreased to: {self.sensor_shift}")
         elif command == "increase_sensitivity":
-            sensitivity_factor += 0.05
-            logging.info(f"Sensitivity factor increased to: {sensitivity_factor}")
+            self.sensitivity_factor += 0.05
+            logging.info(f"Sensitivity factor increased to: {self.sensitivity_factor}")
         elif command == "decrease_sensitivity":
-            sensitivity_factor -= 0.05
-            logging.info(f"Sensitivity factor decreased to: {sensitivity_factor}")
+            self.sensitivity_factor -= 0.05
+            logging.info(f"Sensitivity factor decreased to: {self.sensitivity_factor}")
         elif command == "pause":
-            pause = True
+            self.pause = True
             pause_service()
-            continue
         elif command == "resume":
             resume_service()
-            pause = False
+            self.pause = False
         elif command == "print":
-            print_configuration(sensor_shift, sensitivity_factor, min_brightness_level)
-       
-        if not pause:
-            # Check for commands, increase min_brightness_level or decrease min_brightness_level
+            print_configuration(self.sensor_shift, self.sensitivity_factor, self.min_brightness_level)
+        elif command == "next_profile" and self.profiles is not None:
+            self.load_profile(self.profiles.next_profile())
+        elif command == "auto_profile" and self.profiles is not None:
+            self.load_profile(self.profiles.set_auto())
+        if command in PROFILE_COMMANDS and self.profiles is not None:
+            self.profiles.save_settings(self.min_brightness_level, self.sensitivity_factor, self.sensor_shift)
+
+    def as_dict(self):
+        return {
+            'min_brightness_level': self.min_brightness_level,
+            'sensitivity_factor': round(self.sensitivity_factor, 4),
+            'sensor_shift': self.sensor_shift,
+            'step': self.step,
+            'profile': self.profiles.active.name if self.profiles is not None else None,
+            'auto_profile': self.profiles.auto if self.profiles is not None else False,
+            'paused': self.pause,
+        }
+
+
+class WakeupStats:
+    """
+    Counts main loop wakeups, reported per minute since the previous report.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.wakeups = 0
+        self._since = clock()
+        self._since_wakeups = 0
+
+    def record(self):
+        self.wakeups += 1
+
+    def report(self):
+        now = self.clock()
+        minutes = max(now - self._since, 1e-9) / 60
+        rate = (self.wakeups - self._since_wakeups) / minutes
+        self._since = now
+        self._since_wakeups = self.wakeups
+        return {'wakeups': self.wakeups, 'wakeups_per_minute': round(rate, 2)}
+
+
+class BrightnessService:
+    """
+    The decisions of run_main_loop without the waiting. run_main_loop feeds it what its selector
+    reports, brightness_replay.py feeds it a recorded ALS trace on a virtual clock.
+
+    Args:
+        settings (BrightnessSettings): Curve settings, and the profiles if any.
+        sensor_filter (SensorFilter): Filters and stability detection, on the same clock.
+        ramp (BrightnessRamp): Moves the backlight.
+        read_brightness (callable): Returns the backlight's brightness.
+        read_samples (callable): Returns new ALS readings, used when the ALS is polled.
+        buffered (bool): The ALS pushes its samples through add_samples() (IIO buffer).
+        max_sensor_value (int): Highest ALS reading.
+        max_backlight_value (int): Highest brightness.
+        clock (callable): Monotonic clock in seconds.
+    """
+
+    def __init__(self, settings, sensor_filter, ramp, read_brightness, read_samples=None, buffered=True,
+                 max_sensor_value=2752, max_backlight_value=4095, clock=time.monotonic):
+        self.settings = settings
+        self.sensor_filter = sensor_filter
+        self.ramp = ramp
+        self.read_brightness = read_brightness
+        self.read_samples = read_samples
+        self.buffered = buffered
+        self.max_sensor_value = max_sensor_value
+        self.max_backlight_value = max_backlight_value
+        self.clock = clock
+        self.intensity = None
+        self.pending_samples = []
+        self.next_sample = clock()
+        self._refresh = False
+
+    @property
+    def settled(self):
+        """
+        True when only a new ALS sample can change anything: the filtered value is within the
+        stability threshold of the last reading, so repeating that reading would not move it
+        enough to matter.
+        """
+        sensor_filter = self.sensor_filter
+        return (self.buffered and self.intensity is not None and not self.pending_samples and not self._refresh
+                and abs(sensor_filter.value - self.intensity) <= sensor_filter.stability.threshold)
+
+    @property
+    def waiting_for_samples(self):
+        """
+        True when the cooldown is over, new buffered samples are processed as they arrive.
+        Before that they stay in the IIO buffer and are drained in one read when it ends.
+        """
+        return self.buffered and self.clock() >= self.next_sample
+
+    def timeout(self):
+        """
+        Returns the seconds until tick() has work, None if it has to wait for an event.
+        """
+        wait = self.next_sample - self.clock()
+        if wait > 0:
+            return wait
+        return None if self.settled else 0
+
+    def add_samples(self, readings):
+        self.pending_samples.extend(readings)
+
+    def refresh(self, readings=None):
+        """
+        Processes a sample right away, after new settings or a resume. readings replace the pending ones.
+        """
+        if readings is not None:
+            self.pending_samples = list(readings)
+        self.next_sample = self.clock()
+        self._refresh = True
+
+    def brightness_changed(self, current_brightness):
+        """
+        Handles a backlight change notification. A change while the ramp is idle came from outside
+        (brightness keys): the ramp adopts it, the profile learns it and adjustments hold until the
+        light changes.
+
+        Returns:
+            bool: True if the change was external.
+        """
+        ramp, sensor_filter, profiles = self.ramp, self.sensor_filter, self.settings.profiles
+        # Our own ramp writes notify too
+        if ramp.ramping or current_brightness == ramp.value:
+            return False
+        logging.info(f"Brightness changed externally to {current_brightness}, holding it until the light changes")
+        ramp.set_target(current_brightness, current=current_brightness)
+        if profiles is not None and sensor_filter.value is not None and profiles.record_override(sensor_filter.value, current_brightness):
+            self.settings.load_profile(profiles.active)
+            logging.info(f"Profile '{profiles.active.name}' refit to: {profiles.active.settings()}")
+        sensor_filter.stability.hold(sensor_filter.value)
+        self.next_sample = self.clock() + sensor_filter.cooldown
+        return True
+
+    def tick(self):
+        """
+        Filters the pending samples and moves the brightness if a sample is due.
+
+        Returns:
+            bool: True if a sample was processed.
+        """
+        sensor_filter, settings = self.sensor_filter, self.settings
+        if self.clock() < self.next_sample or self.settled:
+            return False
+        self._refresh = False
+
+        if not self.buffered:
             try:
-                with open(sensor_file1, 'r') as file:
-                    intensity = int(file.read().strip())
-                # with open(sensor_file2, 'r') as file:
-                #     illuminance = int(file.read().strip())
-            except OSError as e:
+                self.pending_samples.extend(self.read_samples())
+            except (OSError, ValueError) as e:
                 logging.error(f"Failed to read sensor data: {e}")
-                continue
+                self.next_sample = self.clock() + sensor_filter.cooldown
+                return False
+        if self.pending_samples:
+            self.intensity = self.pending_samples[-1]
+        elif self.intensity is None:
+            # The buffer has not delivered a first sample yet
+            self.next_sample = self.clock() + sensor_filter.cooldown
+            return False
+
+        # The buffer only has new samples when the light changed, keep the last reading otherwise
+        moving_average, adjust = sensor_filter.update_many(self.pending_samples or [self.intensity])
+        self.pending_samples = []
+        logging.debug(f"Moving average: {moving_average}")
+        profiles = settings.profiles
+        if profiles is not None and profiles.switch_mode == 'als' and profiles.select(moving_average):
+            settings.load_profile(profiles.active)
+            adjust = True
+
+        if adjust:
+            # Change brightness if not in cooldown or within the stability duration
+            target_brightness = calculate_brightness_from_sensor(
+                moving_average, self.max_sensor_value, settings.sensitivity_factor, settings.min_brightness_level,
+                self.max_backlight_value, settings.sensor_shift)
+            set_ramp_target(self.ramp, target_brightness, settings.step, self.max_backlight_value, self.read_brightness)
+        logging.debug(f"Cooldown period: {sensor_filter.cooldown}")
+        self.next_sample = self.clock() + sensor_filter.cooldown
+        return True
+
+
+def exit_on_signal(signum, frame):
+    logging.info(f"Received signal {signum}, exiting")
+    raise SystemExit(0)
+
+def run_main_loop(backlight_device, sensitivity_factor, num_readings, max_sensor_value, min_brightness_level, pause, stability_threshold=STABILITY_THRESHOLD, stability_duration=STABILITY_DURATION, step=10, sensor_shift=0, ema_alpha=None, median_size=0, iio_buffer=True, profile='default', profile_switch='time', profile_store=brightness_profiles.PROFILE_STORE_PATH):
+    """
+    Event loop of the service. One selector waits on the command socket, the ALS buffer, the
+    backlight's change notification and the pause flag, the only timer is the sensor cooldown.
+    The ALS buffer is only watched once the cooldown is over, samples arriving during it are
+    drained when it ends, so a noisy sensor wakes the loop once per cooldown at most. While
+    paused, or while the light is steady and the filter has settled, the loop does not wake up
+    at all.
+
+    The arguments seed the 'default' profile the first time, after that the stored profile wins.
+    """
+    als_device = locate_als_device()
+    # IIO buffer when available, otherwise in_intensity_both_raw kept open, see als_reader.py
+    sensor_reader = als_reader.open_als_reader(als_device, buffered=iio_buffer)
+    # The buffer's device node is readable when samples arrive, sysfs has to be polled
+    buffered = isinstance(sensor_reader, als_reader.IioBufferedReader)
+    sensor_file2 = f'/sys/bus/iio/devices/{als_device}/in_illuminance_raw'
 
-            # average_reading = (intensity + illuminance) // 2
-            average_reading = intensity
-            readings.append(average_reading)
-            readings = readings[-num_readings:]
-
-            moving_average = sum(readings) / len(readings)
-            logging.debug(f"Moving average: {moving_average}")
-            
-            if stable_value is not None:
-                logging.debug(f"Stability delta: {abs(moving_average - stable_value)}")
-            if stable_value is None or abs(moving_average - stable_value) > stability_threshold:
-                stable_value = moving_average
-                last_change_time = time.monotonic()
-                cooldown_period = 1 # Reset cooldown period to 1 second
-                logging.debug(f"Resetting cooldown period: {cooldown_period}")
-            elif (time.monotonic() - last_change_time) >= stability_duration:
-                # If the value has been stable for longer than STABILITY_DURATION, increase cooldown period
-                cooldown_period = min(cooldown_period * 2, 30)  # Maximum cooldown period of 30 seconds
-                logging.debug(f"Increasing cooldown period: {cooldown_period}")
-            if cooldown_period == 1 or time.monotonic() - last_change_time < stability_duration:
-                # Change brightness if not in cooldown or within the stability duration
-                with lock:
-                    adjust_display_brightness(
-                        moving_average, 
-                        backlight_device, 
-                        max_sensor_value=max_sensor_value, 
-                        sensitivity_factor=sensitivity_factor, 
-                        min_brightness_level=min_brightness_level,
-                        step=step,
-                        sensor_shift=sensor_shift)
-            logging.debug(f"Cooldown period: {cooldown_period}")
-            sleep(cooldown_period)
-        else:
-            sleep(5)
+    def read_samples():
+        # with open(sensor_file2, 'r') as file:
+        #     illuminance = int(file.read().strip())
+        # average_reading = (intensity + illuminance) // 2
+        return [value for _, value in sensor_reader.read_samples()]
+
+    # Median (optional) -> moving average or EMA -> stability/cooldown, see sensor_filter.py
+    sensor_filter = SensorFilter(num_readings, stability_threshold, stability_duration, ema_alpha=ema_alpha, median_size=median_size)
+
+    # Brightness changes run on their own thread so a long ramp does not hold up the sensor loop
+    ramp = brightness_ramp.BrightnessRamp(
+        lambda value: write_brightness(backlight_device, value),
+        current=read_brightness(backlight_device),
+        rate=brightness_ramp.rate_for_step(step))
+    ramp.start()
+
+    store = brightness_profiles.ProfileStore(
+        profile_store,
+        brightness_profiles.Profile('default', sensitivity_factor, min_brightness_level, step, sensor_shift)).load()
+    profiles = brightness_profiles.ProfileManager(store, profile, profile_switch, max_sensor_value)
+    settings = BrightnessSettings(min_brightness_level, sensitivity_factor, sensor_shift, pause, step, profiles)
+    logging.info(f"Brightness profile: '{profiles.active.name}' {profiles.active.settings()}")
+    arguments = store.default_arguments()
+    if arguments is not None:
+        # The arguments only seed the profile, say so instead of ignoring them silently
+        logging.info(f"Stored 'default' profile {store.profiles['default'].settings()} is used instead of the "
+                     f"arguments {arguments}, the reset command goes back to the arguments")
+    service = BrightnessService(settings, sensor_filter, ramp, lambda: read_brightness(backlight_device), read_samples,
+                                buffered, max_sensor_value)
+    command_server = brightness_commands.CommandServer().start()
+    wakeup_stats = WakeupStats()
+
+    selector = selectors.DefaultSelector()
+    selector.register(command_server.wake_fileno(), selectors.EVENT_READ, 'commands')
+    # Brightness keys and other tools changing the backlight, see sysfs_watch.py
+    backlight_watch = sysfs_watch.open_sysfs_attribute_watch(f'/sys/class/backlight/{backlight_device}/actual_brightness')
+    if backlight_watch is not None:
+        selector.register(backlight_watch, selectors.EVENT_READ, 'backlight')
+    # Without inotify the pause flag is checked every PAUSE_POLL_INTERVAL seconds
+    pause_watch = sysfs_watch.open_file_watch(PAUSE_FLAG_FILE_PATH)
+    if pause_watch is not None:
+        selector.register(pause_watch, selectors.EVENT_READ, 'pause_flag')
+    flag_paused = os.path.exists(PAUSE_FLAG_FILE_PATH)
+    if flag_paused:
+        logging.info("Brightness adjustment is paused due to flag file at {}".format(PAUSE_FLAG_FILE_PATH))
+    als_registered = False
+    # Set while paused (and at startup): the samples drained next are stale
+    als_stale = True
+    # systemd stops the service with SIGTERM, exit through the finally below so the IIO buffer is turned off
+    signal.signal(signal.SIGTERM, exit_on_signal)
+
+    try:
+        while True:
+            paused = settings.pause or flag_paused
+            als_stale = als_stale or paused
+            als_wanted = buffered and not paused and service.waiting_for_samples
+            if als_wanted and not als_registered:
+                # Drain what queued up during the cooldown, after a pause only the newest
+                # sample still describes the light
+                try:
+                    samples = read_samples()
+                    if als_stale:
+                        service.refresh(samples[-1:])
+                    else:
+                        service.add_samples(samples)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Failed to read sensor data: {e}")
+                als_stale = False
+                selector.register(sensor_reader, selectors.EVENT_READ, 'als')
+            elif als_registered and not als_wanted:
+                selector.unregister(sensor_reader)
+            als_registered = als_wanted
+
+            # Sleep until the next sample is due, or indefinitely when only an event can change anything
+            timeout = None if paused else service.timeout()
+            if pause_watch is None:
+                timeout = PAUSE_POLL_INTERVAL if timeout is None else min(timeout, PAUSE_POLL_INTERVAL)
+            # Time of day profile switches happen on the hour
+            switch_in = profiles.seconds_until_switch()
+            if switch_in is not None:
+                timeout = switch_in if timeout is None else min(timeout, switch_in)
+
+            events = selector.select(timeout)
+            wakeup_stats.record()
+            refresh = False
+
+            for key, _ in events:
+                if key.data == 'commands':
+                    # Applied in the order they were sent
+                    for request in command_server.pending():
+                        for command in request.commands:
+                            settings.apply_command(command)
+                        if 'print' in request.commands:
+                            logging.info(f"Main loop wakeups: {wakeup_stats.wakeups}")
+                        request.set_reply({'ok': True, 'config': settings.as_dict(), 'loop': wakeup_stats.report()})
+                        refresh = True
+                elif key.data == 'als':
+                    try:
+                        service.add_samples(read_samples())
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Failed to read sensor data: {e}")
+                elif key.data == 'backlight':
+                    backlight_watch.consume()
+                    if not ramp.ramping:
+                        service.brightness_changed(read_brightness(backlight_device))
+                elif key.data == 'pause_flag':
+                    if pause_watch.read_events():
+                        flag_paused = pause_watch.exists()
+                        logging.info(f"Pause flag file {PAUSE_FLAG_FILE_PATH} {'created' if flag_paused else 'removed'}")
+
+            if profiles.switch_mode == 'time' and profiles.select():
+                settings.load_profile(profiles.active)
+                refresh = True
+
+            if pause_watch is None and flag_paused != os.path.exists(PAUSE_FLAG_FILE_PATH):
+                flag_paused = not flag_paused
+                logging.info(f"Pause flag file {PAUSE_FLAG_FILE_PATH} {'created' if flag_paused else 'removed'}")
+
+            if settings.pause or flag_paused:
+                continue
+            if refresh or paused:
+                # New settings and resumes take effect right away
+                service.refresh()
+            service.tick()
+    finally:
+        selector.close()
+        command_server.stop()
+        ramp.stop()
+        sensor_reader.close()
+        if backlight_watch is not None:
+            backlight_watch.close()
+        if pause_watch is not None:
+            pause_watch.close()
 
 def print_configuration(sensor_shift, sensitivity_factor, min_brightness_level):
     logging.info("Adaptive Brightness Configuration:")
     logging.info(f"Sensor Shift: {sensor_shift}")
     logging.info(f"Sensitivity Factor: {sensitivity_factor}")
     logging.info(f"Minimum Brightness Level: {min_brightness_level}")
+    logging.info(f"Brightness write cache: {state_cache.get_cache().stats}")
 
 def start_service(args):
     print_configuration(args.sensor_shift, args.sensitivity_factor, args.min_brightness_level)
@@ -357,7 +668,13 @@ def start_service(args):
         min_brightness_level=args.min_brightness_level,
         pause=False,
         step=args.step,
-        sensor_shift=args.sensor_shift
+        sensor_shift=args.sensor_shift,
+        ema_alpha=args.ema_alpha,
+        median_size=args.median_filter,
+        iio_buffer=not args.sysfs_als,
+        profile=args.profile,
+        profile_switch=args.profile_switch,
+        profile_store=args.profile_store
     )
 
 def pause_service():
@@ -395,6 +712,12 @@ if __name__ == "__main__":
     parser_start.add_argument('--backlight_device', type=str, default=backlight_device_default, help='The backlight device to control. (DEV)')
     parser_start.add_argument('--num_readings', type=int, default=10, help='The number of sensor readings to average. (DEV)')
     parser_start.add_argument('--max_sensor_value', type=int, default=2752, help='The maximum sensor value for brightness scaling. (DEV)')
+    parser_start.add_argument('--ema_alpha', type=float, default=None, help='Smooth the sensor with an exponential moving average of this weight instead of averaging num_readings. (DEV)')
+    parser_start.add_argument('--sysfs_als', action='store_true', help='Read the ALS from sysfs even when its IIO buffer is available. (DEV)')
+    parser_start.add_argument('--median_filter', type=int, default=0, help='Median of this many readings before averaging, drops single reading spikes. 0 disables it. (DEV)')
+    parser_start.add_argument('--profile', choices=['auto', 'default'] + list(brightness_profiles.BUILTIN_PROFILES), default='default', help="Brightness profile, 'auto' switches by --profile_switch. The other arguments seed the 'default' profile on first use.")
+    parser_start.add_argument('--profile_switch', choices=['time', 'als'], default='time', help='Switch profiles by time of day or by ambient light when --profile is auto.')
+    parser_start.add_argument('--profile_store', type=str, default=brightness_profiles.PROFILE_STORE_PATH, help='File the profiles and learned brightness are saved in.')
     parser_start.set_defaults(func=start_service)
     if parser_start.parse_known_args()[0].silent:
         logging.disable(logging.CRITICAL)
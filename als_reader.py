@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Ambient light sensor input for adaptive_brightness.
+
+Description:
+    Two ways to read the ALS:
+
+    - IioBufferedReader: enables the intensity channel (and the timestamp, when there is one) in
+      the IIO scan elements, turns on the buffer and reads timestamped samples in bulk from the
+      /dev/iio:deviceN character device. Samples queue up in the kernel between reads, so the
+      loop sees every sample even when it only wakes up once per cooldown.
+    - SysfsReader: keeps in_intensity_both_raw open and re-reads it with pread, one syscall per
+      reading instead of open/read/close plus a Python file object.
+
+    open_als_reader() tries the buffer first (it needs write access to the device's sysfs
+    directory, i.e. root) and falls back to sysfs. Both readers have read_samples(), returning
+    a list of (timestamp in ns or None, value), and fileno() for select/poll.
+
+Usage:
+    ./als_reader.py                  # Reads the real sensor for a few seconds
+    ./als_reader.py --simulate       # Fake IIO directory and FIFO, no sensor needed
+"""
+
+import argparse
+import logging
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+IIO_DEVICES_PATH = '/sys/bus/iio/devices'
+DEV_PATH = '/dev'
+INTENSITY_CHANNEL = 'in_intensity_both'
+TIMESTAMP_CHANNEL = 'in_timestamp'
+BUFFER_LENGTH = 128
+
+# i.e. "le:u32/32>>0", "le:s64/64>>0", "be:s12/16>>4", repeat counts ("X2") are not used by ALS sensors
+_SCAN_TYPE_PATTERN = re.compile(r'^(be|le):(s|u)(\d+)/(\d+)(?:X\d+)?>>(\d+)$')
+
+_STRUCT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+class ScanChannel:
+    """
+    One enabled scan element and where it sits in a scan record.
+    """
+
+    def __init__(self, name, index, scan_type):
+        match = _SCAN_TYPE_PATTERN.match(scan_type.strip())
+        if not match:
+            raise ValueError(f"Unsupported scan type for {name}: {scan_type!r}")
+        endianness, sign, bits, storage_bits, shift = match.groups()
+        self.name = name
+        self.index = index
+        self.big_endian = endianness == 'be'
+        self.signed = sign == 's'
+        self.bits = int(bits)
+        self.storage_bytes = int(storage_bits) // 8
+        self.shift = int(shift)
+        self.offset = 0
+        if self.storage_bytes not in _STRUCT_CODES:
+            raise ValueError(f"Unsupported storage size for {name}: {scan_type!r}")
+
+    def decode(self, raw):
+        value = (raw >> self.shift) & ((1 << self.bits) - 1)
+        if self.signed and value & (1 << (self.bits - 1)):
+            value -= 1 << self.bits
+        return value
+
+
+def read_scan_channels(device_dir, channel_names):
+    """
+    Reads the index and type of scan elements and lays them out like the kernel does:
+    ordered by index, each element aligned to its own size, the record padded to the largest.
+
+    Returns:
+        tuple: (list of ScanChannel, record size in bytes)
+    """
+    channels = []
+    for name in channel_names:
+        scan_dir = os.path.join(device_dir, 'scan_elements')
+        with open(os.path.join(scan_dir, f'{name}_index'), 'r') as file:
+            index = int(file.read())
+        with open(os.path.join(scan_dir, f'{name}_type'), 'r') as file:
+            channels.append(ScanChannel(name, index, file.read()))
+    channels.sort(key=lambda channel: channel.index)
+
+    offset = 0
+    for channel in channels:
+        offset = (offset + channel.storage_bytes - 1) // channel.storage_bytes * channel.storage_bytes
+        channel.offset = offset
+        offset += channel.storage_bytes
+    largest = max(channel.storage_bytes for channel in channels)
+    record_size = (offset + largest - 1) // largest * largest
+    return channels, record_size
+
+
+def _write_sysfs(path, value):
+    with open(path, 'w') as file:
+        file.write(str(value))
+
+
+class SysfsReader:
+    """
+    Reads in_intensity_both_raw through a file descriptor that stays open.
+
+    Args:
+        path (str): The raw intensity file.
+    """
+
+    name = 'sysfs'
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        """
+        Returns the current reading.
+
+        Raises:
+            OSError: If the file could not be read.
+            ValueError: If it did not hold a number.
+        """
+        return int(os.pread(self._fd, 32, 0))
+
+    def read_samples(self):
+        return [(None, self.read())]
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class IioBufferedReader:
+    """
+    Reads timestamped ALS samples from the IIO buffer.
+
+    Args:
+        device_dir (str): The sysfs directory of the IIO device, i.e. /sys/bus/iio/devices/iio:device0.
+        dev_path (str): Its character device, i.e. /dev/iio:device0.
+        buffer_length (int): Samples the kernel keeps between two reads.
+
+    Raises:
+        OSError: If the buffer could not be set up, i.e. without write access to sysfs.
+        ValueError: If the scan elements are missing or have an unsupported type.
+    """
+
+    name = 'iio buffer'
+
+    def __init__(self, device_dir, dev_path, buffer_length=BUFFER_LENGTH):
+        self.device_dir = device_dir
+        self.dev_path = dev_path
+        scan_dir = os.path.join(device_dir, 'scan_elements')
+        if not os.path.exists(os.path.join(scan_dir, f'{INTENSITY_CHANNEL}_en')):
+            raise ValueError(f"{device_dir} has no {INTENSITY_CHANNEL} scan element")
+
+        names = [INTENSITY_CHANNEL]
+        if os.path.exists(os.path.join(scan_dir, f'{TIMESTAMP_CHANNEL}_en')):
+            names.append(TIMESTAMP_CHANNEL)
+        self._fd = None
+        try:
+            _write_sysfs(os.path.join(device_dir, 'buffer', 'enable'), 0)
+            for name in names:
+                _write_sysfs(os.path.join(scan_dir, f'{name}_en'), 1)
+            self.channels, self.record_size = read_scan_channels(device_dir, names)
+            self._intensity = next(channel for channel in self.channels if channel.name == INTENSITY_CHANNEL)
+            self._timestamp = next((channel for channel in self.channels if channel.name == TIMESTAMP_CHANNEL), None)
+            self._set_trigger()
+            _write_sysfs(os.path.join(device_dir, 'buffer', 'length'), buffer_length)
+            _write_sysfs(os.path.join(device_dir, 'buffer', 'enable'), 1)
+            self._fd = os.open(dev_path, os.O_RDONLY | os.O_NONBLOCK)
+        except Exception:
+            # Do not leave the buffer running for nobody, the caller falls back to the sysfs file
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._disable_buffer()
+            raise
+        self._pending = b''
+        self._read_size = self.record_size * buffer_length
+        self._intensity_format = self._format(self._intensity)
+        self._timestamp_format = self._format(self._timestamp) if self._timestamp else None
+
+    @staticmethod
+    def _format(channel):
+        return ('>' if channel.big_endian else '<') + _STRUCT_CODES[channel.storage_bytes]
+
+    def _set_trigger(self):
+        # hid-sensor devices bring their own trigger, named "<name>-dev<N>"
+        trigger_path = os.path.join(self.device_dir, 'trigger', 'current_trigger')
+        if not os.path.exists(trigger_path):
+            return
+        with open(trigger_path, 'r') as file:
+            if file.read().strip():
+                return
+        with open(os.path.join(self.device_dir, 'name'), 'r') as file:
+            name = file.read().strip()
+        device_number = os.path.basename(self.device_dir).replace('iio:device', '')
+        _write_sysfs(trigger_path, f"{name}-dev{device_number}")
+
+    def read_samples(self):
+        """
+        Returns every sample queued since the last call, oldest first, or an empty list.
+        """
+        try:
+            data = os.read(self._fd, self._read_size)
+        except BlockingIOError:
+            return []
+        data = self._pending + data
+        usable = len(data) - len(data) % self.record_size
+        self._pending = data[usable:]
+
+        samples = []
+        intensity, timestamp = self._intensity, self._timestamp
+        for offset in range(0, usable, self.record_size):
+            value = intensity.decode(struct.unpack_from(self._intensity_format, data, offset + intensity.offset)[0])
+            sample_time = timestamp.decode(struct.unpack_from(self._timestamp_format, data, offset + timestamp.offset)[0]) if timestamp else None
+            samples.append((sample_time, value))
+        return samples
+
+    def fileno(self):
+        return self._fd
+
+    def _disable_buffer(self):
+        try:
+            _write_sysfs(os.path.join(self.device_dir, 'buffer', 'enable'), 0)
+        except OSError as e:
+            logging.debug(f"Failed to disable the IIO buffer: {e}")
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._disable_buffer()
+
+
+def open_als_reader(als_device, iio_devices_path=IIO_DEVICES_PATH, dev_path=DEV_PATH, buffered=True):
+    """
+    Opens the IIO buffer of the ALS, or its sysfs file when the buffer is not available.
+
+    Args:
+        als_device (str): The IIO device name, i.e. iio:device0.
+        iio_devices_path (str): Where the IIO devices are in sysfs.
+        dev_path (str): Where their character devices are.
+        buffered (bool): False to go straight to sysfs.
+
+    Returns:
+        IioBufferedReader or SysfsReader
+    """
+    device_dir = os.path.join(iio_devices_path, als_device)
+    if buffered:
+        try:
+            reader = IioBufferedReader(device_dir, os.path.join(dev_path, als_device))
+            logging.info(f"Reading the ALS from the IIO buffer of {als_device}")
+            return reader
+        except (OSError, ValueError) as e:
+            logging.info(f"IIO buffer not available ({e}), reading the ALS from sysfs")
+    return SysfsReader(os.path.join(device_dir, f'{INTENSITY_CHANNEL}_raw'))
+
+
+def create_fake_iio_device(root, als_device='iio:device0', value=100):
+    """
+    Builds a fake IIO sysfs directory and a FIFO as its character device, like an hid-sensor ALS:
+    a 32 bit intensity and a 64 bit timestamp.
+
+    Returns:
+        tuple: (iio_devices_path, dev_path)
+    """
+    iio_devices_path = os.path.join(root, 'sys')
+    dev_path = os.path.join(root, 'dev')
+    device_dir = os.path.join(iio_devices_path, als_device)
+    for directory in ('scan_elements', 'buffer', 'trigger'):
+        os.makedirs(os.path.join(device_dir, directory))
+    os.makedirs(dev_path)
+    files = {
+        'name': 'als',
+        f'{INTENSITY_CHANNEL}_raw': str(value),
+        f'scan_elements/{INTENSITY_CHANNEL}_en': '0',
+        f'scan_elements/{INTENSITY_CHANNEL}_index': '0',
+        f'scan_elements/{INTENSITY_CHANNEL}_type': 'le:u32/32>>0',
+        f'scan_elements/{TIMESTAMP_CHANNEL}_en': '0',
+        f'scan_elements/{TIMESTAMP_CHANNEL}_index': '1',
+        f'scan_elements/{TIMESTAMP_CHANNEL}_type': 'le:s64/64>>0',
+        'buffer/enable': '0',
+        'buffer/length': '0',
+        'trigger/current_trigger': '',
+    }
+    for name, content in files.items():
+        with open(os.path.join(device_dir, name), 'w') as file:
+            file.write(content + '\n')
+    os.mkfifo(os.path.join(dev_path, als_device))
+    return iio_devices_path, dev_path
+
+
+def pack_fake_samples(values, start_ns=0, period_ns=10_000_000):
+    """
+    Packs samples the way create_fake_iio_device() lays them out.
+    """
+    return b''.join(struct.pack('<I4xq', value, start_ns + index * period_ns) for index, value in enumerate(values))
+
+
+def simulate(samples=1000):
+    with tempfile.TemporaryDirectory() as root:
+        iio_devices_path, dev_path = create_fake_iio_device(root)
+        reader = open_als_reader('iio:device0', iio_devices_path, dev_path)
+        fifo = os.open(os.path.join(dev_path, 'iio:device0'), os.O_WRONLY)
+        values = [(index * 37) % 2753 for index in range(samples)]
+
+        writer = threading.Thread(target=lambda: os.write(fifo, pack_fake_samples(values)))
+        writer.start()
+        received = []
+        start = time.perf_counter()
+        reads = 0
+        while len(received) < samples:
+            batch = reader.read_samples()
+            reads += 1
+            received.extend(batch)
+            if not batch:
+                time.sleep(0.001)
+        buffered_time = time.perf_counter() - start
+        writer.join()
+        os.close(fifo)
+        reader.close()
+        assert [value for _, value in received] == values, "Decoded samples do not match"
+        print(f"{reader.name}: {samples} samples in {reads} reads, {buffered_time / samples * 1e6:.2f} us/sample, "
+              f"timestamps {received[0][0]}..{received[-1][0]} ns")
+
+        raw_path = os.path.join(iio_devices_path, 'iio:device0', f'{INTENSITY_CHANNEL}_raw')
+        start = time.perf_counter()
+        for _ in range(samples):
+            with open(raw_path, 'r') as file:
+                int(file.read().strip())
+        open_time = time.perf_counter() - start
+
+        reader = SysfsReader(raw_path)
+        start = time.perf_counter()
+        for _ in range(samples):
+            reader.read()
+        pread_time = time.perf_counter() - start
+        reader.close()
+        print(f"open/read/close: {open_time / samples * 1e6:.2f} us/sample, sysfs pread: {pread_time / samples * 1e6:.2f} us/sample")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ambient light sensor reader')
+    parser.add_argument('--simulate', action='store_true', help='Read from a fake IIO directory and FIFO.')
+    parser.add_argument('--device', help='IIO device, i.e. iio:device0. Defaults to the device named als.')
+    parser.add_argument('--sysfs', action='store_true', help='Skip the IIO buffer.')
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate()
+        return
+
+    als_device = args.device
+    if als_device is None:
+        for device in sorted(os.listdir(IIO_DEVICES_PATH)):
+            try:
+                with open(os.path.join(IIO_DEVICES_PATH, device, 'name'), 'r') as file:
+                    if file.read().strip() == 'als':
+                        als_device = device
+                        break
+            except OSError:
+                continue
+    if als_device is None:
+        logging.error('ALS device not found')
+        return
+
+    reader = open_als_reader(als_device, buffered=not args.sysfs)
+    try:
+        for _ in range(10):
+            print(reader.read_samples())
+            time.sleep(0.5)
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Command channel for adaptive_brightness.
+
+Description:
+    adaptive_brightness listens on a Unix socket instead of polling a control file. A client
+    sends one JSON line with a list of commands, the daemon queues them, wakes its main loop
+    right away through wake_fileno(), applies them in order and replies with the configuration after the last one.
+    Several commands (i.e. "increase x5") go in one round-trip and none are lost.
+
+Protocol:
+    {"commands": ["increase", "increase", "print"]}
+    {"ok": true, "config": {"min_brightness_level": 500, ...}}
+    {"ok": false, "error": "Unknown command: foo"}
+
+Usage:
+    ./brightness_commands.py increase x5         # Sends five "increase" commands
+    ./brightness_commands.py print
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+
+COMMAND_SOCKET_PATH = os.environ.get('ADAPTIVE_BRIGHTNESS_SOCKET', '/tmp/adaptive_brightness.sock')
+
+COMMANDS = (
+    'increase',
+    'decrease',
+    'reset',
+    'increase_shift',
+    'decrease_shift',
+    'increase_sensitivity',
+    'decrease_sensitivity',
+    'pause',
+    'resume',
+    'print',
+    'next_profile',
+    'auto_profile',
+)
+
+# Longest the daemon may take to apply a batch, in seconds
+REPLY_TIMEOUT = 5.0
+
+
+def parse_batch(text):
+    """
+    Turns "increase x5, increase_shift" into a list of commands. A "xN" after a command repeats it.
+
+    Args:
+        text (str or list): The batch, or its words.
+
+    Returns:
+        list: The commands, in order.
+
+    Raises:
+        ValueError: On an unknown command or a misplaced repeat count.
+    """
+    words = text.replace(',', ' ').replace(';', ' ').split() if isinstance(text, str) else text
+    commands = []
+    for word in words:
+        if re.fullmatch(r'[xX]\d+', word):
+            if not commands:
+                raise ValueError(f"{word} must follow a command")
+            commands.extend([commands[-1]] * (int(word[1:]) - 1))
+            continue
+        if word not in COMMANDS:
+            raise ValueError(f"Unknown command: {word}")
+        commands.append(word)
+    return commands
+
+
+class CommandRequest:
+    """
+    A batch of commands waiting for the main loop. The handler thread blocks in wait_reply().
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.reply = None
+        self._done = threading.Event()
+
+    def set_reply(self, reply):
+        self.reply = reply
+        self._done.set()
+
+    def wait_reply(self, timeout=REPLY_TIMEOUT):
+        if not self._done.wait(timeout):
+            return {'ok': False, 'error': 'Timed out waiting for adaptive_brightness'}
+        return self.reply
+
+
+class CommandRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                commands = request.get('commands') if isinstance(request, dict) else None
+                if not isinstance(commands, list):
+                    raise ValueError("Request must be {\"commands\": [...]}")
+                for command in commands:
+                    if command not in COMMANDS:
+                        raise ValueError(f"Unknown command: {command}")
+            except ValueError as e:
+                reply = {'ok': False, 'error': str(e)}
+            else:
+                command_request = CommandRequest(commands)
+                self.server.requests.put(command_request)
+                self.server.notify()
+                reply = command_request.wait_reply()
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts command batches on a Unix socket and queues them for the main loop.
+
+    Args:
+        socket_path (str): Where to create the socket, an existing stale socket is removed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=COMMAND_SOCKET_PATH):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.requests = queue.Queue()
+        # Readable while requests are queued, lets the main loop select on it
+        self._wake_read, self._wake_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        super().__init__(socket_path, CommandRequestHandler)
+        os.chmod(socket_path, 0o600)
+        self._thread = None
+
+    def start(self):
+        """
+        Serves clients on a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='brightness-commands', daemon=True)
+        self._thread.start()
+        return self
+
+    def wake_fileno(self):
+        """
+        Returns a file descriptor that becomes readable when a command batch arrives, for
+        selectors. pending() clears it.
+        """
+        return self._wake_read
+
+    def notify(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass  # Already readable
+
+    def wait(self, timeout):
+        """
+        Sleeps until a command batch arrives or timeout seconds passed.
+
+        Returns:
+            list: The CommandRequests received, empty on timeout.
+        """
+        try:
+            requests = [self.requests.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        return requests + self.pending()
+
+    def pending(self):
+        """
+        Returns the CommandRequests received so far without waiting.
+        """
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        requests = []
+        while True:
+            try:
+                requests.append(self.requests.get_nowait())
+            except queue.Empty:
+                return requests
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def send_commands(commands, socket_path=COMMAND_SOCKET_PATH, timeout=REPLY_TIMEOUT + 1):
+    """
+    Sends a batch of commands to the running daemon.
+
+    Returns:
+        dict: The reply, {"ok": true, "config": {...}} on success.
+
+    Raises:
+        OSError: If adaptive_brightness is not listening.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps({'commands': list(commands)}).encode() + b'\n')
+        with client.makefile('rb') as reply:
+            line = reply.readline()
+    if not line:
+        raise ConnectionError("adaptive_brightness closed the connection")
+    return json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send commands to adaptive_brightness')
+    parser.add_argument('commands', nargs='+', help=f"Commands, optionally repeated with xN. Known commands: {', '.join(COMMANDS)}")
+    parser.add_argument('--socket', default=COMMAND_SOCKET_PATH, help='adaptive_brightness command socket.')
+    args = parser.parse_args()
+
+    try:
+        reply = send_commands(parse_batch(args.commands), args.socket)
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to send commands: {e}")
+        sys.exit(1)
+    print(json.dumps(reply, indent=2))
+    sys.exit(0 if reply.get('ok') else 1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
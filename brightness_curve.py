@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Brightness curve lookup tables for adaptive_brightness.
+
+Description:
+    The ALS reading is an integer in [0, max_sensor_value], so the logarithmic curve of
+    adaptive_brightness is computed once for every reading and stored in an array. A table is
+    built per (max_sensor_value, sensitivity_factor, min_brightness_level, max_brightness_level,
+    sensor_shift) and kept until a control command changes one of them, a lookup is then one
+    index instead of two logarithms.
+
+    map_batch() maps a whole sequence of readings at once, for offline curve fitting and for
+    plotting curves like the PNGs in this repository.
+
+Usage:
+    ./brightness_curve.py --sensor_shift -2 > curve.csv     # sensor,brightness for every reading
+    ./brightness_curve.py --benchmark 100000
+"""
+
+import argparse
+import sys
+import time
+from array import array
+from functools import lru_cache
+from math import log
+
+# Tables kept around, enough for every profile plus a few command steps
+CURVE_CACHE_SIZE = 16
+
+
+def compute_brightness(sensor_value, max_sensor_value=2752, sensitivity_factor=1.0, min_brightness_level=400, max_brightness_level=2752, sensor_shift=0):
+    """
+    Maps a sensor reading to a brightness level on a logarithmic curve.
+
+    Args:
+        sensor_value (float): The ALS reading.
+        max_sensor_value (int): Highest ALS reading, maps to the top of the curve.
+        sensitivity_factor (float): Steepness of the curve.
+        min_brightness_level (int): Brightness for readings at or below sensor_shift.
+        max_brightness_level (int): Highest brightness returned.
+        sensor_shift (int): Shifts the curve right (positive) or left (negative).
+
+    Returns:
+        int: The brightness level.
+    """
+    # Adjust the sensor value based on the sensor shift
+    adjusted_sensor_value = max(sensor_value - sensor_shift, 0)
+
+    # If adjusted sensor value is very low, return the minimum brightness level
+    if adjusted_sensor_value <= 0:
+        return min_brightness_level
+
+    # Calculate the logarithmic scaling and apply the sensitivity factor
+    log_scale = log(1 + adjusted_sensor_value) / log(1 + max_sensor_value - sensor_shift)
+    log_scale *= sensitivity_factor
+
+    # Scale the adjusted value to the range between min_brightness_level and max_brightness_level
+    brightness_range = max_brightness_level - min_brightness_level
+    target_brightness = int(log_scale * brightness_range) + min_brightness_level
+
+    # Ensure the brightness does not exceed the max brightness level and is not below the min brightness level
+    return max(min(target_brightness, max_brightness_level), min_brightness_level)
+
+
+class BrightnessCurve:
+    """
+    Precomputed brightness for every integer sensor reading.
+
+    Args:
+        Same as compute_brightness(), without sensor_value.
+    """
+
+    def __init__(self, max_sensor_value=2752, sensitivity_factor=1.0, min_brightness_level=400, max_brightness_level=2752, sensor_shift=0):
+        self.max_sensor_value = max_sensor_value
+        self.sensitivity_factor = sensitivity_factor
+        self.min_brightness_level = min_brightness_level
+        self.max_brightness_level = max_brightness_level
+        self.sensor_shift = sensor_shift
+        self.table = array('i', (self._compute(value) for value in range(max_sensor_value + 1)))
+
+    def _compute(self, sensor_value):
+        return compute_brightness(sensor_value, self.max_sensor_value, self.sensitivity_factor,
+                                  self.min_brightness_level, self.max_brightness_level, self.sensor_shift)
+
+    def lookup(self, sensor_value):
+        """
+        Returns the brightness for a reading. Fractional readings (i.e. a moving average) are
+        rounded to the nearest integer, readings outside the table are computed.
+        """
+        index = int(sensor_value + 0.5)
+        if 0 <= index <= self.max_sensor_value:
+            return self.table[index]
+        return self._compute(sensor_value)
+
+    def map_batch(self, sensor_values):
+        """
+        Maps a sequence of readings.
+
+        Returns:
+            array: The brightness for each reading, typecode 'i'.
+        """
+        indices = [int(sensor_value + 0.5) for sensor_value in sensor_values]
+        if not indices:
+            return array('i')
+        if 0 <= min(indices) and max(indices) <= self.max_sensor_value:
+            return array('i', map(self.table.__getitem__, indices))
+        return array('i', (self.lookup(sensor_value) for sensor_value in sensor_values))
+
+
+@lru_cache(maxsize=CURVE_CACHE_SIZE)
+def get_curve(max_sensor_value=2752, sensitivity_factor=1.0, min_brightness_level=400, max_brightness_level=2752, sensor_shift=0):
+    """
+    Returns the BrightnessCurve for these parameters, building it on first use.
+    """
+    return BrightnessCurve(max_sensor_value, sensitivity_factor, min_brightness_level, max_brightness_level, sensor_shift)
+
+
+def benchmark(iterations, max_sensor_value=2752):
+    readings = [(index * 7919) % (max_sensor_value + 1) for index in range(iterations)]
+
+    start = time.perf_counter()
+    for reading in readings:
+        compute_brightness(reading, max_sensor_value)
+    compute_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    curve = get_curve(max_sensor_value)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for reading in readings:
+        curve.lookup(reading)
+    lookup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    curve.map_batch(readings)
+    batch_time = time.perf_counter() - start
+
+    print(f"Readings: {iterations}, table build: {build_time * 1000:.2f} ms")
+    print(f"compute_brightness: {compute_time / iterations * 1e6:.3f} us/reading")
+    print(f"lookup:             {lookup_time / iterations * 1e6:.3f} us/reading")
+    print(f"map_batch:          {batch_time / iterations * 1e6:.3f} us/reading")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Brightness curve lookup tables')
+    parser.add_argument('--min_brightness_level', type=int, default=400, help='The minimum brightness level.')
+    parser.add_argument('--max_brightness_level', type=int, default=4095, help='The maximum brightness level.')
+    parser.add_argument('--sensor_shift', type=int, default=-2, help='The sensor shift value.')
+    parser.add_argument('--sensitivity_factor', type=float, default=1.0, help='The sensitivity factor.')
+    parser.add_argument('--max_sensor_value', type=int, default=2752, help='The maximum sensor value.')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='Time N lookups against computing the curve.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.max_sensor_value)
+        return
+
+    curve = get_curve(args.max_sensor_value, args.sensitivity_factor, args.min_brightness_level,
+                      args.max_brightness_level, args.sensor_shift)
+    sys.stdout.write('sensor,brightness\n')
+    sys.stdout.writelines(f"{sensor},{brightness}\n" for sensor, brightness in enumerate(curve.table))
+
+
+if __name__ == "__main__":
+    main()
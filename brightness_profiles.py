@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""
+Brightness profiles for adaptive_brightness.
+
+Description:
+    The profiles listed in the adaptive_brightness docstring (reading, day, evening, movie,
+    night) plus 'default', which starts from the command line arguments. Each profile keeps
+    the curve settings changed with the control commands and the brightness the user picked
+    by hand (brightness keys) per sensor bucket, so both survive a restart.
+
+    Overrides refit the profile's min_brightness_level and sensitivity_factor. For a given
+    sensor_shift the curve is linear in those two, brightness = min + sensitivity * (max - min) * u
+    with u the normalized log of the reading, so the least squares fit only needs five running
+    sums over the buckets. An override updates one bucket and the sums, the history is never
+    reprocessed. The current curve takes part as two low weight points, a single override
+    pulls the curve toward it instead of bending it through one point.
+
+    Profiles switch by time of day (ProfileManager mode 'time') or by the ALS regime ('als',
+    with a margin around the limits so a reading near one does not flip back and forth).
+
+Store:
+    A little endian binary file, loaded in well under a millisecond:
+    header '<4sBB' (b'ABPF', version, profile count), then per profile PROFILE_RECORD and
+    NUM_BUCKETS (preferred brightness, weight) float32 pairs.
+
+Usage:
+    ./brightness_profiles.py --list
+    ./brightness_profiles.py --benchmark 1000      # Load time of the store
+    ./brightness_profiles.py --simulate            # Refits a profile from simulated overrides
+"""
+
+import argparse
+import logging
+import math
+import os
+import struct
+import tempfile
+import time
+from array import array
+
+PROFILE_STORE_PATH = os.environ.get(
+    'ADAPTIVE_BRIGHTNESS_PROFILES',
+    os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'adaptive_brightness', 'profiles.bin'))
+
+STORE_MAGIC = b'ABPF'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<4sBB')
+# name, sensitivity_factor, min_brightness_level, sensor_shift, step, hour start/end, ALS low/high
+PROFILE_RECORD = struct.Struct('<16sdiiibbii')
+
+# Sensor buckets are log spaced, the eye (and the curve) care about ratios of light
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 48
+# A bucket's preferred brightness moves half way to each new override
+OVERRIDE_ALPHA = 0.5
+MAX_BUCKET_WEIGHT = 8.0
+# Weight of the current curve in a refit, as two points at u = 0.25 and 0.75
+PRIOR_WEIGHT = 1.0
+PRIOR_POINTS = (0.25, 0.75)
+SENSITIVITY_LIMITS = (0.05, 3.0)
+# Readings have to leave a regime's range by this fraction before the ALS mode switches away
+ALS_SWITCH_MARGIN = 0.2
+
+MAX_SENSOR_VALUE = 2752
+MAX_BRIGHTNESS_LEVEL = 4095
+
+NO_LIMIT = -1
+
+# name: (sensitivity_factor, min_brightness_level, step, sensor_shift, hours, ALS range)
+# Shifts are the middle of the suggested ranges in the adaptive_brightness docstring
+BUILTIN_PROFILES = {
+    'reading': (0.8, 100, 50, 50, None, None),
+    'day': (1.5, 200, 100, 200, (7, 19), (300, NO_LIMIT)),
+    'evening': (1.2, 50, 50, 150, (19, 23), (30, 300)),
+    'movie': (0.5, 80, 20, 250, None, None),
+    'night': (0.3, 10, 30, 100, (23, 7), (0, 30)),
+}
+
+
+def bucket_for(sensor_value):
+    """
+    Returns the bucket index of a sensor reading.
+    """
+    return min(int(math.log2(1 + max(sensor_value, 0)) * BUCKETS_PER_OCTAVE), NUM_BUCKETS - 1)
+
+
+def bucket_center(bucket):
+    """
+    Returns the sensor reading in the middle of a bucket.
+    """
+    return 2 ** ((bucket + 0.5) / BUCKETS_PER_OCTAVE) - 1
+
+
+def curve_position(sensor_value, sensor_shift, max_sensor_value=MAX_SENSOR_VALUE):
+    """
+    Returns u, the position of a reading on the curve in [0, 1] before the sensitivity_factor,
+    see brightness_curve.compute_brightness().
+    """
+    adjusted = max(sensor_value - sensor_shift, 0)
+    if adjusted <= 0:
+        return 0.0
+    return math.log(1 + adjusted) / math.log(1 + max_sensor_value - sensor_shift)
+
+
+class Profile:
+    """
+    Curve settings and learned overrides.
+
+    Args:
+        name (str): Profile name, at most 16 bytes.
+        sensitivity_factor (float): See adaptive_brightness.
+        min_brightness_level (int): See adaptive_brightness.
+        step (int): See adaptive_brightness.
+        sensor_shift (int): See adaptive_brightness.
+        hours (tuple): (start, end) hours the profile is used in 'time' mode, end may wrap past midnight.
+        als_range (tuple): (low, high) readings the profile is used for in 'als' mode, high may be NO_LIMIT.
+    """
+
+    def __init__(self, name, sensitivity_factor, min_brightness_level, step, sensor_shift, hours=None, als_range=None):
+        self.name = name
+        self.sensitivity_factor = sensitivity_factor
+        self.min_brightness_level = min_brightness_level
+        self.step = step
+        self.sensor_shift = sensor_shift
+        self.hours = hours
+        self.als_range = als_range
+        # (preferred brightness, weight) per bucket
+        self.buckets = array('f', bytes(8 * NUM_BUCKETS))
+        self._sums = None
+        self._sums_shift = None
+
+    @property
+    def overrides(self):
+        """
+        Returns {bucket: (preferred brightness, weight)} for the buckets with an override.
+        """
+        buckets = self.buckets
+        return {index: (buckets[2 * index], buckets[2 * index + 1])
+                for index in range(NUM_BUCKETS) if buckets[2 * index + 1] > 0}
+
+    def settings(self):
+        return {
+            'sensitivity_factor': self.sensitivity_factor,
+            'min_brightness_level': self.min_brightness_level,
+            'step': self.step,
+            'sensor_shift': self.sensor_shift,
+        }
+
+    def clear_overrides(self):
+        self.buckets = array('f', bytes(8 * NUM_BUCKETS))
+        self._sums = None
+
+    def _add_bucket(self, bucket, sign, max_sensor_value, max_brightness_level):
+        brightness, weight = self.buckets[2 * bucket], self.buckets[2 * bucket + 1]
+        # The curve is clipped at the top, a pick at the maximum only says "at least this much"
+        if weight <= 0 or brightness >= max_brightness_level:
+            return
+        u = curve_position(bucket_center(bucket), self.sensor_shift, max_sensor_value)
+        weight *= sign
+        sums = self._sums
+        sums[0] += weight
+        sums[1] += weight * u
+        sums[2] += weight * u * u
+        sums[3] += weight * brightness
+        sums[4] += weight * u * brightness
+
+    def _ensure_sums(self, max_sensor_value, max_brightness_level):
+        # u depends on the shift, a shift command means one pass over the buckets, not the history
+        if self._sums is None or self._sums_shift != self.sensor_shift:
+            self._sums = [0.0] * 5
+            self._sums_shift = self.sensor_shift
+            for bucket in range(NUM_BUCKETS):
+                self._add_bucket(bucket, 1, max_sensor_value, max_brightness_level)
+
+    def record_override(self, sensor_value, brightness, max_sensor_value=MAX_SENSOR_VALUE, max_brightness_level=MAX_BRIGHTNESS_LEVEL):
+        """
+        Stores a brightness the user picked for a reading and refits the curve.
+
+        Returns:
+            bool: True if min_brightness_level or sensitivity_factor changed.
+        """
+        bucket = bucket_for(sensor_value)
+        self._ensure_sums(max_sensor_value, max_brightness_level)
+        self._add_bucket(bucket, -1, max_sensor_value, max_brightness_level)
+        preferred, weight = self.buckets[2 * bucket], self.buckets[2 * bucket + 1]
+        self.buckets[2 * bucket] = brightness if weight <= 0 else preferred + OVERRIDE_ALPHA * (brightness - preferred)
+        self.buckets[2 * bucket + 1] = min(weight + 1, MAX_BUCKET_WEIGHT)
+        self._add_bucket(bucket, 1, max_sensor_value, max_brightness_level)
+        return self.refit(max_brightness_level)
+
+    def refit(self, max_brightness_level=MAX_BRIGHTNESS_LEVEL):
+        """
+        Least squares fit of min_brightness_level and sensitivity_factor to the overrides and
+        the current curve, using the running sums.
+
+        Returns:
+            bool: True if a setting changed.
+        """
+        if self._sums is None:
+            return False
+        s0, s1, s2, t0, t1 = self._sums
+        scale = self.sensitivity_factor * (max_brightness_level - self.min_brightness_level)
+        for u in PRIOR_POINTS:
+            brightness = self.min_brightness_level + scale * u
+            s0 += PRIOR_WEIGHT
+            s1 += PRIOR_WEIGHT * u
+            s2 += PRIOR_WEIGHT * u * u
+            t0 += PRIOR_WEIGHT * brightness
+            t1 += PRIOR_WEIGHT * u * brightness
+        determinant = s0 * s2 - s1 * s1
+        slope = (s0 * t1 - s1 * t0) / determinant
+        intercept = (t0 - slope * s1) / s0
+
+        min_brightness_level = int(round(min(max(intercept, 0), max_brightness_level - 1)))
+        sensitivity_factor = slope / (max_brightness_level - min_brightness_level)
+        sensitivity_factor = round(min(max(sensitivity_factor, SENSITIVITY_LIMITS[0]), SENSITIVITY_LIMITS[1]), 4)
+        changed = (min_brightness_level, sensitivity_factor) != (self.min_brightness_level, self.sensitivity_factor)
+        self.min_brightness_level = min_brightness_level
+        self.sensitivity_factor = sensitivity_factor
+        return changed
+
+    def in_hours(self, hour):
+        if self.hours is None:
+            return False
+        start, end = self.hours
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def in_als_range(self, sensor_value, margin=0.0):
+        if self.als_range is None:
+            return False
+        low, high = self.als_range
+        return low * (1 - margin) <= sensor_value and (high == NO_LIMIT or sensor_value < high * (1 + margin))
+
+
+def builtin_profile(name):
+    sensitivity_factor, min_brightness_level, step, sensor_shift, hours, als_range = BUILTIN_PROFILES[name]
+    return Profile(name, sensitivity_factor, min_brightness_level, step, sensor_shift, hours, als_range)
+
+
+class ProfileStore:
+    """
+    The profiles, in a binary file.
+
+    Args:
+        path (str): The store file.
+        default (Profile): The 'default' profile to use if the store does not have one yet.
+    """
+
+    def __init__(self, path=PROFILE_STORE_PATH, default=None):
+        self.path = path
+        default = default or Profile('default', 1.0, 400, 50, 0)
+        # What 'reset' goes back to for profiles that are not built in
+        self._default_settings = (default.sensitivity_factor, default.min_brightness_level, default.step, default.sensor_shift)
+        self.profiles = {'default': default}
+        for name in BUILTIN_PROFILES:
+            self.profiles[name] = builtin_profile(name)
+
+    def load(self):
+        """
+        Replaces the profiles with the stored ones. A missing or unreadable store keeps the defaults.
+
+        Returns:
+            ProfileStore: self
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return self
+        except OSError as e:
+            logging.error(f"Failed to read brightness profiles from {self.path}: {e}")
+            return self
+        try:
+            self.profiles.update(self._decode(data))
+        except (struct.error, ValueError) as e:
+            logging.error(f"Ignoring corrupt brightness profile store {self.path}: {e}")
+        return self
+
+    def default_arguments(self):
+        """
+        Returns:
+            dict: The settings the 'default' profile was seeded with, if the stored one differs
+            from them, else None.
+        """
+        default = self.profiles['default']
+        if (default.sensitivity_factor, default.min_brightness_level, default.step, default.sensor_shift) == self._default_settings:
+            return None
+        return dict(zip(default.settings(), self._default_settings))
+
+    @staticmethod
+    def _decode(data):
+        magic, version, count = STORE_HEADER.unpack_from(data, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError(f"unknown format {magic!r} version {version}")
+        profiles = {}
+        offset = STORE_HEADER.size
+        bucket_size = 8 * NUM_BUCKETS
+        for _ in range(count):
+            name, sensitivity_factor, min_brightness_level, sensor_shift, step, start, end, low, high = PROFILE_RECORD.unpack_from(data, offset)
+            offset += PROFILE_RECORD.size
+            if offset + bucket_size > len(data):
+                raise ValueError("truncated")
+            name = name.rstrip(b'\0').decode()
+            profile = Profile(name, sensitivity_factor, min_brightness_level, step, sensor_shift,
+                              (start, end) if start >= 0 else None,
+                              (low, high) if low >= 0 else None)
+            profile.buckets = array('f')
+            profile.buckets.frombytes(data[offset:offset + bucket_size])
+            offset += bucket_size
+            profiles[name] = profile
+        return profiles
+
+    def encode(self):
+        parts = [STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(self.profiles))]
+        for profile in self.profiles.values():
+            start, end = profile.hours or (-1, -1)
+            low, high = profile.als_range or (-1, NO_LIMIT)
+            parts.append(PROFILE_RECORD.pack(
+                profile.name.encode()[:16], profile.sensitivity_factor, profile.min_brightness_level,
+                profile.sensor_shift, profile.step, start, end, low, high))
+            parts.append(profile.buckets.tobytes())
+        return b''.join(parts)
+
+    def save(self):
+        """
+        Writes the store, replacing the file atomically.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, 'wb') as file:
+                file.write(self.encode())
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to save brightness profiles to {self.path}: {e}")
+
+    def reset(self, name):
+        """
+        Restores a profile's original settings and drops its overrides.
+        """
+        self.profiles[name] = builtin_profile(name) if name in BUILTIN_PROFILES else Profile(name, *self._default_settings)
+        return self.profiles[name]
+
+
+class ProfileManager:
+    """
+    Picks the active profile and persists changes to it.
+
+    Args:
+        store (ProfileStore): The loaded profiles.
+        profile (str): Profile name, or 'auto' to switch by switch_mode.
+        switch_mode (str): 'time' (hours) or 'als' (ALS ranges).
+        max_sensor_value (int): Used for the refit.
+        max_brightness_level (int): Used for the refit.
+        clock (callable): Wall clock in seconds, for 'time' mode.
+    """
+
+    def __init__(self, store, profile='default', switch_mode='time', max_sensor_value=MAX_SENSOR_VALUE,
+                 max_brightness_level=MAX_BRIGHTNESS_LEVEL, clock=time.time):
+        if profile != 'auto' and profile not in store.profiles:
+            raise ValueError(f"Unknown profile: {profile}")
+        self.store = store
+        self.auto = profile == 'auto'
+        self.switch_mode = switch_mode
+        self.max_sensor_value = max_sensor_value
+        self.max_brightness_level = max_brightness_level
+        self.clock = clock
+        self.active = store.profiles['default' if self.auto else profile]
+        if self.auto and switch_mode == 'time':
+            self.select()
+
+    def select(self, sensor_value=None):
+        """
+        Switches to the profile for the current time or ALS regime when in auto mode.
+
+        Returns:
+            bool: True if the active profile changed.
+        """
+        if not self.auto:
+            return False
+        candidate = None
+        if self.switch_mode == 'time':
+            hour = time.localtime(self.clock()).tm_hour
+            candidate = next((profile for profile in self.store.profiles.values() if profile.in_hours(hour)), None)
+        elif sensor_value is not None:
+            if self.active.in_als_range(sensor_value, ALS_SWITCH_MARGIN):
+                return False
+            candidate = next((profile for profile in self.store.profiles.values() if profile.in_als_range(sensor_value)), None)
+        if candidate is None or candidate is self.active:
+            return False
+        logging.info(f"Switching to brightness profile '{candidate.name}'")
+        self.active = candidate
+        return True
+
+    def seconds_until_switch(self):
+        """
+        Returns the seconds until the next local hour boundary in 'time' auto mode, None otherwise.
+        """
+        if not self.auto or self.switch_mode != 'time':
+            return None
+        now = self.clock()
+        # select() goes by the local hour, and not every time zone is offset by whole hours
+        local = time.localtime(now)
+        return 3600 - (local.tm_min * 60 + local.tm_sec + now % 1) + 1
+
+    def next_profile(self):
+        names = list(self.store.profiles)
+        self.auto = False
+        self.active = self.store.profiles[names[(names.index(self.active.name) + 1) % len(names)]]
+        logging.info(f"Brightness profile set to '{self.active.name}'")
+        return self.active
+
+    def set_auto(self):
+        self.auto = True
+        self.select()
+        logging.info(f"Brightness profiles switch by {self.switch_mode}, active: '{self.active.name}'")
+        return self.active
+
+    def save_settings(self, min_brightness_level, sensitivity_factor, sensor_shift):
+        """
+        Stores settings changed by a control command in the active profile.
+        """
+        profile = self.active
+        if (profile.min_brightness_level, profile.sensitivity_factor, profile.sensor_shift) == (min_brightness_level, sensitivity_factor, sensor_shift):
+            return
+        profile.min_brightness_level = min_brightness_level
+        profile.sensitivity_factor = sensitivity_factor
+        profile.sensor_shift = sensor_shift
+        self.store.save()
+
+    def reset_active(self):
+        self.active = self.store.reset(self.active.name)
+        self.store.save()
+        return self.active
+
+    def record_override(self, sensor_value, brightness):
+        """
+        Learns a brightness picked by hand for the active profile.
+
+        Returns:
+            bool: True if the profile's curve changed.
+        """
+        changed = self.active.record_override(sensor_value, brightness, self.max_sensor_value, self.max_brightness_level)
+        self.store.save()
+        return changed
+
+
+def benchmark(iterations, path):
+    store = ProfileStore(path)
+    for profile in store.profiles.values():
+        for sensor_value in range(0, MAX_SENSOR_VALUE, 97):
+            profile.record_override(sensor_value, 300 + sensor_value)
+    store.save()
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ProfileStore(path).load()
+    load_time = (time.perf_counter() - start) / iterations
+    print(f"Store: {len(store.profiles)} profiles, {size} bytes, load {load_time * 1e6:.1f} us")
+
+    profile = store.profiles['default']
+    start = time.perf_counter()
+    for index in range(iterations):
+        profile.record_override(index % MAX_SENSOR_VALUE, 1000)
+    print(f"Override + refit: {(time.perf_counter() - start) / iterations * 1e6:.1f} us")
+
+
+def simulate():
+    """
+    A user who wants a brighter and steeper curve than the default keeps correcting it by hand.
+    """
+    import brightness_curve
+    preferred = dict(sensitivity_factor=1.3, min_brightness_level=700)
+    profile = Profile('default', 1.0, 400, 50, 0)
+    print(f"Preferred: {preferred}")
+    readings = [5, 40, 900, 120, 2000, 15, 300, 60, 1500, 600]
+    for count, reading in enumerate(readings * 3, 1):
+        brightness = brightness_curve.compute_brightness(reading, MAX_SENSOR_VALUE, max_brightness_level=MAX_BRIGHTNESS_LEVEL, **preferred)
+        current = brightness_curve.compute_brightness(reading, MAX_SENSOR_VALUE, profile.sensitivity_factor, profile.min_brightness_level, MAX_BRIGHTNESS_LEVEL)
+        profile.record_override(reading, brightness)
+        print(f"override {count:2}: reading {reading:4}, curve gave {current:4}, user picked {brightness:4} -> "
+              f"min_brightness_level {profile.min_brightness_level}, sensitivity_factor {profile.sensitivity_factor}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Brightness profiles')
+    parser.add_argument('--store', default=PROFILE_STORE_PATH, help='Profile store file.')
+    parser.add_argument('--list', action='store_true', help='Print the stored profiles.')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='Time N loads of a full store (uses a temporary file).')
+    parser.add_argument('--simulate', action='store_true', help='Refit a profile from simulated overrides.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark(args.benchmark, os.path.join(directory, 'profiles.bin'))
+    elif args.simulate:
+        simulate()
+    elif args.list:
+        for profile in ProfileStore(args.store).load().profiles.values():
+            print(f"{profile.name}: {profile.settings()}, hours: {profile.hours}, ALS: {profile.als_range}, "
+                  f"overrides: {len(profile.overrides)}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Non-blocking brightness ramp for adaptive_brightness.
+
+Description:
+    adjust_display_brightness used to walk to the target in `step` increments with a sleep
+    per step, blocking sensor sampling and command handling for as long as the ramp took.
+    BrightnessRamp runs the ramp on its own thread instead: set_target() returns at once, the
+    thread eases from the current value to the target over a time based on the distance, and
+    a new target retargets the ramp in flight from wherever it is. Writes are capped at
+    max_writes_per_second and values that do not change the backlight are not written.
+
+    The ramp counts its writes and the latency from set_target() to the first write, see RampStats.
+
+Usage:
+    ./brightness_ramp.py --simulate    # Ramps a fake backlight directory, prints writes and latency
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Brightness units per second, adjust_display_brightness moved `step` units every 0.05 s
+DEFAULT_RATE = 1000.0
+MAX_WRITES_PER_SECOND = 30
+MIN_RAMP_DURATION = 0.1
+MAX_RAMP_DURATION = 1.0
+# --simulate fails when the first write after set_target() takes longer, one write period plus
+# scheduling slack
+MAX_SIMULATED_LATENCY = 1 / MAX_WRITES_PER_SECOND + 0.02
+
+
+def ease_out(progress):
+    """
+    Cubic ease-out, progress and result in [0, 1]. Starts fast so the first change is visible
+    right away, slows down into the target.
+    """
+    return 1 - (1 - progress) ** 3
+
+
+def rate_for_step(step):
+    """
+    The ramp speed adjust_display_brightness had for a step size, in units per second.
+    """
+    return step / (0.05 if step > 50 else 0.1)
+
+
+class RampStats:
+    """
+    Ramp counters since the ramp was created.
+    """
+
+    def __init__(self):
+        self.writes = 0
+        self.failed_writes = 0
+        self.targets = 0
+        self.retargets = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+
+    def record_latency(self, latency):
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self):
+        last_latency = f"{self.last_latency * 1000:.1f} ms" if self.last_latency is not None else 'n/a'
+        return (f"writes: {self.writes}, failed writes: {self.failed_writes}, targets: {self.targets}, "
+                f"retargets: {self.retargets}, first change latency: {last_latency} (max {self.max_latency * 1000:.1f} ms)")
+
+
+class BrightnessRamp(threading.Thread):
+    """
+    Eases the backlight toward a target on a background thread.
+
+    Args:
+        write (callable): Writes a brightness value, returns False on failure.
+        current (int): The brightness the backlight has now.
+        rate (float): Ramp speed in brightness units per second, sets the ramp duration.
+        max_writes_per_second (int): Upper bound on writes.
+        min_duration (float): Shortest ramp, in seconds.
+        max_duration (float): Longest ramp, in seconds.
+        clock (callable): Monotonic clock in seconds.
+    """
+
+    def __init__(self, write, current=0, rate=DEFAULT_RATE, max_writes_per_second=MAX_WRITES_PER_SECOND,
+                 min_duration=MIN_RAMP_DURATION, max_duration=MAX_RAMP_DURATION, clock=time.monotonic):
+        super().__init__(name='brightness-ramp', daemon=True)
+        self.write = write
+        self.rate = rate
+        self.min_interval = 1 / max_writes_per_second
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.clock = clock
+        self.stats = RampStats()
+        self.value = current
+        self.target = current
+        self._start_value = current
+        self._start_time = clock()
+        self._duration = 0.0
+        self._requested_at = None
+        self._last_write = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    @property
+    def ramping(self):
+        return self.value != self.target
+
+    def set_target(self, target, current=None):
+        """
+        Starts a ramp to target, or retargets the ramp in flight. Returns at once.
+
+        Args:
+            target (int): The brightness to reach.
+            current (int): The brightness read from the backlight, used when no ramp is running
+                           so changes made outside this script are picked up.
+        """
+        with self._condition:
+            if current is not None and not self.ramping:
+                self.value = current
+            if target == self.target and (self.ramping or target == self.value):
+                return
+            if self.ramping:
+                self.stats.retargets += 1
+            self.stats.targets += 1
+            now = self.clock()
+            self._start_value = self.value
+            self.target = target
+            self._duration = min(max(abs(target - self.value) / self.rate, self.min_duration), self.max_duration)
+            self._start_time = now
+            if self._requested_at is None:
+                self._requested_at = now
+            self._condition.notify()
+
+    def set_rate(self, rate):
+        with self._condition:
+            self.rate = rate
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until the target was reached. Returns False on timeout.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._condition:
+            while self.ramping and not self._stopped:
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _next_value(self, now):
+        progress = min((now - self._start_time) / self._duration, 1.0) if self._duration > 0 else 1.0
+        return round(self._start_value + (self.target - self._start_value) * ease_out(progress))
+
+    def _next_write(self, now):
+        """
+        Returns (value, 0) when a write is due, (None, seconds to wait) otherwise. Called with the lock held.
+        """
+        if self._last_write is not None and now - self._last_write < self.min_interval:
+            # Bounded writes per second, a retarget wakes us up but does not write early
+            return None, self.min_interval - (now - self._last_write)
+        value = self._next_value(now)
+        if value == self.value:
+            # Eased value did not move a full unit yet
+            return None, self.min_interval / 4
+        return value, 0
+
+    def _written(self, value, written, requested_at, now):
+        self._last_write = now
+        if written is False:
+            logging.error(f"Brightness ramp stopped, failed to write {value}")
+            self.stats.failed_writes += 1
+            self.target = self.value
+            self._requested_at = None
+        else:
+            self.value = value
+            self.stats.writes += 1
+            if requested_at is not None and self._requested_at == requested_at:
+                self.stats.record_latency(now - requested_at)
+                self._requested_at = None
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not self.ramping:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                value, wait = self._next_write(self.clock())
+                if value is None:
+                    self._condition.wait(wait)
+                    continue
+                requested_at = self._requested_at
+
+            written = self.write(value)
+
+            with self._condition:
+                self._written(value, written, requested_at, self.clock())
+                self._condition.notify_all()
+
+    def advance(self, now):
+        """
+        Runs the ramp without its thread, for replays on a virtual clock (see brightness_replay.py):
+        does the write due at `now`.
+
+        Returns:
+            float: Seconds until the ramp needs to run again, None once the target was reached.
+        """
+        with self._condition:
+            while self.ramping and not self._stopped:
+                value, wait = self._next_write(now)
+                if value is None:
+                    return wait
+                self._written(value, self.write(value), self._requested_at, now)
+            return None
+
+
+def sysfs_writer(brightness_path):
+    """
+    Returns a write function for a backlight brightness file.
+    """
+    def write(value):
+        try:
+            with open(brightness_path, 'w') as file:
+                file.write(str(value))
+            return True
+        except OSError as e:
+            logging.error(f"Failed to write brightness: {e}")
+            return False
+    return write
+
+
+def simulate():
+    """
+    Ramps a fake backlight directory, checks the result, the write rate and the first change
+    latency, and compares with the old blocking step loop.
+
+    Returns:
+        int: Number of failed checks.
+    """
+    failures = 0
+
+    def check(condition, message):
+        nonlocal failures
+        if not condition:
+            failures += 1
+            print(f"FAILED: {message}")
+
+    with tempfile.TemporaryDirectory() as backlight_dir:
+        brightness_path = os.path.join(backlight_dir, 'brightness')
+        with open(brightness_path, 'w') as file:
+            file.write('400')
+        write = sysfs_writer(brightness_path)
+
+        ramp = BrightnessRamp(write, current=400, rate=rate_for_step(50))
+        ramp.start()
+        start = time.monotonic()
+        ramp.set_target(4000)
+        blocked = time.monotonic() - start
+        time.sleep(0.3)
+        call = time.monotonic()
+        ramp.set_target(1000)  # Retarget in flight
+        blocked = max(blocked, time.monotonic() - call)
+        ramp.wait_idle(5)
+        ramp_time = time.monotonic() - start
+        with open(brightness_path, 'r') as file:
+            final_value = int(file.read())
+        ramp.stop()
+        print(f"Ramp 400 -> 4000, retargeted to 1000 after 0.3 s: final {final_value}, {ramp_time:.2f} s, "
+              f"{ramp.stats.writes / ramp_time:.1f} writes/s")
+        print(f"  {ramp.stats}")
+        print(f"  set_target() blocked the caller for {blocked * 1e6:.0f} us at most")
+        check(final_value == 1000, f"final brightness {final_value}, expected 1000")
+        check(ramp.stats.writes <= MAX_WRITES_PER_SECOND * ramp_time + 1,
+              f"{ramp.stats.writes} writes in {ramp_time:.2f} s, more than {MAX_WRITES_PER_SECOND}/s")
+        check(ramp.stats.retargets == 1, f"{ramp.stats.retargets} retargets, expected 1")
+        check(ramp.stats.max_latency < MAX_SIMULATED_LATENCY,
+              f"first change latency {ramp.stats.max_latency * 1000:.1f} ms, expected under {MAX_SIMULATED_LATENCY * 1000:.0f} ms")
+
+        # The old adjust_display_brightness loop, step 50 with a 0.05 s sleep per step
+        writes = 0
+        value = 400
+        start = time.monotonic()
+        while abs(1000 - value) >= 50:
+            value += 50
+            write(value)
+            writes += 1
+            time.sleep(0.05)
+        print(f"Blocking step loop 400 -> 1000: {writes} writes, blocks the sensor loop for {time.monotonic() - start:.2f} s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Non-blocking brightness ramp')
+    parser.add_argument('--simulate', action='store_true', help='Ramp a fake backlight directory and check the write counts and latency.')
+    args = parser.parse_args()
+    if args.simulate:
+        if simulate():
+            raise SystemExit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
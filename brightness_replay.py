@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Offline replay of adaptive_brightness.
+
+Description:
+    Feeds a recorded ALS trace through the same BrightnessService, SensorFilter and
+    BrightnessRamp that run_main_loop uses, on a virtual clock and with a fake backlight, so
+    changes to the curve, the stability logic or the ramp can be evaluated without a Legion Go.
+    A day of samples replays in seconds.
+
+    Reported per trace and parameter set:
+    - writes/h:   backlight writes per hour
+    - flicker/h:  a visible brightness movement (FLICKER_MIN_CHANGE) reversed less than
+                  FLICKER_WINDOW seconds after it ended, per hour
+    - settle:     mean and max seconds from a light change (the reading doubled or halved) to
+                  the last brightness write of the response
+    - cpu/h:      CPU time spent in the adaptive_brightness logic per hour of trace
+    - wakeups/h:  times the loop had something to do, per hour
+
+    --sweep runs the product of parameter values in parallel, one process per core.
+
+Traces:
+    CSV:     time (seconds), value (raw ALS reading), an optional header line
+    Binary:  IIO buffer records as read from /dev/iio:deviceN by als_reader.py, a u32 intensity
+             and an s64 timestamp in nanoseconds, see als_reader.pack_fake_samples()
+    --record writes a CSV from the real sensor, without a trace a synthetic hour is used.
+
+Usage:
+    ./brightness_replay.py                                  # Synthetic hour with the start defaults
+    ./brightness_replay.py trace.csv --hours 8
+    ./brightness_replay.py --sweep num_readings=5,10,20 --sweep stability_threshold=2,5,10
+    ./brightness_replay.py --record trace.csv --seconds 600
+"""
+
+import argparse
+import bisect
+import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+
+import adaptive_brightness
+import brightness_ramp
+from sensor_filter import SensorFilter
+
+# A brightness reversal within this many seconds of the previous change counts as flicker
+FLICKER_WINDOW = 5.0
+# Smallest movement that counts, in brightness units (2% of 4095)
+FLICKER_MIN_CHANGE = 80
+# A light change is the reading doubling or halving against the last change
+LIGHT_CHANGE_RATIO = 2.0
+# Gaps between writes longer than this end a response when measuring the settling time
+SETTLE_QUIET = 10.0
+SAMPLE_RATE = 10
+
+IIO_RECORD = struct.Struct('<I4xq')
+
+# The adaptive_brightness.py start defaults
+DEFAULT_PARAMETERS = {
+    'sensitivity_factor': 1.0,
+    'min_brightness_level': 400,
+    'sensor_shift': -2,
+    'step': 50,
+    'num_readings': 10,
+    'stability_threshold': adaptive_brightness.STABILITY_THRESHOLD,
+    'stability_duration': adaptive_brightness.STABILITY_DURATION,
+    'ema_alpha': None,
+    'median_size': 0,
+    'buffered': True,
+}
+
+
+class VirtualClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBacklight:
+    """
+    Records the writes with their virtual time.
+    """
+
+    def __init__(self, clock, value):
+        self.clock = clock
+        self.value = value
+        self.writes = []
+
+    def write(self, value):
+        self.value = value
+        self.writes.append((self.clock(), value))
+        return True
+
+
+def read_trace(path):
+    """
+    Reads a CSV or binary IIO trace.
+
+    Returns:
+        tuple: (times in seconds from the start, values)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    try:
+        text = data.decode('ascii')
+    except UnicodeDecodeError:
+        text = None
+
+    times, values = [], []
+    if text is not None and ',' in text:
+        for row in csv.reader(text.splitlines()):
+            try:
+                times.append(float(row[0]))
+                values.append(int(float(row[1])))
+            except (ValueError, IndexError):
+                continue  # Header or blank line
+    else:
+        usable = len(data) - len(data) % IIO_RECORD.size
+        for value, timestamp in IIO_RECORD.iter_unpack(data[:usable]):
+            times.append(timestamp / 1e9)
+            values.append(value)
+    if not times:
+        raise ValueError(f"No samples in {path}")
+    start = times[0]
+    return [t - start for t in times], values
+
+
+def synthetic_trace(hours=1.0, rate=SAMPLE_RATE, seed=1):
+    """
+    An hour of desk use repeated: lamp on and off, a window with passing clouds, a dark room and
+    a hand over the sensor now and then, with 3% noise.
+    """
+    rng = random.Random(seed)
+    # (start second within the hour, level, cloud amplitude)
+    scenes = ((0, 120, 0.0), (600, 420, 0.0), (1200, 1500, 0.3), (2100, 8, 0.0), (2700, 120, 0.0), (3300, 700, 0.1))
+    starts = [scene[0] for scene in scenes]
+    times, values = [], []
+    hand_until = -1.0
+    for index in range(int(hours * 3600 * rate)):
+        t = index / rate
+        _, level, clouds = scenes[bisect.bisect_right(starts, t % 3600) - 1]
+        value = level * (1 + clouds * math.sin(2 * math.pi * t / 90)) * rng.gauss(1, 0.03)
+        if t >= hand_until and rng.random() < 1 / (90 * rate):
+            hand_until = t + 0.5
+        if t < hand_until:
+            value = 5
+        times.append(t)
+        values.append(max(int(value), 0))
+    return times, values
+
+
+def write_trace(path, times, values):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['time', 'value'])
+        writer.writerows((f"{t:.3f}", value) for t, value in zip(times, values))
+
+
+def light_changes(times, values):
+    """
+    Returns the times the reading doubled or halved against the previous change.
+    """
+    changes = []
+    reference = max(values[0], 1)
+    for t, value in zip(times, values):
+        if abs(math.log(max(value, 1) / reference)) >= math.log(LIGHT_CHANGE_RATIO):
+            changes.append(t)
+            reference = max(value, 1)
+    return changes
+
+
+def settling_times(changes, writes, end):
+    """
+    Seconds from each light change to the last write of the response that followed it.
+    """
+    write_times = [t for t, _ in writes]
+    result = []
+    for index, change in enumerate(changes):
+        limit = changes[index + 1] if index + 1 < len(changes) else end
+        position = bisect.bisect_left(write_times, change)
+        last = change
+        while position < len(write_times) and write_times[position] < limit and write_times[position] - last <= SETTLE_QUIET:
+            last = write_times[position]
+            position += 1
+        result.append(last - change)
+    return result
+
+
+def flicker_events(writes):
+    """
+    Counts visible movements reversed within FLICKER_WINDOW seconds.
+    """
+    events = 0
+    run_start = run_end = None
+    run_direction = 0
+    run_time = None
+    for t, value in writes:
+        if run_end is not None and value != run_end:
+            direction = 1 if value > run_end else -1
+            if direction != run_direction:
+                if run_direction and abs(run_end - run_start) >= FLICKER_MIN_CHANGE and t - run_time < FLICKER_WINDOW:
+                    events += 1
+                run_start, run_direction = run_end, direction
+        elif run_end is None:
+            run_start = value
+        run_end, run_time = value, t
+    return events
+
+
+def replay(times, values, max_sensor_value=2752, initial_brightness=None, **parameters):
+    """
+    Runs a trace through the adaptive_brightness logic.
+
+    Args:
+        times (list): Sample times in seconds.
+        values (list): ALS readings.
+        max_sensor_value (int): See adaptive_brightness.
+        initial_brightness (int): Backlight at the start, the minimum brightness by default.
+        parameters: Any of DEFAULT_PARAMETERS.
+
+    Returns:
+        dict: The metrics.
+    """
+    params = dict(DEFAULT_PARAMETERS, **parameters)
+    clock = VirtualClock(times[0])
+    backlight = FakeBacklight(clock, params['min_brightness_level'] if initial_brightness is None else initial_brightness)
+    ramp = brightness_ramp.BrightnessRamp(backlight.write, current=backlight.value,
+                                          rate=brightness_ramp.rate_for_step(params['step']), clock=clock)
+    settings = adaptive_brightness.BrightnessSettings(params['min_brightness_level'], params['sensitivity_factor'],
+                                                      params['sensor_shift'], step=params['step'])
+    sensor_filter = SensorFilter(params['num_readings'], params['stability_threshold'], params['stability_duration'],
+                                 ema_alpha=params['ema_alpha'], median_size=params['median_size'], clock=clock)
+
+    def read_samples():
+        # Polled ALS: the reading at the current time
+        return [values[max(bisect.bisect_right(times, clock.now) - 1, 0)]]
+
+    buffered = params['buffered']
+    service = adaptive_brightness.BrightnessService(settings, sensor_filter, ramp, lambda: backlight.value, read_samples,
+                                                    buffered, max_sensor_value, clock=clock)
+    index = 0
+    ramp_at = None
+    wakeups = 0
+    cpu_time = 0.0
+    end = times[-1]
+    while True:
+        deadlines = []
+        timeout = service.timeout()
+        if timeout is not None:
+            deadlines.append(clock.now + timeout)
+        if ramp_at is not None:
+            deadlines.append(ramp_at)
+        # Like run_main_loop, buffered samples only wake the loop once the cooldown is over,
+        # the ones arriving before are drained at its end
+        if service.waiting_for_samples and index < len(times):
+            deadlines.append(times[index])
+        if not deadlines:
+            break
+        now = min(deadlines)
+        if now > end:
+            break
+        clock.now = now
+        wakeups += 1
+
+        start = time.process_time()
+        if service.waiting_for_samples and index < len(times) and times[index] <= now:
+            first = index
+            while index < len(times) and times[index] <= now:
+                index += 1
+            service.add_samples(values[first:index])
+        service.tick()
+        ramp_wait = ramp.advance(now)
+        cpu_time += time.process_time() - start
+        # A wait shorter than the clock's float resolution would not move it forward
+        ramp_at = None if ramp_wait is None else now + max(ramp_wait, 1e-6)
+
+    hours = max(end - times[0], 1e-9) / 3600
+    settle = settling_times(light_changes(times, values), backlight.writes, end)
+    return {
+        'writes/h': len(backlight.writes) / hours,
+        'flicker/h': flicker_events(backlight.writes) / hours,
+        'settle mean s': sum(settle) / len(settle) if settle else 0.0,
+        'settle max s': max(settle, default=0.0),
+        'cpu ms/h': cpu_time * 1000 / hours,
+        'wakeups/h': wakeups / hours,
+    }
+
+
+_trace = None
+
+
+def _load_trace(path, hours):
+    global _trace
+    _trace = read_trace(path) if path else synthetic_trace(hours)
+
+
+def _replay_job(parameters):
+    return parameters, replay(*_trace, **parameters)
+
+
+def parse_sweep(specs):
+    """
+    Turns ["num_readings=5,10", "ema_alpha=none,0.2"] into the list of parameter dicts to run.
+    """
+    axes = []
+    for spec in specs:
+        name, _, text = spec.partition('=')
+        if name not in DEFAULT_PARAMETERS:
+            raise ValueError(f"Unknown parameter: {name}, known: {', '.join(DEFAULT_PARAMETERS)}")
+        default = DEFAULT_PARAMETERS[name]
+        options = []
+        for item in text.split(','):
+            if item.lower() == 'none':
+                options.append(None)
+            elif isinstance(default, bool):
+                options.append(item.lower() in ('1', 'true', 'yes'))
+            elif isinstance(default, int):
+                options.append(int(item))
+            else:
+                options.append(float(item))
+        axes.append([(name, option) for option in options])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def record(path, seconds):
+    """
+    Records the real ALS to a CSV trace.
+    """
+    import als_reader
+    reader = als_reader.open_als_reader(adaptive_brightness.locate_als_device())
+    start = time.monotonic()
+    samples = 0
+    try:
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['time', 'value'])
+            while time.monotonic() - start < seconds:
+                now = time.monotonic() - start
+                for timestamp, value in reader.read_samples():
+                    writer.writerow([f"{now if timestamp is None else timestamp / 1e9:.3f}", value])
+                    samples += 1
+                time.sleep(1 / SAMPLE_RATE)
+    finally:
+        reader.close()
+    logging.info(f"Recorded {samples} samples to {path}")
+
+
+def print_results(results, as_csv):
+    names = sorted({name for parameters, _ in results for name in parameters})
+    metrics = list(results[0][1])
+    if as_csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(names + metrics)
+        for parameters, result in results:
+            writer.writerow([parameters.get(name) for name in names] + [f"{result[metric]:.3f}" for metric in metrics])
+        return
+    header = [f"{name:>20}" for name in names] + [f"{metric:>14}" for metric in metrics]
+    print(' '.join(header))
+    for parameters, result in results:
+        print(' '.join([f"{str(parameters.get(name)):>20}" for name in names] + [f"{result[metric]:>14.2f}" for metric in metrics]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline replay of adaptive_brightness')
+    parser.add_argument('trace', nargs='?', help='CSV (time,value) or binary IIO buffer trace. A synthetic trace if omitted.')
+    parser.add_argument('--hours', type=float, default=1.0, help='Length of the synthetic trace.')
+    parser.add_argument('--sweep', action='append', default=[], metavar='NAME=V1,V2', help=f"Parameter values to sweep, repeatable. Parameters: {', '.join(DEFAULT_PARAMETERS)}")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='Fixed parameter value, repeatable.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes for sweeps.')
+    parser.add_argument('--csv', action='store_true', help='Print the results as CSV.')
+    parser.add_argument('--write_trace', metavar='PATH', help='Save the synthetic trace as CSV and exit.')
+    parser.add_argument('--record', metavar='PATH', help='Record the real ALS to a CSV trace and exit.')
+    parser.add_argument('--seconds', type=float, default=600, help='Recording length.')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.seconds)
+        return
+    if args.write_trace:
+        write_trace(args.write_trace, *synthetic_trace(args.hours))
+        return
+
+    try:
+        fixed = parse_sweep(args.set)[0] if args.set else {}
+        jobs = [dict(fixed, **parameters) for parameters in parse_sweep(args.sweep)] if args.sweep else [fixed]
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    if len(jobs) == 1:
+        _load_trace(args.trace, args.hours)
+        results = [_replay_job(jobs[0])]
+    else:
+        with multiprocessing.Pool(min(args.processes, len(jobs)), initializer=_load_trace, initargs=(args.trace, args.hours)) as pool:
+            results = pool.map(_replay_job, jobs)
+    print_results(results, args.csv)
+    logging.info(f"{len(jobs)} replay(s) in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    # adaptive_brightness configures DEBUG logging on import, the replay only wants problems
+    logging.getLogger().setLevel(logging.WARNING)
+    main()
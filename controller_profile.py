@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Declarative controller profiles for legion_configurator.
+
+Description:
+    A TOML or JSON file describes the whole controller setup: RGB, gyro remaps, button and FPS
+    remaps, deadzones, curves, vibration, sleep time and the touchpad. It is compiled once into
+    the 64 byte reports, one per setting slot (i.e. the left deadzone), and compared with the
+    reports applied last time, so only the slots that changed are sent. The applied reports are
+    kept per controller in PROFILE_STATE_PATH.
+
+    A setting removed from the profile is left as it is on the controller, the firmware has no
+    "back to default" report. --force sends every report, i.e. after the controllers were reset.
+
+Profile:
+    touchpad = true
+    touchpad_vibration = true
+    legion_button_swap = false
+
+    [[gyro_remap]]
+    gyro = 1                    # 1: left controller gyro, 2: right
+    joystick = 1                # 0: disabled, 1: left stick, 2: right stick
+
+    [left]
+    deadzone = 4
+    curve = [85, 85, 5, 30]     # tx, ty, bx, by
+    vibration = 2               # 0: off, 1: weak, 2: medium, 3: strong
+    sleep_time = 10             # minutes
+    rgb = { mode = 1, color = "FF0000", brightness = 100, speed = 50, profile = 1 }  # or { on = false }
+    buttons = { Y1 = "A", M2 = "left_trigger" }
+    fps_remap = [{ profile = 1, button = "Y1", action = "B" }]
+
+    [right]
+    ...
+
+    See controller_profile_example.toml. Codes can be given as numbers instead of names.
+
+Usage:
+    ./legion_configurator.py --profile my_profile.toml
+    ./controller_profile.py my_profile.toml --benchmark     # Full vs diffed apply on a fake backend
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import legion_configurator
+from hid_reports import ACTIONS, BUTTONS
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None  # Python < 3.11, JSON profiles only
+
+PROFILE_STATE_PATH = os.environ.get(
+    'LEGION_PROFILE_STATE',
+    os.path.join(os.environ.get('XDG_STATE_HOME', os.path.expanduser('~/.local/state')), 'legion_configurator', 'applied_profile.json'))
+
+CONTROLLERS = {'left': 0x03, 'right': 0x04}
+
+CONTROLLER_SETTINGS = ('deadzone', 'curve', 'vibration', 'sleep_time', 'rgb', 'buttons', 'fps_remap')
+TOP_LEVEL_SETTINGS = ('touchpad', 'touchpad_vibration', 'legion_button_swap', 'gyro_remap') + tuple(CONTROLLERS)
+
+
+def load_profile(path):
+    """
+    Reads a TOML or JSON profile.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if path.endswith('.json'):
+        return json.loads(data)
+    if tomllib is None:
+        raise ValueError("TOML profiles need Python 3.11, use JSON")
+    return tomllib.loads(data.decode())
+
+
+def _byte(value, name, limit=0xFF):
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= limit:
+        raise ValueError(f"{name} must be an integer from 0 to {limit}, got {value!r}")
+    return value
+
+
+def _code(value, codes, name):
+    if isinstance(value, str):
+        if value not in codes:
+            raise ValueError(f"Unknown {name} {value!r}, known: {', '.join(codes)}")
+        return codes[value]
+    return _byte(value, name)
+
+
+def _check_keys(table, known, where):
+    unknown = set(table) - set(known)
+    if unknown:
+        raise ValueError(f"Unknown setting(s) in {where}: {', '.join(sorted(unknown))}")
+
+
+def compile_profile(profile):
+    """
+    Turns a profile into reports.
+
+    Returns:
+        dict: {slot: 64 byte report}, slots like 'left.deadzone' or 'right.button.Y1', in send order.
+
+    Raises:
+        ValueError: On an unknown setting or a value out of range.
+    """
+    _check_keys(profile, TOP_LEVEL_SETTINGS, 'the profile')
+    reports = {}
+    if 'touchpad' in profile:
+        reports['touchpad'] = legion_configurator.create_touchpad_command(bool(profile['touchpad']))
+    if 'touchpad_vibration' in profile:
+        reports['touchpad_vibration'] = legion_configurator.create_touchpad_vibration_command(bool(profile['touchpad_vibration']))
+    if 'legion_button_swap' in profile:
+        reports['legion_button_swap'] = legion_configurator.create_legion_button_swap_command(bool(profile['legion_button_swap']))
+    for remap in profile.get('gyro_remap', []):
+        gyro = _byte(remap.get('gyro'), 'gyro_remap.gyro', 2)
+        reports[f"gyro_remap.{gyro}"] = legion_configurator.create_gyro_remap_command(gyro, _byte(remap.get('joystick'), 'gyro_remap.joystick', 2))
+
+    for side, controller in CONTROLLERS.items():
+        settings = profile.get(side)
+        if settings is None:
+            continue
+        _check_keys(settings, CONTROLLER_SETTINGS, f"[{side}]")
+        if 'rgb' in settings:
+            rgb = settings['rgb']
+            if rgb.get('on', True):
+                color = bytes.fromhex(rgb.get('color', 'FFFFFF'))
+                if len(color) != 3:
+                    raise ValueError(f"{side}.rgb.color must be RRGGBB")
+                reports[f"{side}.rgb"] = legion_configurator.create_rgb_control_command(
+                    controller, _byte(rgb.get('mode', 1), 'rgb.mode'), color,
+                    _byte(rgb.get('brightness', 100), 'rgb.brightness', 0x64),
+                    _byte(rgb.get('speed', 50), 'rgb.speed', 0x64), _byte(rgb.get('profile', 1), 'rgb.profile'))
+            else:
+                reports[f"{side}.rgb"] = legion_configurator.create_rgb_on_off_command(controller, False)
+        if 'deadzone' in settings:
+            reports[f"{side}.deadzone"] = legion_configurator.create_deadzone_command(controller, _byte(settings['deadzone'], 'deadzone', 0x63))
+        if 'curve' in settings:
+            points = settings['curve']
+            if len(points) != 4:
+                raise ValueError(f"{side}.curve must be [tx, ty, bx, by]")
+            reports[f"{side}.curve"] = legion_configurator.create_sensitivity_command(controller, *(_byte(point, 'curve', 100) for point in points))
+        if 'vibration' in settings:
+            reports[f"{side}.vibration"] = legion_configurator.create_vibration_command(controller, _byte(settings['vibration'], 'vibration', 3))
+        if 'sleep_time' in settings:
+            reports[f"{side}.sleep_time"] = legion_configurator.create_sleep_time_command(controller, _byte(settings['sleep_time'], 'sleep_time'))
+        for button, action in settings.get('buttons', {}).items():
+            code = _code(button, BUTTONS, 'button')
+            reports[f"{side}.button.{code:#04x}"] = legion_configurator.create_button_remap_command(controller, code, _code(action, ACTIONS, 'action'))
+        for remap in settings.get('fps_remap', []):
+            profile_number = _byte(remap.get('profile'), 'fps_remap.profile', 4)
+            code = _code(remap.get('button'), BUTTONS, 'button')
+            reports[f"{side}.fps.{profile_number}.{code:#04x}"] = legion_configurator.create_fps_remap_command(
+                controller, profile_number, code, _code(remap.get('action'), ACTIONS, 'action'))
+    return reports
+
+
+def diff_reports(reports, applied):
+    """
+    Returns the reports whose slot is new or holds different bytes than the applied ones.
+    """
+    return {slot: report for slot, report in reports.items() if applied.get(slot) != report}
+
+
+def device_key(info):
+    """
+    Identifies the controllers the state belongs to.
+    """
+    serial = info.get('serial_number') if info else None
+    return serial or 'default'
+
+
+def load_applied(key, path=PROFILE_STATE_PATH):
+    try:
+        with open(path, 'r') as file:
+            state = json.load(file)
+        return {slot: bytes.fromhex(report) for slot, report in state.get(key, {}).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable profile state {path}: {e}")
+        return {}
+
+
+def save_applied(key, applied, path=PROFILE_STATE_PATH):
+    try:
+        with open(path, 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        state = {}
+    state[key] = {slot: report.hex() for slot, report in applied.items()}
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f"{path}.tmp", 'w') as file:
+            json.dump(state, file, indent=1)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.error(f"Failed to save the applied profile to {path}: {e}")
+
+
+class ApplyResult:
+    """
+    What an apply compiled and sent.
+    """
+
+    def __init__(self, compiled, sent, compile_time, send_time):
+        self.compiled = compiled
+        self.sent = sent
+        self.compile_time = compile_time
+        self.send_time = send_time
+
+    def __str__(self):
+        return (f"{self.compiled} report(s) compiled in {self.compile_time * 1000:.2f} ms, "
+                f"{self.sent} sent in {self.send_time * 1000:.2f} ms")
+
+
+def apply_profile(profile, controller=None, force=False, state_path=PROFILE_STATE_PATH):
+    """
+    Compiles a profile and sends the reports that changed since the last apply.
+
+    Args:
+        profile (dict or str): The profile, or the path of a profile file.
+        controller (LegionController): The session, the shared one by default.
+        force (bool): Send every report.
+        state_path (str): Where the applied reports are kept.
+
+    Returns:
+        ApplyResult: Counts and timings.
+
+    Raises:
+        ValueError: On an invalid profile.
+        OSError: If the controllers can not be reached.
+    """
+    controller = controller or legion_configurator.get_controller()
+    if isinstance(profile, str):
+        profile = load_profile(profile)
+    start = time.perf_counter()
+    reports = compile_profile(profile)
+    compile_time = time.perf_counter() - start
+
+    key = device_key(controller.find())
+    applied = load_applied(key, state_path)
+    changed = reports if force else diff_reports(reports, applied)
+
+    start = time.perf_counter()
+    if changed:
+        controller.send_many(list(changed.values()))
+    send_time = time.perf_counter() - start
+
+    applied.update(changed)
+    save_applied(key, applied, state_path)
+    return ApplyResult(len(reports), len(changed), compile_time, send_time)
+
+
+def benchmark(profile_path, latency):
+    """
+    Applies the profile twice to a fake backend: first everything, then again with one
+    setting changed, to compare the full and the diffed apply.
+    """
+    import tempfile
+    import fake_hid
+    profile = load_profile(profile_path)
+    with tempfile.TemporaryDirectory() as directory:
+        state_path = os.path.join(directory, 'state.json')
+        controller = legion_configurator.LegionController(fake_hid.FakeHidBackend(latency=latency))
+        print(f"Full apply:   {apply_profile(profile, controller, state_path=state_path)}")
+        print(f"Same again:   {apply_profile(profile, controller, state_path=state_path)}")
+        side = next((side for side in CONTROLLERS if side in profile), None)
+        if side is not None:
+            profile[side]['deadzone'] = (profile[side].get('deadzone', 4) + 1) % 0x63
+            print(f"One change:   {apply_profile(profile, controller, state_path=state_path)}")
+        print(f"Session: {controller.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply a declarative controller profile')
+    parser.add_argument('profile', help='TOML or JSON profile.')
+    parser.add_argument('--force', action='store_true', help='Send every report, not just the changed ones.')
+    parser.add_argument('--fake', action='store_true', help='Apply to a fake HID backend.')
+    parser.add_argument('--benchmark', action='store_true', help='Compare full and diffed applies on a fake backend.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Fake backend seconds per report for --benchmark.')
+    args = parser.parse_args()
+
+    try:
+        if args.benchmark:
+            benchmark(args.profile, args.latency)
+            return
+        if args.fake:
+            import fake_hid
+            legion_configurator.get_controller(fake_hid.FakeHidBackend())
+        print(apply_profile(args.profile, force=args.force))
+    except (ValueError, OSError) as e:
+        logging.error(f"Failed to apply {args.profile}: {e}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
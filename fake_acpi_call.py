@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Fake /proc/acpi/call backend for the Legion Go.
+
+Description:
+    Emulates the GZFD WMI methods the scripts use, so the transport, the broker and the
+    controllers can run without hardware. State lives in a dictionary keyed by the names in
+    wmi_codec.FEATURES, responses are formatted the way acpi_call prints them.
+
+    FakeAcpiCall has the same call()/stats interface as the transports in acpi_transport,
+    pass it to acpi_transport.set_transport() or run the broker with --fake.
+"""
+
+import struct
+import threading
+import time
+
+import acpi_transport
+import wmi_codec
+
+# Defaults taken from the wmi_interface.md tables, plugged in
+DEFAULT_STATE = {
+    'flip_to_start': 0,
+    'slow_tdp': 15,
+    'steady_tdp': 15,
+    'fast_tdp': 20,
+    'max_steady_tdp': 30,
+    'boot_on_ac': 0,
+    'boot_on_pd': 0,
+    'full_fan_speed': 0,
+    'fan_speed': 0x0FB6,
+    'crts_temperature': 45,
+    'amts_temperature': 40,
+    'cpu_temperature': 50,
+    'gpu_temperature': 0,
+    'chts_temperature': 45,
+    'ctts_temperature': 45,
+    'smart_fan_mode': 2,
+    'thermal_table_id': 0,
+    'fan_table': [44, 48, 55, 60, 71, 79, 87, 87, 100, 100],
+    'lighting': {wmi_codec.LIGHTING_POWER_BUTTON: (1, 0)},
+}
+
+_FEATURES_BY_ID = {feature.id: name for name, feature in wmi_codec.FEATURES.items()}
+
+
+def format_response(value):
+    """
+    Formats a value the way acpi_call prints it.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return wmi_codec.format_buffer(value)
+    return f"{value:#x}"
+
+
+class FakeAcpiCall:
+    """
+    In-memory stand-in for /proc/acpi/call.
+
+    Args:
+        state (dict): Initial state, merged over DEFAULT_STATE.
+        latency (float): Seconds to sleep per call, to mimic the firmware.
+    """
+
+    name = 'fake'
+
+    def __init__(self, state=None, latency=0.0):
+        self.state = {key: (list(value) if isinstance(value, list) else dict(value) if isinstance(value, dict) else value)
+                      for key, value in DEFAULT_STATE.items()}
+        if state:
+            self.state.update(state)
+        self.latency = latency
+        self.stats = acpi_transport.AcpiCallStats()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def call(self, command):
+        with self._lock:
+            start = time.perf_counter()
+            self.calls.append(command)
+            if self.latency:
+                time.sleep(self.latency)
+            try:
+                response = self._dispatch(*wmi_codec.parse_call(command))
+            except wmi_codec.WmiDecodeError:
+                response = 'Error: AE_NOT_FOUND'
+            self.stats.record(time.perf_counter() - start)
+            return response
+
+    def call_batch(self, commands):
+        results = []
+        for command in commands:
+            start = time.perf_counter()
+            response = self.call(command)
+            results.append((response, time.perf_counter() - start))
+        return results
+
+    def _dispatch(self, method, method_id, arg):
+        if method == 'WMAE' and method_id == wmi_codec.WMAE_GET_FEATURE:
+            name = _FEATURES_BY_ID.get(self._feature_id(arg))
+            return format_response(self.state.get(name, 0))
+        if method == 'WMAE' and method_id == wmi_codec.WMAE_SET_FEATURE:
+            if isinstance(arg, (bytes, bytearray)):
+                feature_id, value = struct.unpack('<II', bytes(arg[:8]).ljust(8, b'\x00'))
+            else:
+                feature_id, value = arg & 0xFFFFFFFF, arg >> 32
+            name = _FEATURES_BY_ID.get(feature_id)
+            if name:
+                self.state[name] = value
+            return '0'
+        if method == 'WMAA':
+            return self._gamezone(method_id, arg)
+        if method == 'WMAB' and method_id == wmi_codec.WMAB_GET_FAN_TABLE:
+            speeds = self.state['fan_table']
+            temperatures = wmi_codec.FAN_TABLE_TEMPERATURES
+            return format_response(struct.pack(f'<I{len(speeds)}II{len(temperatures)}I',
+                                               len(speeds), *speeds, len(temperatures), *temperatures))
+        if method == 'WMAB' and method_id == wmi_codec.WMAB_SET_FAN_TABLE:
+            count = struct.unpack_from('<I', arg, 2)[0]
+            self.state['fan_table'] = list(struct.unpack_from(f'<{count}H', arg, 6))
+            return '0'
+        if method == 'WMAF' and method_id == wmi_codec.WMAF_GET_LIGHTING:
+            return format_response(bytes(self.state['lighting'].get(arg, (0, 0))))
+        if method == 'WMAF' and method_id == wmi_codec.WMAF_SET_LIGHTING:
+            self.state['lighting'][arg[0]] = (arg[1], arg[2])
+            return '0'
+        return '0'
+
+    def _gamezone(self, method_id, arg):
+        if method_id == wmi_codec.WMAA_SET_SMART_FAN_MODE:
+            self.state['smart_fan_mode'] = arg
+            return '0'
+        if method_id == wmi_codec.WMAA_GET_SMART_FAN_MODE:
+            return format_response(self.state['smart_fan_mode'])
+        if method_id == wmi_codec.WMAA_GET_SMART_FAN_SETTING_MODE:
+            return '0x1'
+        if method_id == wmi_codec.WMAA_SET_THERMAL_TABLE_ID:
+            self.state['thermal_table_id'] = arg
+            return '0'
+        if method_id == wmi_codec.WMAA_GET_THERMAL_TABLE_ID:
+            return format_response(self.state['thermal_table_id'])
+        if method_id == wmi_codec.WMAA_GET_CPU_TEMPERATURE:
+            return format_response(self.state['cpu_temperature'])
+        return '0'
+
+    @staticmethod
+    def _feature_id(arg):
+        if isinstance(arg, (bytes, bytearray)):
+            return int.from_bytes(bytes(arg[:4]), 'little')
+        return arg or 0
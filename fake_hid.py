@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Fake HID backend for the Legion Go controllers.
+
+Description:
+    Stands in for hidapi so legion_configurator can run without hardware. It enumerates a
+    keyboard and the Legion controller interfaces (only one has the 0xFFA0 usage page), records
+    every 64 byte report written, and answers each report with an echo of its first four bytes,
+    response_latency seconds after the write. read() waits for it up to its timeout like hidapi.
+
+    unplug() detaches the controllers like pulling them off the device: the open handle fails,
+    enumeration does not list them. replug() brings them back under a new hidraw path.
+    unplug_after=N does the unplug after the Nth report, and the next enumeration replugs.
+
+    FakeHidBackend has the same enumerate()/open() interface as legion_configurator.HidapiBackend.
+"""
+
+import threading
+import time
+
+VENDOR_ID = 0x17EF
+PRODUCT_ID = 0x6182
+CONFIG_USAGE_PAGE = 0xFFA0
+REPORT_SIZE = 64
+
+
+class FakeHidDevice:
+    """
+    An open handle, fails once the controllers were unplugged.
+    """
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.closed = False
+
+    def _check(self):
+        if self.closed or not self.backend.plugged or self.path != self.backend.path:
+            raise OSError(f"{self.path.decode()}: No such device")
+
+    def write(self, data):
+        with self.backend._lock:
+            self._check()
+            if len(data) != REPORT_SIZE:
+                raise ValueError(f"Reports are {REPORT_SIZE} bytes, got {len(data)}")
+            if self.backend.latency:
+                time.sleep(self.backend.latency)
+            self.backend.reports.append(bytes(data))
+            self.backend.responses.append((time.monotonic() + self.backend.response_latency,
+                                           bytes(data[:4]) + bytes(REPORT_SIZE - 4)))
+            self.backend._response_ready.notify_all()
+            if self.backend.unplug_after is not None and len(self.backend.reports) == self.backend.unplug_after:
+                self.backend.unplug()
+            return len(data)
+
+    def read(self, size, timeout=None):
+        """
+        Returns the next response, b'' if none is ready within timeout milliseconds (None blocks).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        with self.backend._lock:
+            while True:
+                self._check()
+                now = time.monotonic()
+                responses = self.backend.responses
+                if responses and responses[0][0] <= now:
+                    return responses.pop(0)[1][:size]
+                if deadline is not None and now >= deadline:
+                    return b''
+                wait = responses[0][0] - now if responses else None
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.backend._response_ready.wait(wait)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeHidBackend:
+    """
+    In-memory HID bus with the Legion Go controllers on it.
+
+    Args:
+        latency (float): Seconds per report written, to mimic the USB round-trip.
+        unplug_after (int): Unplug the controllers after this many reports.
+        response_latency (float): Seconds until the response of a report can be read.
+    """
+
+    name = 'fake'
+
+    def __init__(self, latency=0.0, unplug_after=None, response_latency=0.0):
+        self.latency = latency
+        self.response_latency = response_latency
+        self.unplug_after = unplug_after
+        self.reports = []
+        self.responses = []
+        self.enumerations = 0
+        self.opens = 0
+        self.plugged = True
+        self._generation = 0
+        self._lock = threading.RLock()
+        self._response_ready = threading.Condition(self._lock)
+
+    @property
+    def path(self):
+        return f"/dev/hidraw{2 + self._generation * 3}".encode()
+
+    def enumerate(self, vendor_id=0):
+        with self._lock:
+            self.enumerations += 1
+            if not self.plugged and self.unplug_after is not None:
+                self.replug()
+            devices = [{'path': b'/dev/hidraw0', 'vendor_id': 0x048D, 'product_id': 0xC101, 'usage_page': 0x0001,
+                        'product_string': 'ITE Keyboard'}]
+            if self.plugged:
+                base = 1 + self._generation * 3
+                for offset, usage_page in enumerate((0x0001, CONFIG_USAGE_PAGE, 0x000C)):
+                    devices.append({'path': f"/dev/hidraw{base + offset}".encode(), 'vendor_id': VENDOR_ID,
+                                    'product_id': PRODUCT_ID, 'usage_page': usage_page,
+                                    'product_string': 'Legion Controller for Windows'})
+            return [device for device in devices if not vendor_id or device['vendor_id'] == vendor_id]
+
+    def open(self, path):
+        with self._lock:
+            if not self.plugged or path != self.path:
+                raise OSError(f"{path.decode()}: No such device")
+            self.opens += 1
+            return FakeHidDevice(self, path)
+
+    def unplug(self):
+        with self._lock:
+            self.plugged = False
+            self.responses.clear()
+            self._response_ready.notify_all()
+            self.unplug_after = None if self.unplug_after is None else -1
+
+    def replug(self):
+        with self._lock:
+            self.plugged = True
+            self._generation += 1
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Fan controller engine for legion_fan_helper.
+
+Description:
+    Reads the acpitz temperature from its sysfs node, resolved once at startup and kept open,
+    instead of walking every hwmon device through psutil.sensors_temperatures() each poll.
+
+    The sampling period adapts to the temperature: it drops to min_period while the temperature
+    climbs toward temp_high (or moves above temp_low) and doubles while it is stable, up to
+    max_period below temp_low and BAND_MAX_PERIOD above it, so the helper reacts quickly to
+    spikes and barely wakes up when idle or holding a steady load.
+
+    Two controllers are available: HysteresisController toggles full fan speed between two
+    thresholds, CurveController holds a target temperature by shifting the fan table with a PI
+    controller and rate limits the writes. fan_simulator.py compares them on temperature and
+    load traces.
+
+    The loop takes its clock and sleep function as arguments, simulate() drives it with a
+    virtual clock against a thermal trace and reports idle wakeups per minute and the reaction
+    latency to a temperature step, next to the old fixed 5 second poll.
+
+Usage:
+    ./fan_controller.py --simulate
+    ./fan_controller.py --simulate --temp_high 85 --temp_low 80 --duration 1800
+"""
+
+import argparse
+import glob
+import logging
+import math
+import os
+import time
+
+HWMON_ROOT = '/sys/class/hwmon'
+THERMAL_ROOT = '/sys/class/thermal'
+
+# Sampling period bounds, in seconds
+MIN_PERIOD = 0.5
+MAX_PERIOD = 20.0
+# Longest period inside the hysteresis band, where the controllers are still acting
+BAND_MAX_PERIOD = 4.0
+# Temperature change rates, in °C per second
+RISING_RATE = 0.2
+STABLE_RATE = 0.05
+
+# Fan table the firmware ships with, in %, for wmi_codec.FAN_TABLE_TEMPERATURES
+DEFAULT_FAN_TABLE = (44, 48, 55, 60, 71, 79, 87, 87, 100, 100)
+
+# Curve controller defaults
+CURVE_KP = 8.0              # % per °C above the target
+CURVE_KI = 0.3              # % per °C·s above the target
+CURVE_BOOST_LIMITS = (-30, 60)  # Offset applied to the fan table, in %
+CURVE_BOOST_STEP = 5        # Offsets are rounded to this, in %
+MIN_WRITE_INTERVAL = 10.0   # Seconds between two fan table writes
+
+
+def find_temperature_path(sensor_name='acpitz', hwmon_root=HWMON_ROOT, thermal_root=THERMAL_ROOT):
+    """
+    Finds the sysfs file holding the temperature of a sensor, in millidegrees.
+    Looks at the hwmon devices first (where psutil finds acpitz), then at the thermal zones.
+
+    Returns:
+        str: The path, or None if the sensor was not found.
+    """
+    for name_path in sorted(glob.glob(os.path.join(hwmon_root, 'hwmon*', 'name'))):
+        try:
+            with open(name_path, 'r') as file:
+                if file.read().strip() == sensor_name:
+                    path = os.path.join(os.path.dirname(name_path), 'temp1_input')
+                    if os.path.exists(path):
+                        return path
+        except OSError:
+            continue
+    for type_path in sorted(glob.glob(os.path.join(thermal_root, 'thermal_zone*', 'type'))):
+        try:
+            with open(type_path, 'r') as file:
+                if file.read().strip() == sensor_name:
+                    return os.path.join(os.path.dirname(type_path), 'temp')
+        except OSError:
+            continue
+    return None
+
+
+class SysfsTemperatureSensor:
+    """
+    Keeps a sysfs temperature file open and re-reads it with pread.
+
+    Args:
+        path (str): The temperature file, in millidegrees Celsius.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        """
+        Returns the temperature in °C, or None if it could not be read.
+        """
+        try:
+            return int(os.pread(self._fd, 16, 0)) / 1000
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to read temperature from {self.path}: {e}")
+            return None
+
+    def close(self):
+        os.close(self._fd)
+
+
+class AdaptiveSampler:
+    """
+    Picks the time until the next temperature sample.
+
+    Args:
+        temp_high (int): Temperature that enables full fan speed.
+        temp_low (int): Temperature that disables full fan speed.
+        min_period (float): Shortest period, used near or above the thresholds.
+        max_period (float): Longest period, reached while the temperature is stable.
+        band_max_period (float): Longest period while stable above temp_low.
+    """
+
+    def __init__(self, temp_high, temp_low, min_period=MIN_PERIOD, max_period=MAX_PERIOD, band_max_period=BAND_MAX_PERIOD):
+        self.temp_high = temp_high
+        self.temp_low = temp_low
+        self.min_period = min_period
+        self.max_period = max_period
+        self.band_max_period = min(max(band_max_period, min_period), max_period)
+        self.period = min_period
+        self._last_temp = None
+        self._last_time = None
+
+    def next_period(self, temp, now):
+        rate = 0.0
+        if self._last_time is not None and now > self._last_time:
+            rate = (temp - self._last_temp) / (now - self._last_time)
+        self._last_temp = temp
+        self._last_time = now
+
+        if rate >= RISING_RATE or (temp >= self.temp_low and abs(rate) >= STABLE_RATE):
+            # Heating up fast, or moving inside the hysteresis band, sample as fast as allowed
+            self.period = self.min_period
+        elif temp >= self.temp_low:
+            # Holding inside the band, back off but stay close enough to catch a change
+            self.period = min(self.period * 2, self.band_max_period)
+        elif rate > STABLE_RATE:
+            # Climbing slowly, sample at least twice before it can reach temp_high
+            self.period = min(max((self.temp_high - temp) / rate / 2, self.min_period), self.max_period)
+        else:
+            # Stable or cooling down, back off
+            self.period = min(self.period * 2, self.max_period)
+        return self.period
+
+
+class FixedSampler:
+    """
+    The old behaviour, one sample every period seconds.
+    """
+
+    def __init__(self, period=5.0):
+        self.period = period
+        self.min_period = period
+
+    def next_period(self, temp, now):
+        return self.period
+
+
+class HysteresisController:
+    """
+    Enables full fan speed at temp_high and goes back to the fan curve at temp_low.
+
+    Args:
+        temp_high (int): Temperature to enable full fan speed.
+        temp_low (int): Temperature to disable full fan speed.
+        apply (callable): Called with True/False when the state changes.
+    """
+
+    def __init__(self, temp_high, temp_low, apply):
+        self.temp_high = temp_high
+        self.temp_low = temp_low
+        self.apply = apply
+        self.full_speed_enabled = False
+        self.writes = 0
+
+    def update(self, temp, now):
+        if temp >= self.temp_high and not self.full_speed_enabled:
+            logging.info("High temperature detected. Enabling full fan speed.")
+            self.apply(True)
+            self.full_speed_enabled = True
+            self.writes += 1
+        elif temp <= self.temp_low and self.full_speed_enabled:
+            logging.info("Temperature back to normal. Disabling full fan speed.")
+            self.apply(False)
+            self.full_speed_enabled = False
+            self.writes += 1
+
+
+class CurveController:
+    """
+    Keeps the temperature at a target by shifting the whole fan table up or down.
+
+    A PI controller turns the distance to the target into an offset that is added to every point
+    of base_table. The offset is rounded to CURVE_BOOST_STEP and a new table is only written when
+    the rounded offset changes and MIN_WRITE_INTERVAL passed since the last write, so the firmware
+    sees a few writes per minute at most. Above full_speed_temp the full speed toggle is used,
+    without waiting, and released once the temperature is back at the target.
+
+    Args:
+        base_table (list): The fan table to shift, in %.
+        target (float): Temperature to hold, in °C.
+        apply_table (callable): Writes a fan table, returns None or False on failure.
+        apply_full_speed (callable): Called with True/False to toggle full speed, None to never use it.
+        full_speed_temp (float): Temperature that enables full speed.
+        kp (float): Proportional gain, in % per °C.
+        ki (float): Integral gain, in % per °C·s.
+        boost_limits (tuple): Lowest and highest offset, in %.
+        min_write_interval (float): Seconds between two fan table writes.
+    """
+
+    def __init__(self, base_table, target, apply_table, apply_full_speed=None, full_speed_temp=None,
+                 kp=CURVE_KP, ki=CURVE_KI, boost_limits=CURVE_BOOST_LIMITS, min_write_interval=MIN_WRITE_INTERVAL):
+        self.base_table = list(base_table)
+        self.target = target
+        self.apply_table = apply_table
+        self.apply_full_speed = apply_full_speed
+        self.full_speed_temp = full_speed_temp
+        self.kp = kp
+        self.ki = ki
+        self.boost_limits = boost_limits
+        self.min_write_interval = min_write_interval
+        self.integral = 0.0
+        self.boost = 0
+        self.table = list(base_table)
+        self.full_speed_enabled = False
+        self.writes = 0
+        self._last_time = None
+        self._last_write = None
+
+    def table_for(self, boost):
+        return [min(max(speed + boost, 0), 100) for speed in self.base_table]
+
+    def update(self, temp, now):
+        dt = now - self._last_time if self._last_time is not None else 0.0
+        self._last_time = now
+        error = temp - self.target
+
+        low, high = self.boost_limits
+        proportional = self.kp * error
+        integral = self.integral + error * dt
+        # Anti windup, only integrate while the output is not saturated
+        if low <= proportional + self.ki * integral <= high:
+            self.integral = integral
+        boost = min(max(proportional + self.ki * self.integral, low), high)
+        boost = int(round(boost / CURVE_BOOST_STEP)) * CURVE_BOOST_STEP
+
+        if self.apply_full_speed and self.full_speed_temp is not None:
+            if temp >= self.full_speed_temp and not self.full_speed_enabled:
+                logging.info("Temperature above the fan curve range. Enabling full fan speed.")
+                self.apply_full_speed(True)
+                self.full_speed_enabled = True
+                self.writes += 1
+            elif temp <= self.target and self.full_speed_enabled:
+                logging.info("Temperature back at the target. Disabling full fan speed.")
+                self.apply_full_speed(False)
+                self.full_speed_enabled = False
+                self.writes += 1
+
+        if boost == self.boost:
+            return
+        if self._last_write is not None and now - self._last_write < self.min_write_interval:
+            return
+        table = self.table_for(boost)
+        self._last_write = now
+        if table == self.table:
+            self.boost = boost
+            return
+        logging.info(f"Fan curve offset {self.boost:+d}% -> {boost:+d}% at {temp}°C")
+        result = self.apply_table(table)
+        self.writes += 1
+        if result is not None and result is not False:
+            self.boost = boost
+            self.table = table
+
+
+class FanControlLoop:
+    """
+    Samples the temperature, feeds the controller and sleeps for the period the sampler picks.
+
+    Args:
+        read_temperature (callable): Returns the temperature in °C or None.
+        controller: Object with update(temp, now).
+        sampler: Object with next_period(temp, now).
+        clock (callable): Monotonic clock in seconds.
+        sleep (callable): Sleeps for the given number of seconds.
+        on_sample (callable): Optional, called with (temp, now) after every sample.
+    """
+
+    def __init__(self, read_temperature, controller, sampler, clock=time.monotonic, sleep=time.sleep, on_sample=None):
+        self.read_temperature = read_temperature
+        self.controller = controller
+        self.sampler = sampler
+        self.clock = clock
+        self.sleep = sleep
+        self.on_sample = on_sample
+        self.wakeups = 0
+        self.start_time = clock()
+
+    def step(self):
+        """
+        Takes one sample and returns the time to sleep until the next one.
+        """
+        now = self.clock()
+        self.wakeups += 1
+        temp = self.read_temperature()
+        if temp is None:
+            logging.error("Could not read CPU temperature")
+            return self.sampler.min_period
+        self.controller.update(temp, now)
+        period = self.sampler.next_period(temp, now)
+        if self.on_sample:
+            self.on_sample(temp, now)
+        return period
+
+    def run(self):
+        while True:
+            self.sleep(self.step())
+
+    @property
+    def wakeups_per_minute(self):
+        elapsed = self.clock() - self.start_time
+        return self.wakeups / elapsed * 60 if elapsed > 0 else 0.0
+
+
+def thermal_step_trace(idle_temp=55.0, load_temp=95.0, step_time=600.0, step_duration=300.0, tau=30.0):
+    """
+    First order thermal model: the temperature settles at idle_temp, heats toward load_temp
+    from step_time for step_duration seconds, then cools back down.
+
+    Returns:
+        callable: Temperature in °C for a time in seconds.
+    """
+    def trace(t):
+        if t < step_time:
+            return idle_temp
+        end_time = step_time + step_duration
+        peak = idle_temp + (load_temp - idle_temp) * (1 - math.exp(-(min(t, end_time) - step_time) / tau))
+        if t < end_time:
+            return peak
+        return idle_temp + (peak - idle_temp) * math.exp(-(t - end_time) / tau)
+    return trace
+
+
+def first_crossing(trace, threshold, duration, resolution=0.01):
+    """
+    Returns the first time the trace reaches threshold, or None.
+    """
+    t = 0.0
+    while t <= duration:
+        if trace(t) >= threshold:
+            return t
+        t += resolution
+    return None
+
+
+def simulate(trace, sampler, temp_high, temp_low, duration=1800.0, idle_until=None):
+    """
+    Runs the control loop against a thermal trace with a virtual clock.
+
+    Args:
+        trace (callable): Temperature in °C for a time in seconds.
+        sampler: The sampler to evaluate.
+        temp_high (int): Temperature to enable full fan speed.
+        temp_low (int): Temperature to disable full fan speed.
+        duration (float): Simulated seconds.
+        idle_until (float): End of the idle part of the trace, defaults to the first temp_high crossing.
+
+    Returns:
+        dict: wakeups, wakeups_per_minute, idle_wakeups_per_minute (before idle_until), reaction_latency
+        (seconds from the trace reaching temp_high to full speed, None if never) and writes.
+    """
+    virtual_time = [0.0]
+    full_speed_times = []
+
+    def apply(enable):
+        if enable:
+            full_speed_times.append(virtual_time[0])
+
+    def sleep(seconds):
+        virtual_time[0] += seconds
+
+    controller = HysteresisController(temp_high, temp_low, apply)
+    loop = FanControlLoop(lambda: trace(virtual_time[0]), controller, sampler, clock=lambda: virtual_time[0], sleep=sleep)
+    crossing = first_crossing(trace, temp_high, duration)
+    if idle_until is None:
+        idle_until = crossing if crossing is not None else duration
+    idle_wakeups = None
+    while virtual_time[0] < duration:
+        if idle_wakeups is None and virtual_time[0] >= idle_until:
+            idle_wakeups = loop.wakeups
+        sleep(loop.step())
+
+    reaction_latency = None
+    if crossing is not None:
+        reacted = [t for t in full_speed_times if t >= crossing]
+        reaction_latency = reacted[0] - crossing if reacted else None
+    return {
+        'wakeups': loop.wakeups,
+        'wakeups_per_minute': loop.wakeups / duration * 60,
+        'idle_wakeups_per_minute': (idle_wakeups if idle_wakeups is not None else loop.wakeups) / idle_until * 60,
+        'reaction_latency': reaction_latency,
+        'writes': controller.writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go fan controller engine')
+    parser.add_argument('--simulate', action='store_true', help='Compare the adaptive and the fixed 5 s poll against a simulated thermal step.')
+    parser.add_argument('--temp_high', type=int, default=87, help='High temperature threshold.')
+    parser.add_argument('--temp_low', type=int, default=83, help='Low temperature threshold.')
+    parser.add_argument('--duration', type=float, default=1800, help='Simulated seconds.')
+    args = parser.parse_args()
+
+    if not args.simulate:
+        path = find_temperature_path()
+        print(f"acpitz temperature file: {path}")
+        if path:
+            sensor = SysfsTemperatureSensor(path)
+            print(f"Temperature: {sensor.read()}°C")
+        return
+
+    logging.disable(logging.INFO)
+    step_time = 600.0
+    trace = thermal_step_trace(step_time=step_time)
+    samplers = {
+        'fixed 5s': FixedSampler(5.0),
+        'adaptive': AdaptiveSampler(args.temp_high, args.temp_low),
+    }
+    for name, sampler in samplers.items():
+        result = simulate(trace, sampler, args.temp_high, args.temp_low, args.duration, idle_until=step_time)
+        latency = f"{result['reaction_latency']:.2f} s" if result['reaction_latency'] is not None else 'never'
+        print(f"{name:>10}: idle wakeups/min: {result['idle_wakeups_per_minute']:.2f}, "
+              f"wakeups/min: {result['wakeups_per_minute']:.2f}, reaction latency: {latency}, ACPI writes: {result['writes']}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
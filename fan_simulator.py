@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Headless fan control simulator for the Legion Go.
+
+Description:
+    Replays a load or temperature trace through a lumped thermal model of the APU and runs the
+    fan_controller strategies against it with a virtual clock, no hardware or sudo needed:
+
+    - firmware:   the stock fan table, no writes
+    - hysteresis: full fan speed between --temp_high and --temp_low (legion_fan_helper default)
+    - curve:      PI controller shifting the fan table to hold --target (legion_fan_helper --mode curve)
+
+    For each strategy it reports the time spent above --temp_high, the peak temperature, the
+    number of ACPI writes, the fan energy, estimated with the fan affinity law (power grows
+    with the cube of the speed), and how often the control loop woke up.
+
+Traces:
+    CSV with a header and a "time" column in seconds, plus "load" in watts and/or "temperature"
+    in °C. A temperature only trace (or a temp_legion_monitor.log written by legion_fan_helper
+    --logging True) is turned into a load trace by running the model backwards with the stock
+    fan table. Without --trace a built-in gaming session is used.
+
+Usage:
+    ./fan_simulator.py
+    ./fan_simulator.py --trace session.csv --temp_high 87 --temp_low 83 --target 85
+    ./fan_simulator.py --trace temp_legion_monitor.log
+"""
+
+import argparse
+import bisect
+import csv
+import logging
+import math
+import re
+from datetime import datetime
+
+import fan_controller
+import wmi_codec
+
+# Lumped thermal model, tuned so a 32 W load reaches the high 80s on the stock fan table
+AMBIENT_TEMPERATURE = 30.0  # °C
+HEAT_CAPACITY = 120.0       # J/°C
+PASSIVE_CONDUCTANCE = 0.12  # W/°C with the fan stopped
+FAN_CONDUCTANCE = 0.45      # W/°C added at 100% fan speed
+FAN_MAX_POWER = 3.0         # W at 100% fan speed
+
+SIMULATION_STEP = 0.1       # Seconds
+
+STRATEGIES = ('firmware', 'hysteresis', 'curve')
+
+_LOG_LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - \w+ - CPU Temperature: ([\d.]+)°C')
+
+
+class ThermalModel:
+    """
+    First order model: heat_capacity * dT/dt = load - conductance(fan) * (T - ambient).
+    """
+
+    def __init__(self, ambient=AMBIENT_TEMPERATURE, heat_capacity=HEAT_CAPACITY,
+                 passive_conductance=PASSIVE_CONDUCTANCE, fan_conductance=FAN_CONDUCTANCE):
+        self.ambient = ambient
+        self.heat_capacity = heat_capacity
+        self.passive_conductance = passive_conductance
+        self.fan_conductance = fan_conductance
+
+    def conductance(self, fan_speed):
+        return self.passive_conductance + self.fan_conductance * fan_speed / 100
+
+    def step(self, temp, load, fan_speed, dt):
+        return temp + (load - self.conductance(fan_speed) * (temp - self.ambient)) * dt / self.heat_capacity
+
+    def load_for(self, temp, temp_rate, fan_speed):
+        """
+        The load that explains a temperature change, in W.
+        """
+        return max(self.heat_capacity * temp_rate + self.conductance(fan_speed) * (temp - self.ambient), 0.0)
+
+
+def fan_speed_for(table, temp, temperatures=wmi_codec.FAN_TABLE_TEMPERATURES):
+    """
+    Fan speed the firmware runs at for a temperature, interpolating the fan table.
+    """
+    if temp <= temperatures[0]:
+        return table[0]
+    if temp >= temperatures[-1]:
+        return table[-1]
+    index = bisect.bisect_right(temperatures, temp)
+    t0, t1 = temperatures[index - 1], temperatures[index]
+    s0, s1 = table[index - 1], table[index]
+    return s0 + (s1 - s0) * (temp - t0) / (t1 - t0)
+
+
+class Trace:
+    """
+    Load samples, held until the next one.
+
+    Args:
+        times (list): Sample times in seconds, increasing.
+        loads (list): Load in W for each sample.
+        initial_temperature (float): Temperature at the first sample.
+    """
+
+    def __init__(self, times, loads, initial_temperature=None):
+        self.times = list(times)
+        self.loads = list(loads)
+        self.initial_temperature = initial_temperature
+
+    @property
+    def duration(self):
+        return self.times[-1] - self.times[0]
+
+    def load_at(self, t):
+        index = bisect.bisect_right(self.times, self.times[0] + t) - 1
+        return self.loads[max(index, 0)]
+
+
+def synthetic_trace():
+    """
+    A gaming session: idle, a game around 25 W with bursts, a menu, a heavier game, idle.
+    """
+    segments = [(120, 5.0, 0.0), (900, 25.0, 4.0), (60, 10.0, 0.0), (600, 32.0, 4.0), (300, 5.0, 0.0)]
+    times, loads = [], []
+    t = 0
+    for duration, load, swing in segments:
+        for offset in range(duration):
+            times.append(t + offset)
+            loads.append(load + swing * math.sin((t + offset) / 15))
+        t += duration
+    return Trace(times, loads)
+
+
+def temperature_trace_to_load(times, temperatures, model, base_table):
+    """
+    Turns a recorded temperature trace into a load trace, assuming the stock fan table was active.
+    """
+    loads = []
+    for index, (t, temp) in enumerate(zip(times, temperatures)):
+        if index + 1 < len(times) and times[index + 1] > t:
+            rate = (temperatures[index + 1] - temp) / (times[index + 1] - t)
+        else:
+            rate = 0.0
+        loads.append(model.load_for(temp, rate, fan_speed_for(base_table, temp)))
+    return Trace(times, loads, initial_temperature=temperatures[0])
+
+
+def read_trace(path, model, base_table=fan_controller.DEFAULT_FAN_TABLE):
+    """
+    Reads a CSV trace or a legion_fan_helper log.
+
+    Returns:
+        Trace: The load trace.
+    """
+    times, loads, temperatures = [], [], []
+    if path.endswith('.log'):
+        start = None
+        with open(path, 'r') as file:
+            for line in file:
+                match = _LOG_LINE_PATTERN.match(line)
+                if not match:
+                    continue
+                timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+                start = timestamp if start is None else start
+                times.append(timestamp - start)
+                temperatures.append(float(match.group(2)))
+    else:
+        with open(path, 'r', newline='') as file:
+            for row in csv.DictReader(file):
+                times.append(float(row['time']))
+                if row.get('load'):
+                    loads.append(float(row['load']))
+                if row.get('temperature'):
+                    temperatures.append(float(row['temperature']))
+
+    if not times:
+        raise ValueError(f"No samples found in {path}")
+    if len(loads) == len(times):
+        return Trace(times, loads, initial_temperature=temperatures[0] if temperatures else None)
+    if len(temperatures) == len(times):
+        return temperature_trace_to_load(times, temperatures, model, base_table)
+    raise ValueError(f"{path} needs a load or a temperature value on every row")
+
+
+def simulate_strategy(strategy, trace, model, temp_high, temp_low, target, base_table=fan_controller.DEFAULT_FAN_TABLE):
+    """
+    Runs one strategy over the trace.
+
+    Returns:
+        dict: time_above (s), max_temperature (°C), writes, fan_energy (Wh), average_fan_speed (%), wakeups.
+    """
+    now = [0.0]
+    fan = {'table': list(base_table), 'full_speed': False}
+
+    def apply_table(table):
+        fan['table'] = list(table)
+        return '0'
+
+    def apply_full_speed(enable):
+        fan['full_speed'] = enable
+        return '0'
+
+    temp = trace.initial_temperature if trace.initial_temperature is not None else model.ambient + trace.load_at(0) / model.conductance(base_table[0])
+    sampler = fan_controller.AdaptiveSampler(temp_high, temp_low)
+    if strategy == 'hysteresis':
+        controller = fan_controller.HysteresisController(temp_high, temp_low, apply_full_speed)
+    elif strategy == 'curve':
+        controller = fan_controller.CurveController(base_table, target, apply_table, apply_full_speed, full_speed_temp=temp_high + 3)
+    else:
+        controller = None
+    loop = fan_controller.FanControlLoop(lambda: temp, controller, sampler, clock=lambda: now[0]) if controller else None
+
+    next_sample = 0.0
+    time_above = 0.0
+    max_temperature = temp
+    fan_energy = 0.0
+    fan_speed_total = 0.0
+    steps = int(trace.duration / SIMULATION_STEP)
+    for _ in range(steps):
+        if loop and now[0] >= next_sample:
+            next_sample = now[0] + loop.step()
+        fan_speed = 100 if fan['full_speed'] else fan_speed_for(fan['table'], temp)
+        temp = model.step(temp, trace.load_at(now[0]), fan_speed, SIMULATION_STEP)
+        now[0] += SIMULATION_STEP
+
+        if temp > temp_high:
+            time_above += SIMULATION_STEP
+        max_temperature = max(max_temperature, temp)
+        fan_energy += FAN_MAX_POWER * (fan_speed / 100) ** 3 * SIMULATION_STEP
+        fan_speed_total += fan_speed
+
+    return {
+        'time_above': time_above,
+        'max_temperature': max_temperature,
+        'writes': controller.writes if controller else 0,
+        'fan_energy': fan_energy / 3600,
+        'average_fan_speed': fan_speed_total / steps if steps else 0.0,
+        'wakeups': loop.wakeups if loop else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go fan control simulator')
+    parser.add_argument('--trace', help='CSV trace (time, load and/or temperature) or a legion_fan_helper log. Defaults to a built-in gaming session.')
+    parser.add_argument('--temp_high', type=int, default=87, help='High temperature threshold.')
+    parser.add_argument('--temp_low', type=int, default=83, help='Low temperature threshold.')
+    parser.add_argument('--target', type=float, default=None, help='Curve controller target temperature. Defaults to temp_high - 2.')
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES), help='Strategies to compare.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    model = ThermalModel()
+    trace = read_trace(args.trace, model) if args.trace else synthetic_trace()
+    target = args.target if args.target is not None else args.temp_high - 2
+
+    print(f"Trace: {args.trace or 'built-in gaming session'}, {trace.duration / 60:.1f} min, "
+          f"temp_high: {args.temp_high}°C, temp_low: {args.temp_low}°C, target: {target}°C")
+    print(f"{'strategy':>10} | {'above temp_high':>15} | {'peak':>7} | {'ACPI writes':>11} | {'fan energy':>10} | {'avg fan':>7} | {'wakeups/min':>11}")
+    for strategy in args.strategies:
+        result = simulate_strategy(strategy, trace, model, args.temp_high, args.temp_low, target)
+        print(f"{strategy:>10} | {result['time_above']:>13.1f} s | {result['max_temperature']:>5.1f}°C | "
+              f"{result['writes']:>11} | {result['fan_energy']:>7.3f} Wh | {result['average_fan_speed']:>6.1f}% | "
+              f"{result['wakeups'] / trace.duration * 60:>11.1f}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
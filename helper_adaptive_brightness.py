@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
-import os
-
-CONTROL_FILE_PATH = '/tmp/adaptive_brightness_control.txt'
+import brightness_commands
 
 commands = {
     'i': 'increase',
@@ -13,16 +11,38 @@ commands = {
     'l': 'decrease_shift',
     'e': 'increase_sensitivity',
     't': 'decrease_sensitivity',
-    'c': 'print'
+    'c': 'print',
+    'n': 'next_profile',
+    'a': 'auto_profile'
 }
 
-def write_command_to_file(command):
+def send_commands(command_list):
+    try:
+        reply = brightness_commands.send_commands(command_list)
+    except OSError as e:
+        print(f"Error sending commands to {brightness_commands.COMMAND_SOCKET_PATH}: {e}")
+        return
+    if reply.get('ok'):
+        print(f"Sent {len(command_list)} command(s), configuration: {reply['config']}")
+    else:
+        print(f"Error: {reply.get('error')}")
+
+def parse_choice(choice):
+    """
+    Turns "i x5" or "i i h" into a list of commands, None if a key is unknown.
+    """
+    words = []
+    for word in choice.split():
+        if word in commands:
+            words.append(commands[word])
+        elif word.startswith('x') and word[1:].isdigit():
+            words.append(word)
+        else:
+            return None
     try:
-        with open(CONTROL_FILE_PATH, 'w') as file:
-            file.write(command)
-        print(f"Command '{command}' written to {CONTROL_FILE_PATH}")
-    except Exception as e:
-        print(f"Error writing to file: {e}")
+        return brightness_commands.parse_batch(words)
+    except ValueError:
+        return None
 
 def display_menu():
     print("\nAdaptive Brightness Control CLI")
@@ -37,7 +57,10 @@ def display_menu():
     print("e - Increase Sensitivity")
     print("t - Decrease Sensitivity")
     print("c - Print Current Configuration")
+    print("n - Next Profile")
+    print("a - Automatic Profile Switching")
     print("q - Quit")
+    print("Repeat with xN (i.e. 'i x5'), or chain keys (i.e. 'i h h').")
     print("-------------------------------")
 
 if __name__ == "__main__":
@@ -47,7 +70,8 @@ if __name__ == "__main__":
         if choice == 'q':
             print("Exiting Adaptive Brightness Control CLI")
             break
-        elif choice in commands:
-            write_command_to_file(commands[choice])
+        command_list = parse_choice(choice)
+        if command_list:
+            send_commands(command_list)
         else:
             print("Invalid choice. Please try again.")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Preallocated 64 byte report templates for the Legion Go controllers.
+
+Description:
+    The create_*_command functions in legion_configurator.py build a list, pad it and convert it
+    on every call. A ReportTemplate holds the report of one command type in a bytearray with the
+    constant bytes and the 0xCD padding already in place, and only writes the variable fields.
+    build() returns a memoryview of that buffer, so nothing is allocated per report; the view is
+    overwritten by the next build, copy() returns bytes that can be kept.
+
+    Field values are checked against the allowed codes/ranges in build(). Values that were
+    already checked, i.e. a precomputed colour table, can skip that with check=False, and
+    patch() rewrites a single field (i.e. only the colour of a streamed RGB report).
+
+    Templates are not shared between threads, every user makes its own (ReportBuilder makes one
+    of each).
+
+Usage:
+    ./hid_reports.py --check        # Compare every template byte for byte with the create_* functions
+    ./hid_reports.py --benchmark    # Per report build cost, create_* vs templates
+"""
+
+import argparse
+import itertools
+import time
+
+REPORT_SIZE = 64
+PADDING = 0xCD
+END_MARKER = 0x01
+
+CONTROLLERS = range(0x03, 0x05)  # 0x03: left, 0x04: right
+BYTE = range(0x100)
+PERCENT = range(0x65)
+
+BUTTONS = {'Y1': 0x1c, 'Y2': 0x1d, 'Y3': 0x1e, 'M2': 0x21, 'M3': 0x22}
+
+# From the create_button_remap_command docstring
+ACTIONS = {
+    'disabled': 0x00,
+    'left_stick_click': 0x03, 'left_stick_up': 0x04, 'left_stick_down': 0x05,
+    'left_stick_left': 0x06, 'left_stick_right': 0x07,
+    'right_stick_click': 0x08, 'right_stick_up': 0x09, 'right_stick_down': 0x0a,
+    'right_stick_left': 0x0b, 'right_stick_right': 0x0c,
+    'dpad_up': 0x0d, 'dpad_down': 0x0e, 'dpad_left': 0x0f, 'dpad_right': 0x10,
+    'A': 0x12, 'B': 0x13, 'X': 0x14, 'Y': 0x15,
+    'left_bumper': 0x16, 'left_trigger': 0x17, 'right_bumper': 0x18, 'right_trigger': 0x19,
+    'view': 0x23, 'menu': 0x24,
+}
+
+# name: (constant bytes before the fields, ((field, allowed values), ...)), the end marker follows
+REPORT_LAYOUTS = {
+    'touchpad': ((0x05, 0x06, 0x6b, 0x02, 0x04), (('enable', range(2)),)),
+    'rgb_control': ((0x05, 0x0c, 0x72, 0x01), (('controller', CONTROLLERS), ('mode', BYTE), ('red', BYTE),
+                                               ('green', BYTE), ('blue', BYTE), ('brightness', PERCENT),
+                                               ('speed', PERCENT), ('profile', BYTE))),
+    'rgb_on_off': ((0x05, 0x06, 0x70, 0x02), (('controller', CONTROLLERS), ('on', range(2)))),
+    'gyro_remap': ((0x05, 0x08, 0x6a, 0x06, 0x01, 0x01), (('gyro', range(1, 3)), ('joystick', range(3)))),
+    'button_remap': ((0x05, 0x07, 0x6c, 0x02), (('controller', CONTROLLERS), ('button', frozenset(BUTTONS.values())),
+                                                ('action', frozenset(ACTIONS.values())))),
+    'vibration': ((0x05, 0x06, 0x67, 0x02), (('controller', CONTROLLERS), ('level', range(4)))),
+    'fps_remap': ((0x05, 0x08, 0x6c, 0x04), (('controller', CONTROLLERS), ('profile', range(1, 5)),
+                                             ('button', frozenset(BUTTONS.values())),
+                                             ('action', frozenset(ACTIONS.values())))),
+    'sleep_time': ((0x05, 0x06, 0x33, 0x01), (('controller', CONTROLLERS), ('minutes', BYTE))),
+    'gyro_enable': ((0x05, 0x08, 0x6a, 0x02), (('controller', CONTROLLERS), ('enable', range(2)))),
+    'touchpad_vibration': ((0x05, 0x06, 0x6b, 0x04, 0x04), (('enable', range(1, 3)),)),
+    'legion_button_swap': ((0x05, 0x06, 0x69, 0x04, 0x01), (('enable', range(1, 3)),)),
+    'deadzone': ((0x05, 0x06, 0x3f, 0x06), (('controller', CONTROLLERS), ('level', range(0x64)))),
+    'sensitivity': ((0x05, 0x09, 0x3f, 0x02), (('controller', CONTROLLERS), ('tx', PERCENT), ('ty', PERCENT),
+                                               ('bx', PERCENT), ('by', PERCENT))),
+    'leds': ((0x05, 0x05, 0x6a, 0x01), (('controller', CONTROLLERS),)),
+}
+
+
+class ReportTemplate:
+    """
+    One command type, with its report preallocated.
+
+    Args:
+        name (str): Key of REPORT_LAYOUTS.
+    """
+
+    def __init__(self, name):
+        header, fields = REPORT_LAYOUTS[name]
+        self.name = name
+        self.fields = tuple(field for field, _ in fields)
+        self.allowed = tuple(allowed for _, allowed in fields)
+        # bytes() already rejects values outside 0-255, only the narrower fields are checked
+        self.narrow = tuple((index, field, allowed) for index, (field, allowed) in enumerate(fields) if allowed is not BYTE)
+        self.offset = len(header)
+        self.offsets = {field: self.offset + index for index, field in enumerate(self.fields)}
+        self.buffer = bytearray([PADDING]) * REPORT_SIZE
+        self.buffer[:self.offset] = bytes(header)
+        self.buffer[self.offset + len(fields)] = END_MARKER
+        self.view = memoryview(self.buffer)
+
+    def validate(self, *values):
+        """
+        Returns:
+            bytes: The field values.
+
+        Raises:
+            ValueError: If a value is missing or not allowed for its field.
+        """
+        if len(values) != len(self.fields):
+            raise ValueError(f"{self.name} takes {len(self.fields)} field(s) ({', '.join(self.fields)}), got {len(values)}")
+        try:
+            data = bytes(values)
+        except (TypeError, ValueError):
+            raise ValueError(f"{self.name}: the fields are bytes (0-255), got {values!r}") from None
+        for index, field, allowed in self.narrow:
+            if data[index] not in allowed:
+                raise ValueError(f"{self.name}.{field}: {data[index]!r} is not allowed")
+        return data
+
+    def build(self, *values, check=True):
+        """
+        Writes the fields, in REPORT_LAYOUTS order.
+
+        Args:
+            values (int): The field values.
+            check (bool): Validate them, False if they were checked before.
+
+        Returns:
+            memoryview: The report, valid until the next build/patch of this template.
+        """
+        self.buffer[self.offset:self.offset + len(values)] = self.validate(*values) if check else values
+        return self.view
+
+    def copy(self, *values, check=True):
+        """
+        Same as build(), but returns bytes that stay valid.
+        """
+        return bytes(self.build(*values, check=check))
+
+    def patch(self, field, value, check=True):
+        """
+        Rewrites one field and keeps the others.
+
+        Returns:
+            memoryview: The report.
+        """
+        if check and value not in self.allowed[self.fields.index(field)]:
+            raise ValueError(f"{self.name}.{field}: {value!r} is not allowed")
+        self.buffer[self.offsets[field]] = value
+        return self.view
+
+
+class ReportBuilder:
+    """
+    One template of each command type, i.e. builder.rgb_control.build(...).
+    """
+
+    def __init__(self):
+        for name in REPORT_LAYOUTS:
+            setattr(self, name, ReportTemplate(name))
+
+
+def golden_cases():
+    """
+    Yields (template name, field values, reference report) for every command type, built with
+    the create_* functions of legion_configurator.py.
+    """
+    import legion_configurator as lc
+    buttons = sorted(BUTTONS.values())
+    actions = sorted(ACTIONS.values())
+    for enable in (False, True):
+        yield 'touchpad', (int(enable),), lc.create_touchpad_command(enable)
+        yield 'touchpad_vibration', (2 if enable else 1,), lc.create_touchpad_vibration_command(enable)
+        yield 'legion_button_swap', (2 if enable else 1,), lc.create_legion_button_swap_command(enable)
+    for controller in CONTROLLERS:
+        for mode, color, brightness, speed, profile in itertools.product(
+                (1, 4), (b'\x00\x00\x00', b'\xff\x80\x01'), (0, 100), (0, 50, 100), (1, 3)):
+            yield ('rgb_control', (controller, mode, *color, brightness, speed, profile),
+                   lc.create_rgb_control_command(controller, mode, color, brightness, speed, profile))
+        for on in (False, True):
+            yield 'rgb_on_off', (controller, int(on)), lc.create_rgb_on_off_command(controller, on)
+            yield 'gyro_enable', (controller, int(on)), lc.create_gyro_enable_command(controller, int(on))
+        for button, action in itertools.product(buttons, actions):
+            yield 'button_remap', (controller, button, action), lc.create_button_remap_command(controller, button, action)
+            for profile in range(1, 5):
+                yield ('fps_remap', (controller, profile, button, action),
+                       lc.create_fps_remap_command(controller, profile, button, action))
+        for level in range(4):
+            yield 'vibration', (controller, level), lc.create_vibration_command(controller, level)
+        for minutes in (0, 10, 255):
+            yield 'sleep_time', (controller, minutes), lc.create_sleep_time_command(controller, minutes)
+        for level in range(0x64):
+            yield 'deadzone', (controller, level), lc.create_deadzone_command(controller, level)
+        for curve in ((0, 0, 0, 0), (85, 85, 5, 30), (100, 100, 100, 100)):
+            yield 'sensitivity', (controller, *curve), lc.create_sensitivity_command(controller, *curve)
+        yield 'leds', (controller,), lc.create_leds_command(controller)
+    for gyro, joystick in itertools.product(range(1, 3), range(3)):
+        yield 'gyro_remap', (gyro, joystick), lc.create_gyro_remap_command(gyro, joystick)
+
+
+def check():
+    """
+    Compares the templates with the create_* functions.
+
+    Returns:
+        int: Number of mismatches.
+    """
+    builder = ReportBuilder()
+    cases = mismatches = 0
+    for name, values, expected in golden_cases():
+        cases += 1
+        template = getattr(builder, name)
+        # Each build writes over the previous case, stale bytes must not leak through
+        if bytes(template.build(*values)) != expected or template.copy(*values, check=False) != expected:
+            mismatches += 1
+            print(f"{name}{values}: {bytes(template.view).hex()} != {expected.hex()}")
+    print(f"{cases - mismatches}/{cases} reports match the create_* functions")
+    return mismatches
+
+
+def benchmark(count):
+    """
+    Builds count RGB reports with a changing colour, the way an animation streams them.
+    """
+    import legion_configurator as lc
+    colors = [((i * 7) & 0xFF, (i * 13) & 0xFF, (i * 29) & 0xFF) for i in range(256)]
+    color_bytes = [bytes(color) for color in colors]
+    template = ReportTemplate('rgb_control')
+    template.build(0x03, 1, 0, 0, 0, 100, 50, 1)
+    red = template.offsets['red']
+
+    def create():
+        for i in range(count):
+            lc.create_rgb_control_command(0x03, 1, color_bytes[i & 0xFF], 100, 50, 1)
+
+    def build_checked():
+        for i in range(count):
+            template.build(0x03, 1, *colors[i & 0xFF], 100, 50, 1)
+
+    def build_unchecked():
+        for i in range(count):
+            template.build(0x03, 1, *colors[i & 0xFF], 100, 50, 1, check=False)
+
+    def color_only():
+        buffer = template.buffer
+        for i in range(count):
+            buffer[red:red + 3] = color_bytes[i & 0xFF]
+
+    for label, run in (("create_rgb_control_command", create), ("template.build()", build_checked),
+                       ("template.build(check=False)", build_unchecked), ("colour slice only", color_only)):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f"{label:28} {elapsed / count * 1e9:8.0f} ns/report")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preallocated Legion controller report templates')
+    parser.add_argument('--check', action='store_true', help='Compare the templates with the create_* functions.')
+    parser.add_argument('--benchmark', action='store_true', help='Per report build cost.')
+    parser.add_argument('--count', type=int, default=200000, help='Reports per benchmark run.')
+    args = parser.parse_args()
+    if not args.check and not args.benchmark:
+        parser.print_help()
+        return
+    if args.check and check():
+        raise SystemExit(1)
+    if args.benchmark:
+        benchmark(args.count)
+
+
+if __name__ == "__main__":
+    main()
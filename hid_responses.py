@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Background reader for the Legion controller responses.
+
+Description:
+    send_command(..., read_response=True) writes a report and then blocks on one read, and the
+    response that comes back is taken to be the answer whatever it is. ResponseReader reads the
+    configuration interface on its own thread and hands each input report to the oldest
+    outstanding request with the same report ID and command byte (bytes 0 and 2), as a
+    concurrent.futures.Future. Several requests can be in flight: all their reports are written
+    back to back and the responses are matched as they arrive.
+
+    A request that gets no response within its timeout fails with TimeoutError, all outstanding
+    requests fail with OSError when the handle does. Responses nobody asked for are counted.
+    While a reader runs, send(..., read_response=True) on the same session would race it for the
+    responses, use request() instead.
+
+Usage:
+    ./hid_responses.py --fake                 # Read back the controller settings from the fake backend
+    ./hid_responses.py --benchmark --count 50 # Blocking send/read vs in-flight requests, fake backend
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import legion_configurator
+from legion_configurator import HID_ERRORS, REPORT_SIZE
+
+# Read timeout of the reader thread, bounds how late timeouts fire and stop() returns
+READ_POLL_MS = 50
+REQUEST_TIMEOUT = 1.0
+CONTROLLERS = {'left': 0x03, 'right': 0x04}
+
+
+def response_key(report):
+    """
+    Returns:
+        tuple: Report ID and command byte, shared by a request and its response.
+    """
+    return report[0], report[2]
+
+
+class ResponseReader:
+    """
+    Matches the controller responses to requests on a reader thread.
+
+    Args:
+        controller (LegionController): The session, its handle is shared with the writers.
+        poll_ms (int): Read timeout of the reader thread.
+    """
+
+    def __init__(self, controller, poll_ms=READ_POLL_MS):
+        self.controller = controller
+        self.poll_ms = poll_ms
+        self.pending = collections.defaultdict(collections.deque)  # key: deque of (deadline, future)
+        self.completed = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='hid-responses', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_all(OSError("Response reader stopped"))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def request_many(self, reports, timeout=REQUEST_TIMEOUT):
+        """
+        Sends the reports in one batch, each with a future for its response.
+
+        Args:
+            reports (list): 64 byte reports.
+            timeout (float): Seconds to wait for each response.
+
+        Returns:
+            list: concurrent.futures.Future per report, resolving to the 64 byte response.
+
+        Raises:
+            OSError: If the reports could not be sent.
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        futures = []
+        # Registered before the write, a fast response must find its request
+        with self._lock:
+            for report in reports:
+                future = concurrent.futures.Future()
+                self.pending[response_key(report)].append((deadline, future))
+                futures.append(future)
+        try:
+            self.controller.send_many(reports)
+        except OSError as e:
+            with self._lock:
+                for report, future in zip(reports, futures):
+                    self._discard(response_key(report), future)
+            for future in futures:
+                # The reader thread may have failed them already for the same dead handle
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        return futures
+
+    def request(self, report, timeout=REQUEST_TIMEOUT):
+        return self.request_many([report], timeout)[0]
+
+    def _discard(self, key, future):
+        queue = self.pending.get(key)
+        if queue:
+            for entry in queue:
+                if entry[1] is future:
+                    queue.remove(entry)
+                    break
+
+    def _fail_all(self, error):
+        with self._lock:
+            futures = [future for queue in self.pending.values() for _, future in queue]
+            self.pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _expire(self, now):
+        expired = []
+        with self._lock:
+            for key, queue in self.pending.items():
+                while queue and queue[0][0] <= now:
+                    expired.append(queue.popleft()[1])
+        self.timeouts += len(expired)
+        for future in expired:
+            if not future.done():
+                future.set_exception(TimeoutError("No response from the controller"))
+
+    def _dispatch(self, data):
+        with self._lock:
+            queue = self.pending.get(response_key(data))
+            future = queue.popleft()[1] if queue else None
+        if future is None:
+            self.unmatched += 1
+            logging.debug(f"Unmatched controller response: {data[:8].hex()}")
+        elif not future.done():
+            self.completed += 1
+            future.set_result(data)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data = self.controller.open().read(REPORT_SIZE, self.poll_ms)
+            except HID_ERRORS as e:
+                # Requests written on a failed handle will not be answered. Drop the handle and
+                # the enumeration, the next open() finds the controller again after a replug
+                self.controller.close()
+                self.controller.info = None
+                self._fail_all(OSError(f"Controller handle failed: {e}"))
+                self._stop.wait(self.controller.reconnect_delay)
+                continue
+            if data:
+                self.controller.stats.responses += 1
+                self._dispatch(bytes(data))
+            self._expire(time.monotonic())
+
+
+def settings_requests():
+    """
+    The getter reports of legion_configurator.py, by setting name.
+    """
+    requests = {f"{name}_leds": legion_configurator.create_leds_command(byte) for name, byte in CONTROLLERS.items()}
+    requests['vibration_sensitivity'] = legion_configurator.create_vibration_sensitivity_command()
+    return requests
+
+
+def read_settings(reader, timeout=REQUEST_TIMEOUT):
+    """
+    Reads back the controller settings with all requests in flight at once.
+
+    Args:
+        reader (ResponseReader): Reader on the controller session.
+        timeout (float): Seconds to wait per response.
+
+    Returns:
+        dict: Setting name to the response bytes, or the exception if it failed.
+    """
+    requests = settings_requests()
+    futures = reader.request_many(list(requests.values()), timeout)
+    results = {}
+    for name, future in zip(requests, futures):
+        try:
+            results[name] = future.result()
+        except (OSError, TimeoutError) as e:
+            results[name] = e
+    return results
+
+
+def benchmark(count, latency, response_latency):
+    """
+    Times count getter round trips, one blocking send/read after the other and all in flight.
+    """
+    import fake_hid
+    report = legion_configurator.create_leds_command(CONTROLLERS['left'])
+
+    controller = legion_configurator.LegionController(fake_hid.FakeHidBackend(latency, response_latency=response_latency))
+    start = time.perf_counter()
+    for _ in range(count):
+        controller.send(report, read_response=True)
+    serial_time = time.perf_counter() - start
+
+    controller = legion_configurator.LegionController(fake_hid.FakeHidBackend(latency, response_latency=response_latency))
+    with ResponseReader(controller) as reader:
+        reader.request(report).result()  # Open the handle and start the thread outside the timing
+        start = time.perf_counter()
+        futures = reader.request_many([report] * count)
+        concurrent.futures.wait(futures)
+        in_flight_time = time.perf_counter() - start
+        failed = sum(1 for future in futures if future.exception())
+    print(f"{count} requests, {latency * 1000:.1f} ms/write, {response_latency * 1000:.1f} ms response latency")
+    print(f"Blocking send/read: {serial_time * 1000:8.1f} ms")
+    print(f"In flight:          {in_flight_time * 1000:8.1f} ms ({failed} failed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read back the Legion controller settings')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help='Seconds to wait per response.')
+    parser.add_argument('--fake', action='store_true', help='Use the fake HID backend, no hardware needed.')
+    parser.add_argument('--benchmark', action='store_true', help='Blocking vs in-flight requests on the fake backend.')
+    parser.add_argument('--count', type=int, default=50, help='Requests for --benchmark.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Fake seconds per write.')
+    parser.add_argument('--response_latency', type=float, default=0.004, help='Fake seconds until a response is readable.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.count, args.latency, args.response_latency)
+        return
+    backend = None
+    if args.fake:
+        import fake_hid
+        backend = fake_hid.FakeHidBackend(args.latency, response_latency=args.response_latency)
+    with ResponseReader(legion_configurator.get_controller(backend)) as reader:
+        start = time.perf_counter()
+        try:
+            results = read_settings(reader, args.timeout)
+        except OSError as e:
+            logging.error(f"Failed to read the controller settings: {e}")
+            raise SystemExit(1)
+        elapsed = time.perf_counter() - start
+    for name, response in results.items():
+        print(f"{name}: {response.hex() if isinstance(response, bytes) else f'failed ({response})'}")
+    print(f"Read {len(results)} settings in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -1,29 +1,238 @@
 #!/bin/python3
-import hid
+try:
+    import hid
+except ImportError:
+    hid = None  # Only needed for the real device, see fake_hid.py
 import time
 import argparse
 import sys
+import threading
 # Global variables
 vendor_id = 0x17EF
 product_id_match = lambda x: x & 0xFFF0 == 0x6180
 usage_page = 0xFFA0
 global_config = None
 
+REPORT_SIZE = 64
+# Milliseconds to wait for a response report
+READ_TIMEOUT_MS = 1000
+# Times a report is retried after the controllers were unplugged, and the wait before each try
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 0.5
+
 """
 This file contains functions to send commands to the Legion Go controller.
 """
 
+# hidapi raises its own exception type, the fake backend raises OSError
+HID_ERRORS = (OSError, getattr(hid, 'HIDException', OSError))
+
+
+class HidapiBackend:
+    """
+    The real HID bus, through the hid module.
+    """
+
+    name = 'hidapi'
+
+    def enumerate(self, vendor_id=0):
+        if hid is None:
+            raise OSError("The hid module is not installed (pip install hid)")
+        return hid.enumerate(vendor_id)
+
+    def open(self, path):
+        if hid is None:
+            raise OSError("The hid module is not installed (pip install hid)")
+        return HidapiDevice(hid.Device(path=path))
+
+
+class HidapiDevice:
+    """
+    An open hid.Device. Its write() only takes bytes, the hid_reports templates are memoryviews.
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+    def write(self, data):
+        return self.device.write(data if isinstance(data, bytes) else bytes(data))
+
+    def read(self, size, timeout=None):
+        return self.device.read(size, timeout)
+
+    def close(self):
+        self.device.close()
+
+
+class ControllerStats:
+    """
+    Counters of a LegionController session.
+    """
+
+    def __init__(self):
+        self.enumerations = 0
+        self.opens = 0
+        self.reports = 0
+        self.responses = 0
+        self.reconnects = 0
+        self.total_time = 0.0
+
+    def __str__(self):
+        return (f"reports: {self.reports}, responses: {self.responses}, enumerations: {self.enumerations}, "
+                f"opens: {self.opens}, reconnects: {self.reconnects}, time: {self.total_time * 1000:.2f} ms")
+
+
+class LegionController:
+    """
+    Session with the controllers' configuration interface. The HID tree is enumerated once and
+    the device stays open between reports, a failed report re-enumerates (the hidraw path
+    changes when the controllers are reattached), reopens and is sent again.
+
+    Args:
+        backend: HidapiBackend (default) or fake_hid.FakeHidBackend.
+        reconnect_attempts (int): Retries per report after an error.
+        reconnect_delay (float): Seconds to wait before each retry.
+    """
+
+    def __init__(self, backend=None, reconnect_attempts=RECONNECT_ATTEMPTS, reconnect_delay=RECONNECT_DELAY):
+        self.backend = backend or HidapiBackend()
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.stats = ControllerStats()
+        self.info = None
+        self._device = None
+        # open()/close() also run on the hid_responses reader thread
+        self._lock = threading.RLock()
+
+    def find(self, refresh=False):
+        """
+        Returns the enumeration entry of the configuration interface.
+
+        Raises:
+            OSError: If the controllers are not connected.
+        """
+        if self.info is None or refresh:
+            self.stats.enumerations += 1
+            self.info = None
+            for dev in self.backend.enumerate(vendor_id):
+                if product_id_match(dev["product_id"]) and dev["usage_page"] == usage_page:
+                    self.info = dev
+                    break
+            if self.info is None:
+                raise OSError("Legion go configuration device not found.")
+        return self.info
+
+    def open(self):
+        with self._lock:
+            if self._device is None:
+                self._device = self.backend.open(self.find()['path'])
+                self.stats.opens += 1
+            return self._device
+
+    def close(self):
+        with self._lock:
+            if self._device is not None:
+                try:
+                    self._device.close()
+                except HID_ERRORS:
+                    pass
+                self._device = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _reconnect(self, attempt):
+        self.close()
+        time.sleep(self.reconnect_delay * attempt)
+        self.stats.reconnects += 1
+        self.find(refresh=True)
+
+    def send_many(self, reports, read_responses=False, timeout_ms=READ_TIMEOUT_MS):
+        """
+        Writes the reports back to back on the open handle, then reads one response per report
+        if asked to. A report that fails is retried after reconnecting, the ones before it are
+        not sent again. A failed read is not retried: the responses were queued on the old
+        handle, a new one would never get them.
+
+        Args:
+            reports (list): 64 byte reports.
+            read_responses (bool): Read a response for every report after the writes.
+            timeout_ms (int): Read timeout per response.
+
+        Returns:
+            list: The responses, empty unless read_responses.
+
+        Raises:
+            OSError: If a report still fails after reconnect_attempts retries, or a response
+                could not be read.
+        """
+        start = time.perf_counter()
+        for report in reports:
+            assert len(report) == REPORT_SIZE
+        sent = 0
+        attempt = 0
+        reading = False
+        while True:
+            try:
+                device = self.open()
+                while sent < len(reports):
+                    device.write(reports[sent])
+                    sent += 1
+                    self.stats.reports += 1
+                responses = []
+                if read_responses:
+                    reading = True
+                    for _ in reports:
+                        responses.append(device.read(REPORT_SIZE, timeout_ms))
+                    self.stats.responses += len(responses)
+                self.stats.total_time += time.perf_counter() - start
+                return responses
+            except HID_ERRORS as e:
+                if reading:
+                    # Failed reading the responses, every report already went out
+                    self.close()
+                    raise OSError(f"Failed to read the Legion controller responses: {e}") from e
+                attempt += 1
+                if attempt > self.reconnect_attempts:
+                    self.close()
+                    raise OSError(f"Legion controller unavailable after {self.reconnect_attempts} reconnects: {e}") from e
+                print(f"HID error ({e}), reconnecting ({attempt}/{self.reconnect_attempts})")
+                try:
+                    self._reconnect(attempt)
+                except HID_ERRORS:
+                    pass  # Not back yet, the next attempt enumerates again
+
+    def send(self, report, read_response=False, timeout_ms=READ_TIMEOUT_MS):
+        """
+        Writes one report, returns the response if read_response.
+        """
+        responses = self.send_many([report], read_response, timeout_ms)
+        return responses[0] if read_response else None
+
+
+_controller = None
+
+
+def get_controller(backend=None):
+    """
+    Returns the shared LegionController session, created on first use.
+    """
+    global _controller
+    if _controller is None or (backend is not None and _controller.backend is not backend):
+        _controller = LegionController(backend)
+    return _controller
+
+
 def get_config():
     global global_config
 
     try:
-        # Enumerate and set the global configuration
-        for dev in hid.enumerate(vendor_id):
-            if product_id_match(dev["product_id"]) and dev["usage_page"] == usage_page:
-                global_config = dev
-                break
-    except Exception as e:
-        print("legion_configurator error: couldn't find device config")
+        global_config = get_controller().find()
+    except HID_ERRORS as e:
+        print(f"legion_configurator error: couldn't find device config ({e})")
 
     if not global_config:
         print("Legion go configuration device not found.")
@@ -31,18 +240,25 @@ def get_config():
         print(global_config)
 
 def send_command(command, read_response=False):
-    global global_config
-    get_config()
-    assert len(command) == 64 and global_config
+    assert len(command) == 64
     try:
-        with hid.Device(path=global_config['path']) as device:
-            device.write(command)
-            print("Command sent successfully.")
-            if read_response:
-                response = device.read(64)  # Assuming response is 64 bytes
-                print("Response received:", response)
-                return response
-    except IOError as e:
+        response = get_controller().send(command, read_response)
+        print("Command sent successfully.")
+        if read_response:
+            print("Response received:", response)
+            return response
+    except HID_ERRORS as e:
+        print(f"Error opening HID device: {e}")
+
+def send_commands(commands, read_responses=False):
+    """
+    Sends several commands in one go on the shared session.
+    """
+    try:
+        responses = get_controller().send_many(commands, read_responses)
+        print(f"{len(commands)} command(s) sent successfully.")
+        return responses
+    except HID_ERRORS as e:
         print(f"Error opening HID device: {e}")
 
 
@@ -392,65 +608,86 @@ def main():
     parser.add_argument('--curve', nargs=5, metavar=('CONTROLLER', 'TX', 'TY', 'BX', 'BY'),
                         help='Set sensitivity curve: controller ("left" or "right"), top x, top y, bottom x, bottom y. i.e. --curve left 0 0 0 0 sets the sensitivity curve of the left controller to the default curve. The default curve is a straight line. Lenovo allows for only two points for the curve, the curve is interpolated between the two points. Check repo for example picture using --curve right 85 85 5 30')
 
-    
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Apply a TOML or JSON controller profile, only the settings changed since the last apply are sent. See controller_profile_example.toml')
+    parser.add_argument('--force', action='store_true', help='With --profile, send every setting of the profile.')
+
+    parser.add_argument('--fake', action='store_true', help='Send the reports to a fake HID backend (fake_hid.py), no hardware needed.')
+
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
     args = parser.parse_args()
+    if args.fake:
+        import fake_hid
+        get_controller(fake_hid.FakeHidBackend())
+    commands = []
     
     # Process touchpad vibration argument
     if args.touchpad_vibration is not None:
         touch_vib_command = create_touchpad_vibration_command(args.touchpad_vibration)
-        send_command(touch_vib_command)
+        commands.append(touch_vib_command)
 
     # Process RGB control argument
     if args.rgb_control:
         controller_arg, mode, color, brightness, speed, profile = args.rgb_control
         controller = controller_mapping(controller_arg)
         rgb_command = create_rgb_control_command(controller, int(mode), bytes.fromhex(color), int(brightness), int(speed), int(profile))
-        send_command(rgb_command)
+        commands.append(rgb_command)
     # Process gyro remap argument
     if args.gyro_remap:
         gyro, joystick = args.gyro_remap
         gyro_remap_command = create_gyro_remap_command(int(gyro), int(joystick))
-        send_command(gyro_remap_command)
+        commands.append(gyro_remap_command)
 
     if args.button_remap:
         controller_arg, button, action = args.button_remap
         controller = controller_mapping(controller_arg)
         button_remap_command = create_button_remap_command(controller, int(button), int(action))
-        send_command(button_remap_command)
+        commands.append(button_remap_command)
 
     if args.vibration_level:
         controller_arg, level = args.vibration_level
         controller = controller_mapping(controller_arg)
         vibration_command = create_vibration_command(controller, int(level))
-        send_command(vibration_command)
+        commands.append(vibration_command)
 
     if args.fps_remap:
         controller_arg, profile, button, action = args.fps_remap
         controller = controller_mapping(controller_arg)
         fps_remap_command = create_fps_remap_command(controller, int(profile), int(button), int(action))
-        send_command(fps_remap_command)
+        commands.append(fps_remap_command)
 
     # Process sleep time argument
     if args.sleep_time:
         controller_arg, time_in_minutes = args.sleep_time
         controller = controller_mapping(controller_arg)
         sleep_time_command = create_sleep_time_command(controller, int(time_in_minutes))
-        send_command(sleep_time_command)
+        commands.append(sleep_time_command)
     
     if args.deadzone:
         controller_arg, level = args.deadzone
         controller = controller_mapping(controller_arg)
         deadzone_command = create_deadzone_command(controller, int(level))
-        send_command(deadzone_command)
+        commands.append(deadzone_command)
 
     if args.curve:
         controller_arg, tx, ty, bx, by = args.curve
         controller = controller_mapping(controller_arg)
         curve_command = create_sensitivity_command(controller, int(tx), int(ty), int(bx), int(by))
-        send_command(curve_command)
+        commands.append(curve_command)
+
+    # All reports on one open handle instead of an enumerate and open per report
+    if commands:
+        send_commands(commands)
+    if args.profile:
+        import controller_profile
+        try:
+            print(f"Profile {args.profile}: {controller_profile.apply_profile(args.profile, get_controller(), force=args.force)}")
+        except (ValueError, OSError) as e:
+            print(f"Failed to apply {args.profile}: {e}")
+            sys.exit(1)
+    if args.fake:
+        print(f"Fake HID backend: {get_controller().stats}")
 if __name__ == '__main__':
     main()
-
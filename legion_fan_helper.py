@@ -5,8 +5,8 @@ Legion Fan Control and Monitoring Script
 Description:
     This script is designed to monitor the system's CPU temperature and adjust the fan speed accordingly to ensure optimal cooling and system performance. It implements a hysteresis mechanism to prevent frequent toggling of fan states. The script also logs various system metrics like AC status, Ryzen CPU adjustments, and more for performance monitoring and troubleshooting.
 
-- Monitors CPU temperature
-- Adjusts fan speed based on predefined temperature thresholds with hysteresis.
+- Monitors CPU temperature, sampling faster while it climbs toward the high threshold and backing off while it is stable.
+- Adjusts fan speed based on predefined temperature thresholds with hysteresis, or (--mode curve) shifts the fan curve to hold a target temperature.
 - Logs system performance metrics and hardware sensor readings.
 - Checks and logs AC power status and Ryzen CPU limits.
 
@@ -17,46 +17,41 @@ Usage:
 
 Requirements:
 
-sudo psutil - python3 -m pip install psutil
+sudo psutil - python3 -m pip install psutil (only used when the acpitz sysfs node can not be found)
 """
 
 
-import psutil
-import time
 import logging
 from logging.handlers import RotatingFileHandler
 import subprocess
 import re
 import argparse
 
-parser = argparse.ArgumentParser(description="Legion Fan Control and Monitoring Script")
-parser.add_argument("--temp_high", type=int, default=87, help="High temperature threshold for enabling full fan speed")
-parser.add_argument("--temp_low", type=int, default=83, help="Low temperature threshold for disabling full fan speed")
-parser.add_argument("--logging", type=bool, default=False, help="Enable or disable logging")
-args = parser.parse_args()
+import acpi_transport
+import fan_controller
+import legiongo_control
+import wmi_codec
 
 ryzen_monitoring = False # Broken on N39
 
-# Configure logging
 log_format = "%(asctime)s - %(levelname)s - %(message)s"
-logging.basicConfig(level=logging.INFO, format=log_format)
 
-
-# File handler for logging
-file_handler = RotatingFileHandler("temp_legion_monitor.log", maxBytes=1024*1024*5, backupCount=2)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter(log_format))
-
-# Adding file handler to the root logger
-logging.getLogger('').addHandler(file_handler)
-
-# Display the initial configuration message
-print(f"Starting Legion Fan Control and Monitoring Script with the following settings:")
-print(f" - High Temperature Threshold: {args.temp_high}°C")
-print(f" - Low Temperature Threshold: {args.temp_low}°C")
-print(f" - Logging: {'Enabled' if args.logging else 'Disabled'}")
+# acpitz temperature sensor, resolved on first use
+_temperature_sensor = None
 
 def get_cpu_temperature():
+    global _temperature_sensor
+    if _temperature_sensor is None:
+        path = fan_controller.find_temperature_path()
+        if path:
+            _temperature_sensor = fan_controller.SysfsTemperatureSensor(path)
+            logging.info(f"Reading CPU temperature from {path}")
+        else:
+            _temperature_sensor = False
+    if _temperature_sensor:
+        return _temperature_sensor.read()
+    # Fallback for kernels without an acpitz hwmon/thermal node
+    import psutil
     temps = psutil.sensors_temperatures()
     for name, entries in temps.items():
         if name.startswith("acpitz"):
@@ -118,11 +113,11 @@ def format_selected_ryzenadj_output(output):
     
 def execute_acpi_command(command):
     try:
-        result = subprocess.run(command, shell=True, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logging.info(f"Command executed: {command}, Output: {result.stdout.strip()}")
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error executing command: {command}, Error: {e.stderr}")
+        response = acpi_transport.get_transport().call(command)
+        logging.info(f"Command executed: {command}, Output: {response}")
+        return response
+    except acpi_transport.AcpiCallError as e:
+        logging.error(f"Error executing command: {command}, Error: {e}")
         return None
 
 def set_full_fan_speed(enable):
@@ -135,57 +130,99 @@ def set_full_fan_speed(enable):
     Returns:
         str: The result of the operation.
     """
-    status = '0x01' if enable else '0x00'
-    command = f"echo '\\_SB.GZFD.WMAE 0 0x12 {status}04020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"
+    command = wmi_codec.encode_set_feature('full_fan_speed', 1 if enable else 0)
     return execute_acpi_command(command)
 
-def monitor_and_adjust_fan_speed(temp_high_threshold, temp_low_threshold, log_values):
+def create_curve_controller(temp_high_threshold, target):
+    """
+    Builds a CurveController around the current fan table, it shifts the table with
+    legiongo_control.set_fan_curve and uses full fan speed above temp_high_threshold + 3°C.
+    """
+    fan_curve = legiongo_control.get_fan_curve()
+    base_table = fan_curve[0] if fan_curve else fan_controller.DEFAULT_FAN_TABLE
+    return fan_controller.CurveController(
+        base_table, target, legiongo_control.set_fan_curve,
+        apply_full_speed=set_full_fan_speed, full_speed_temp=temp_high_threshold + 3)
+
+def monitor_and_adjust_fan_speed(temp_high_threshold, temp_low_threshold, log_values, min_period=fan_controller.MIN_PERIOD, max_period=fan_controller.MAX_PERIOD, mode='hysteresis', target=None):
     """
     Monitors the CPU temperature and adjusts the fan speed accordingly.
+    The temperature is sampled every min_period seconds while it climbs toward temp_high_threshold,
+    the period doubles up to max_period while it is stable.
+
     Args:
         temp_high_threshold (int): Temperature to enable full fan speed.
         temp_low_threshold (int): Temperature to disable full fan speed.
         log_values (bool): If True, log the temperature and system status.
+        min_period (float): Shortest time between two samples, in seconds.
+        max_period (float): Longest time between two samples, in seconds.
+        mode (str): 'hysteresis' toggles full fan speed, 'curve' shifts the fan table to hold target.
+        target (float): Temperature the curve mode holds, defaults to temp_high_threshold - 2.
     """
-    full_speed_enabled = False  # Track the state of full fan speed mode
+    def log_sample(cpu_temp, now):
+        if not log_values:
+            return
+        logging.info(f"CPU Temperature: {cpu_temp}°C, next sample in {sampler.period:.1f}s, "
+                     f"wakeups/min: {loop.wakeups_per_minute:.1f}")
+
+        ac_status = get_ac_status()
+        if ac_status:
+            logging.info(f"AC Status: {ac_status}")
+
+        if ryzen_monitoring:
+            ryzen_limits = get_ryzen_limits()
+            if ryzen_limits:
+                ryzen_limits = format_selected_ryzenadj_output(ryzen_limits)
+                logging.info(f"Ryzen Limits: {ryzen_limits}")
+
+    sampler = fan_controller.AdaptiveSampler(temp_high_threshold, temp_low_threshold, min_period, max_period)
+    if mode == 'curve':
+        controller = create_curve_controller(temp_high_threshold, target if target is not None else temp_high_threshold - 2)
+    else:
+        controller = fan_controller.HysteresisController(temp_high_threshold, temp_low_threshold, set_full_fan_speed)
+    loop = fan_controller.FanControlLoop(get_cpu_temperature, controller, sampler, on_sample=log_sample)
     try:
-        while True:
-            cpu_temp = get_cpu_temperature()
-            if cpu_temp:
-                cpu_temp = int(cpu_temp)
-                if log_values:
-                    logging.info(f"CPU Temperature: {cpu_temp}°C")
-
-                if cpu_temp >= temp_high_threshold and not full_speed_enabled:
-                    if log_values:
-                        logging.info("High temperature detected. Enabling full fan speed.")
-                    set_full_fan_speed(True)
-                    full_speed_enabled = True
-                elif cpu_temp <= temp_low_threshold and full_speed_enabled:
-                    if log_values:
-                        logging.info("Temperature back to normal. Disabling full fan speed.")
-                    set_full_fan_speed(False)
-                    full_speed_enabled = False
-
-            else:
-                if log_values:
-                    logging.error("Could not read CPU temperature")
-
-            if log_values:
-                ac_status = get_ac_status()
-                if ac_status:
-                    logging.info(f"AC Status: {ac_status}")
-
-                if ryzen_monitoring:
-                    ryzen_limits = get_ryzen_limits()
-                    if ryzen_limits:
-                        ryzen_limits = format_selected_ryzenadj_output(ryzen_limits)
-                        logging.info(f"Ryzen Limits: {ryzen_limits}")
-
-            time.sleep(5)  # Check temperature every 5 seconds
+        loop.run()
     except KeyboardInterrupt:
-        print("Monitoring stopped.")
+        print(f"Monitoring stopped. Wakeups/min: {loop.wakeups_per_minute:.2f}, fan speed writes: {controller.writes}")
+    finally:
+        if mode == 'curve':
+            # Hand the fan back to the table it had when we started
+            legiongo_control.set_fan_curve(controller.base_table)
+            if controller.full_speed_enabled:
+                set_full_fan_speed(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Legion Fan Control and Monitoring Script")
+    parser.add_argument("--temp_high", type=int, default=87, help="High temperature threshold for enabling full fan speed")
+    parser.add_argument("--temp_low", type=int, default=83, help="Low temperature threshold for disabling full fan speed")
+    parser.add_argument("--logging", type=bool, default=False, help="Enable or disable logging")
+    parser.add_argument("--min_period", type=float, default=fan_controller.MIN_PERIOD, help="Shortest time between temperature samples, in seconds")
+    parser.add_argument("--max_period", type=float, default=fan_controller.MAX_PERIOD, help="Longest time between temperature samples, in seconds")
+    parser.add_argument("--mode", choices=['hysteresis', 'curve'], default='hysteresis', help="hysteresis: toggle full fan speed between the thresholds, curve: shift the fan curve to hold --target")
+    parser.add_argument("--target", type=float, default=None, help="Temperature the curve mode holds, defaults to temp_high - 2")
+    args = parser.parse_args()
+
+    # File handler for logging
+    file_handler = RotatingFileHandler("temp_legion_monitor.log", maxBytes=1024*1024*5, backupCount=2)
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter(log_format))
+
+    # Adding file handler to the root logger
+    logging.getLogger('').addHandler(file_handler)
+
+    # Display the initial configuration message
+    print(f"Starting Legion Fan Control and Monitoring Script with the following settings:")
+    print(f" - High Temperature Threshold: {args.temp_high}°C")
+    print(f" - Low Temperature Threshold: {args.temp_low}°C")
+    print(f" - Sampling Period: {args.min_period}s to {args.max_period}s")
+    print(f" - Mode: {args.mode}")
+    print(f" - Logging: {'Enabled' if args.logging else 'Disabled'}")
+
+    monitor_and_adjust_fan_speed(args.temp_high, args.temp_low, args.logging, args.min_period, args.max_period, args.mode, args.target)
 
 
 if __name__ == "__main__":
-    monitor_and_adjust_fan_speed(args.temp_high, args.temp_low, args.logging)
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    main()
@@ -4,27 +4,31 @@ Legion Go specific code.
 """
 
 import argparse
-import subprocess
 import logging
-import re
+
+import acpi_transport
+import state_cache
+import wmi_codec
 
 # This function is used to execute ACPI commands that are specific to the Legion Go using manufacturer specific ACPI calls.
 def execute_acpi_command(command_parts):
     """
-    Executes an ACPI command and returns the output.
+    Executes an ACPI command and returns the response.
+    Build the command with wmi_codec and decode the response with it.
     """
     command = " ".join(command_parts)
     try:
         logging.debug(f"Command: {command}")
-        result = subprocess.run(command, shell=True, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error executing command: {e.stderr}")
+        response = acpi_transport.get_transport().call(command)
+        logging.debug(f"Response: {response}")
+        return response
+    except acpi_transport.AcpiCallError as e:
+        logging.error(f"Error executing command: {e}")
         return None
 
 
 def set_tdp_value(mode, wattage):
-    mode_mappings = {'slow': '0x01', 'steady': '0x02', 'fast': '0x03'}
+    mode_mappings = wmi_codec.TDP_FEATURES
     if mode not in mode_mappings:
         logging.error(f"Invalid TDP mode: {mode}. Must be one of {list(mode_mappings.keys())}.")
         return None
@@ -34,28 +38,29 @@ def set_tdp_value(mode, wattage):
         logging.error(f"Invalid wattage: {wattage}. Must be between 0 and 100.")
         return None
 
-    mode_code = mode_mappings[mode]
-    command_parts = [f"echo '\\_SB.GZFD.WMAE 0 0x12 {{0x00, 0xFF, {mode_code}, 0x01, {wattage}, 0x00, 0x00, 0x00}}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
-    output = execute_acpi_command(command_parts)
-    logging.info(f"TDP set to {mode} mode with wattage {wattage}.")
+    feature = mode_mappings[mode]
+    command_parts = [wmi_codec.encode_set_feature(feature, wattage)]
+    output = state_cache.get_cache().write_through(feature, wattage, lambda: execute_acpi_command(command_parts))
+    if output == state_cache.UNCHANGED:
+        logging.info(f"TDP for {mode} mode is already {wattage}.")
+    else:
+        logging.info(f"TDP set to {mode} mode with wattage {wattage}.")
     return output
 
 def get_tdp_value(mode):
-    mode_mappings = {'Slow': '01', 'Steady': '02', 'Fast': '03'}
-    mode_code = mode_mappings.get(mode, '02')  # Default to 'Steady' if mode is not found
-    command_parts = [f"echo '\\_SB.GZFD.WMAE 0 0x11 0x01{mode_code}FF00' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
-    response = execute_acpi_command(command_parts)
+    feature = wmi_codec.TDP_FEATURES.get(mode.lower(), 'steady_tdp')  # Default to 'Steady' if mode is not found
+    response = execute_acpi_command([wmi_codec.encode_get_feature(feature)])
     if response:
-        match = re.search(r'\n0x([0-9a-fA-F]+)', response)
-        if match:
-            tdp_hex = match.group(1)
-            tdp_value = int(tdp_hex, 16) # Convert hex to decimal
+        try:
+            tdp_value = wmi_codec.decode_int(response)
+            state_cache.get_cache().update(feature, tdp_value)
             logging.info(f"Retrieved TDP value for {mode} mode: {tdp_value}")
-        else:
-            logging.error("Failed to parse TDP value.")
+            return tdp_value
+        except wmi_codec.WmiDecodeError as e:
+            logging.error(f"Failed to parse TDP value: {e}")
     else:
         logging.error("Failed to retrieve TDP value.")
-    return response
+    return None
 
 def set_fan_curve(fan_table):
     """
@@ -68,62 +73,44 @@ def set_fan_curve(fan_table):
     Returns:
         str: The output from setting the new fan curve.
     """
-    # Assuming Fan ID and Sensor ID are both 0 (as they are ignored)
-    fan_id_sensor_id = '0x00, 0x00'
-
-    # Assuming the temperature array length and values are ignored but required
-    temp_array_length = '0x0A, 0x00, 0x00, 0x00'  # Length 10 in hex
-    temp_values = ', '.join([f'0x{temp:02x}, 0x00' for temp in range(0, 101, 10)]) + ', 0x00'
-
-    # Fan speed values in uint16 format with null termination
-    fan_speed_values = ', '.join([f'0x{speed:02x}, 0x00' for speed in fan_table]) + ', 0x00'
+    try:
+        command = [wmi_codec.encode_set_fan_table(fan_table)]
+    except ValueError as e:
+        logging.error(f"Invalid fan curve: {e}")
+        return None
 
-    # Constructing the full command
     logging.info(f"Setting fan curve to: {fan_table}")
-    
-    command = ["echo '\\_SB.GZFD.WMAB 0 0x06 {{{fan_id_sensor_id}, {temp_array_length}, {fan_speed_values}, {temp_array_length}, {temp_values}}}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call".format(
-        fan_id_sensor_id=fan_id_sensor_id,
-        temp_array_length=temp_array_length,
-        temp_values=temp_values,
-        fan_speed_values=fan_speed_values
-    )]
-    return execute_acpi_command(command)
+    return state_cache.get_cache().write_through('fan_table', tuple(fan_table), lambda: execute_acpi_command(command))
 
 
 def get_fan_curve():
-    # Define the ACPI command to retrieve the fan curve data
-    acpi_command_parts = ["echo '\\_SB.GZFD.WMAB 0 0x05 0x0000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
-    response = execute_acpi_command(acpi_command_parts)
+    """
+    Retrieves and prints the current fan curve.
+
+    Returns:
+        tuple: (fan_speeds, temperatures), or None if the fan curve could not be read.
+    """
+    response = execute_acpi_command([wmi_codec.GET_FAN_TABLE_COMMAND])
 
     if response:
         try:
-            hex_data = response[response.find('{')+1:response.find('}')]
-            hex_values = hex_data.split(', ')
-
-            # Convert hex values to integers, handling trailing commas
-            fan_speed_values = [int(val.split(',')[0].strip(), 16) for val in hex_values if val.strip()]
-
-            # Skip the first value (indicating starting temperature step) and padding values
-            fan_speed_values = fan_speed_values[4:]  # Start from the first actual fan speed value
+            fan_speeds, temperatures = wmi_codec.decode_fan_table(response)
 
             formatted_output = "Fan Curve:\n"
-
-            # Process the data assuming the pattern: 0x00, 0x00, 0x00, fan speed
-            for i in range(0, len(fan_speed_values), 4):
-                temperature = 10 + (i // 4) * 10  # Increment temperature by 10°C starting from 10°C
-                speed = fan_speed_values[i]  # Fan speed is the first value in each group of four
+            for temperature, speed in zip(temperatures, fan_speeds):
                 formatted_output += f"Temperature {temperature}°C: Fan Speed {speed}%\n"
 
-
-
             logging.info("Fan Curve Data Retrieved:")
             print(formatted_output)
+            state_cache.get_cache().update('fan_table', tuple(fan_speeds))
+            return fan_speeds, temperatures
 
-        except Exception as e:
+        except (wmi_codec.WmiDecodeError, IndexError) as e:
             logging.error(f"Error parsing fan curve: {e}")
     
     else:
         logging.error("Failed to retrieve fan curve data.")
+    return None
 
 def set_full_speed(state):
     """
@@ -131,11 +118,11 @@ def set_full_speed(state):
     """
     if state == 1:
         logging.info("Setting fan speed to 100%")
-        command = ["echo '\\_SB.GZFD.WMAE 0 0x12 0x0104020100' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
     else:
         logging.info("Setting fan speed to fan curve value.")
-        command = ["echo '\\_SB.GZFD.WMAE 0 0x12 0x0004020000' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
-    return execute_acpi_command(command)
+    value = 1 if state == 1 else 0
+    command = [wmi_codec.encode_set_feature('full_fan_speed', value)]
+    return state_cache.get_cache().write_through('full_fan_speed', value, lambda: execute_acpi_command(command))
 
 def set_smart_fan_mode(mode_value):
     """
@@ -153,28 +140,38 @@ def set_smart_fan_mode(mode_value):
     Returns:
         str: The result of the operation, or an error message if the operation fails.
     """
-    valid_modes = [1, 2,3, 224, 255]
+    valid_modes = list(wmi_codec.SMART_FAN_MODES)
     if mode_value not in valid_modes:
         logging.error(f"Invalid mode_value. Must be one of {valid_modes}.")
         return "Invalid mode_value provided."
     # Construct and execute the ACPI command
-    command = ["echo '\\_SB.GZFD.WMAA 0 0x2C {mode_value}' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call".format(mode_value=mode_value)]
-    return execute_acpi_command(command)
+    command = [wmi_codec.encode_set_smart_fan_mode(mode_value)]
+    cache = state_cache.get_cache()
+    output = cache.write_through('smart_fan_mode', mode_value, lambda: execute_acpi_command(command))
+    if output != state_cache.UNCHANGED:
+        # Switching modes reconfigures the platform, do not trust the cached TDP values and fan table
+        for feature in wmi_codec.TDP_FEATURES.values():
+            cache.invalidate(feature)
+        cache.invalidate('fan_table')
+    return output
 
 def get_smart_fan_mode():
     """
     Get the current Smart Fan Mode of the system.
 
     Returns:
-        str: The result of the operation, or an error message if the operation fails.
+        int: The current Smart Fan Mode, or None if the operation fails.
     """
-    # Construct and execute the ACPI command
-    command = ["echo '\\_SB.GZFD.WMAA 0 0x2D' | sudo tee /proc/acpi/call; sudo cat /proc/acpi/call"]
-    output = execute_acpi_command(command)
-    first_newline_position = output.find('\n')
-    output = output[first_newline_position+1:first_newline_position+6]
-    logging.info(f"Current Smart Fan Mode: {output}")
-    return output
+    output = execute_acpi_command([wmi_codec.GET_SMART_FAN_MODE_COMMAND])
+    if output is None:
+        return None
+    try:
+        mode_value = wmi_codec.decode_int(output)
+    except wmi_codec.WmiDecodeError as e:
+        logging.error(f"Failed to parse Smart Fan Mode: {e}")
+        return None
+    logging.info(f"Current Smart Fan Mode: {mode_value} ({wmi_codec.SMART_FAN_MODES.get(mode_value, 'Unknown')})")
+    return mode_value
 
 def main():
     parser = argparse.ArgumentParser(description='Legion Go Control Script')
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Host side RGB animations for the Legion Go controllers.
+
+Description:
+    create_rgb_control_command only sets one static mode/colour. This streams a solid colour
+    per frame to both controllers over the shared LegionController handle, at a fixed frame rate.
+
+    The colours come from precomputed tables (PALETTE_SIZE entries of 3 bytes, built once from
+    the PALETTES gradient stops), a frame only picks a table index and copies 3 bytes into a
+    preallocated hid_reports template per controller, then sends both reports in one batch.
+
+    FrameScheduler keeps frames on a fixed grid: a frame that starts late is measured as jitter,
+    frames whose slot already passed are dropped instead of being sent late.
+
+Animations:
+    cycle       Both controllers run through the palette.
+    wave        Same, the right controller half a palette behind.
+    breathe     Slow colour cycle with the brightness pulsing.
+    fan         Palette position follows the fan speed (FAN_SPEED_RANGE rpm), read every --sync_interval.
+    temperature Palette position follows the CPU temperature (TEMPERATURE_RANGE °C).
+
+Usage:
+    ./rgb_animation.py --animation wave --palette rainbow --fps 30
+    ./rgb_animation.py --animation temperature --palette heat
+    ./rgb_animation.py --fake --duration 10    # Fake HID and ACPI backends, prints the frame statistics
+"""
+
+import argparse
+import collections
+import colorsys
+import logging
+import math
+import time
+
+import legion_configurator
+from hid_reports import ReportTemplate
+
+CONTROLLERS = (0x03, 0x04)  # Left, right
+PALETTE_SIZE = 256
+# Gradient stops, evenly spaced and wrapping around so cycles have no seam
+PALETTES = {
+    'fire': ('FF0000', 'FF6000', 'FFC000', 'FF6000'),
+    'ocean': ('0010FF', '00A0FF', '00FFC0', '00A0FF'),
+    'heat': ('0000FF', '00FF00', 'FFFF00', 'FF0000'),
+    'white': ('FFFFFF',),
+}
+# Gradients that map a level instead of cycling, their last stop is not wrapped to the first
+LEVEL_PALETTES = ('heat',)
+
+FAN_SPEED_RANGE = (0, 5000)
+TEMPERATURE_RANGE = (40, 90)
+# Fraction of the distance to a new fan/temperature level covered per frame
+LEVEL_SMOOTHING = 0.05
+RGB_MODE_SOLID = 0x01
+RGB_SPEED = 50
+RGB_PROFILE = 0x01
+# Frames kept for the jitter percentile
+JITTER_WINDOW = 1000
+
+
+def gradient_table(stops, size=PALETTE_SIZE, wrap=True):
+    """
+    Interpolates the RRGGBB stops into a colour table.
+
+    Args:
+        stops (tuple): Hex colours, evenly spaced.
+        size (int): Number of entries.
+        wrap (bool): Interpolate from the last stop back to the first.
+
+    Returns:
+        list: bytes of 3 (R, G, B) per entry.
+    """
+    colors = [bytes.fromhex(stop) for stop in stops]
+    segments = len(colors) if wrap else max(len(colors) - 1, 1)
+    table = []
+    for index in range(size):
+        position = index * segments / (size if wrap else size - 1)
+        start = min(int(position), segments - 1)
+        fraction = position - start
+        first, second = colors[start % len(colors)], colors[(start + 1) % len(colors)]
+        table.append(bytes(round(a + (b - a) * fraction) for a, b in zip(first, second)))
+    return table
+
+
+def palette_table(name, size=PALETTE_SIZE):
+    if name == 'rainbow':
+        return [bytes(round(channel * 255) for channel in colorsys.hsv_to_rgb(index / size, 1.0, 1.0)) for index in range(size)]
+    return gradient_table(PALETTES[name], size, wrap=name not in LEVEL_PALETTES)
+
+
+def breathe_table(brightness, size=PALETTE_SIZE):
+    """
+    Brightness per step of one breath, from 10% to the given brightness.
+    """
+    low = brightness // 10
+    return bytes(round(low + (brightness - low) * (1 - math.cos(2 * math.pi * index / size)) / 2) for index in range(size))
+
+
+class FrameScheduler:
+    """
+    Fixed rate frame clock that drops frames instead of falling behind.
+
+    Args:
+        fps (float): Frames per second.
+        clock (callable): Monotonic time.
+        sleep (callable): Sleeps for seconds.
+    """
+
+    def __init__(self, fps, clock=time.monotonic, sleep=time.sleep):
+        self.period = 1 / fps
+        self.clock = clock
+        self.sleep = sleep
+        self.start = clock()
+        self.frame = 0
+        self.frames = 0
+        self.dropped = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.jitter = collections.deque(maxlen=JITTER_WINDOW)
+
+    def wait(self):
+        """
+        Sleeps until the next frame slot. Slots that already passed are dropped.
+
+        Returns:
+            float: The frame time, seconds since start on the frame grid.
+        """
+        now = self.clock()
+        slot = int((now - self.start) / self.period)
+        if slot > self.frame:
+            self.dropped += slot - self.frame
+            self.frame = slot
+        deadline = self.start + self.frame * self.period
+        if now < deadline:
+            self.sleep(deadline - now)
+            now = self.clock()
+        late = now - deadline
+        self.frames += 1
+        self.jitter_sum += late
+        self.jitter_max = max(self.jitter_max, late)
+        self.jitter.append(late)
+        frame_time = self.frame * self.period
+        self.frame += 1
+        return frame_time
+
+    def stats(self):
+        recent = sorted(self.jitter)
+        p99 = recent[min(len(recent) - 1, int(len(recent) * 0.99))] if recent else 0.0
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'jitter_mean_ms': self.jitter_sum / self.frames * 1000 if self.frames else 0.0,
+            'jitter_p99_ms': p99 * 1000,
+            'jitter_max_ms': self.jitter_max * 1000,
+        }
+
+
+class StatusLevel:
+    """
+    A fan speed or temperature from status_snapshot, scaled to 0-1 and refreshed every interval.
+
+    Args:
+        field (str): 'fan_speed' or 'cpu_temperature'.
+        value_range (tuple): Values mapped to 0 and 1.
+        interval (float): Seconds between reads.
+        clock (callable): Monotonic time.
+    """
+
+    def __init__(self, field, value_range, interval=1.0, clock=time.monotonic):
+        import status_snapshot
+        self.status_snapshot = status_snapshot
+        self.reads = tuple(read for read in status_snapshot.STATUS_READS if read.name == field)
+        self.field = field
+        self.low, self.high = value_range
+        self.interval = interval
+        self.clock = clock
+        self.level = 0.0
+        self.next_read = 0.0
+
+    def read(self):
+        now = self.clock()
+        if now >= self.next_read:
+            self.next_read = now + self.interval
+            try:
+                value = getattr(self.status_snapshot.read_status_snapshot(self.reads), self.field)
+            except OSError as e:
+                logging.warning(f"Failed to read {self.field}: {e}")
+                value = None
+            if value is not None:
+                self.level = min(max((value - self.low) / (self.high - self.low), 0.0), 1.0)
+        return self.level
+
+
+class RgbAnimation:
+    """
+    Streams one animation to both controllers.
+
+    Args:
+        controller (LegionController): The HID session.
+        animation (str): One of the names in the module docstring.
+        palette (str): 'rainbow' or a PALETTES key.
+        fps (float): Frame rate.
+        period (float): Seconds per palette cycle.
+        brightness (int): LED brightness, 0-100.
+        level (StatusLevel): Source of the fan/temperature animations.
+        clock (callable): Monotonic time.
+        sleep (callable): Sleeps for seconds.
+    """
+
+    def __init__(self, controller, animation='cycle', palette='rainbow', fps=30.0, period=5.0, brightness=100,
+                 level=None, clock=time.monotonic, sleep=time.sleep):
+        if animation in ('fan', 'temperature') and level is None:
+            raise ValueError(f"The {animation} animation needs a level source")
+        self.controller = controller
+        self.animation = animation
+        self.period = period
+        self.level = level
+        self.smoothed_level = None
+        self.colors = palette_table(palette)
+        self.brightness = breathe_table(brightness) if animation == 'breathe' else bytes([brightness]) * PALETTE_SIZE
+        self.scheduler = FrameScheduler(fps, clock, sleep)
+        # One template per controller so both reports of a frame stay valid in the same batch
+        self.reports = []
+        for controller_byte in CONTROLLERS:
+            template = ReportTemplate('rgb_control')
+            template.build(controller_byte, RGB_MODE_SOLID, 0, 0, 0, brightness, RGB_SPEED, RGB_PROFILE)
+            self.reports.append(template)
+        self.color_offset = self.reports[0].offsets['red']
+        self.brightness_offset = self.reports[0].offsets['brightness']
+
+    def indices(self, frame_time):
+        """
+        Returns:
+            tuple: Palette index of the left and right controller, brightness index.
+        """
+        position = int(frame_time / self.period * PALETTE_SIZE)
+        if self.animation in ('fan', 'temperature'):
+            level = self.level.read()
+            if self.smoothed_level is None:
+                self.smoothed_level = level
+            self.smoothed_level += (level - self.smoothed_level) * LEVEL_SMOOTHING
+            index = round(self.smoothed_level * (PALETTE_SIZE - 1))
+            return index, index, 0
+        if self.animation == 'wave':
+            return position % PALETTE_SIZE, (position + PALETTE_SIZE // 2) % PALETTE_SIZE, 0
+        if self.animation == 'breathe':
+            return position // 4 % PALETTE_SIZE, position // 4 % PALETTE_SIZE, position % PALETTE_SIZE
+        return position % PALETTE_SIZE, position % PALETTE_SIZE, 0
+
+    def frame(self, frame_time):
+        """
+        Builds and sends the reports of one frame.
+        """
+        *colors, brightness_index = self.indices(frame_time)
+        for template, color_index in zip(self.reports, colors):
+            template.buffer[self.color_offset:self.color_offset + 3] = self.colors[color_index]
+            template.buffer[self.brightness_offset] = self.brightness[brightness_index]
+        self.controller.send_many([template.view for template in self.reports])
+
+    def run(self, duration=None):
+        """
+        Streams frames until duration seconds passed (forever if None).
+
+        Returns:
+            dict: The frame statistics and the CPU usage in %.
+
+        Raises:
+            OSError: If the controllers are gone for good.
+        """
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        try:
+            while duration is None or self.scheduler.frame * self.scheduler.period < duration:
+                self.frame(self.scheduler.wait())
+        except KeyboardInterrupt:
+            pass
+        wall_time = time.monotonic() - wall_start
+        stats = self.scheduler.stats()
+        stats['cpu_percent'] = (time.process_time() - cpu_start) / wall_time * 100 if wall_time else 0.0
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream RGB animations to the Legion Go controllers')
+    parser.add_argument('--animation', choices=('cycle', 'wave', 'breathe', 'fan', 'temperature'), default='cycle')
+    parser.add_argument('--palette', choices=('rainbow',) + tuple(PALETTES), default=None,
+                        help='Colour table, rainbow by default and heat for fan/temperature.')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frames per second.')
+    parser.add_argument('--period', type=float, default=5.0, help='Seconds per palette cycle.')
+    parser.add_argument('--brightness', type=int, choices=range(101), default=100, metavar='0-100')
+    parser.add_argument('--duration', type=float, default=None, help='Seconds to run, until Ctrl+C by default.')
+    parser.add_argument('--sync_interval', type=float, default=1.0, help='Seconds between fan/temperature reads.')
+    parser.add_argument('--fake', action='store_true', help='Fake HID and ACPI backends, no hardware needed.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Fake HID seconds per report.')
+    args = parser.parse_args()
+
+    backend = None
+    if args.fake:
+        import acpi_transport
+        import fake_acpi_call
+        import fake_hid
+        backend = fake_hid.FakeHidBackend(latency=args.latency)
+        acpi_transport.set_transport(fake_acpi_call.FakeAcpiCall())
+    level = None
+    if args.animation == 'fan':
+        level = StatusLevel('fan_speed', FAN_SPEED_RANGE, args.sync_interval)
+    elif args.animation == 'temperature':
+        level = StatusLevel('cpu_temperature', TEMPERATURE_RANGE, args.sync_interval)
+    palette = args.palette or ('heat' if level else 'rainbow')
+
+    animation = RgbAnimation(legion_configurator.get_controller(backend), args.animation, palette, args.fps,
+                             args.period, args.brightness, level)
+    try:
+        stats = animation.run(args.duration)
+    except OSError as e:
+        logging.error(f"Animation stopped: {e}")
+        raise SystemExit(1)
+    logging.info(f"Frames: {stats['frames']}, dropped: {stats['dropped']}, "
+                 f"jitter mean: {stats['jitter_mean_ms']:.2f} ms, p99: {stats['jitter_p99_ms']:.2f} ms, "
+                 f"max: {stats['jitter_max_ms']:.2f} ms, CPU: {stats['cpu_percent']:.1f}%")
+    logging.info(f"HID session: {animation.controller.stats}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Streaming sensor statistics for adaptive_brightness.
+
+Description:
+    Constant time filters for the ALS readings, replacing the list that run_main_loop appended
+    to, sliced and summed on every tick:
+
+    - MovingAverage:       fixed size ring buffer with a running sum
+    - ExponentialAverage:  EMA, no buffer at all
+    - MedianFilter:        median of the last N readings, drops single sample spikes
+
+    StabilityDetector holds the stability/cooldown state machine that used to be inlined in
+    run_main_loop: once the filtered value stayed within the threshold for stability_duration
+    seconds, the cooldown between adjustments doubles up to max_cooldown.
+
+Usage:
+    ./sensor_filter.py --benchmark 1000000
+"""
+
+import argparse
+import bisect
+import time
+from collections import deque
+
+# Recompute the running sum every this many passes over the buffer, keeps float rounding from drifting
+RESUM_LAPS = 1024
+
+MAX_COOLDOWN = 30
+
+
+class MovingAverage:
+    """
+    Average of the last `size` values.
+
+    Args:
+        size (int): Number of values to average over.
+    """
+
+    __slots__ = ('size', '_buffer', '_index', '_count', '_sum', '_laps')
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        # Preallocated, a list indexes faster than an array of doubles
+        self._buffer = [0] * size
+        self._index = 0
+        self._count = 0
+        self._sum = 0
+        self._laps = 0
+
+    def update(self, value):
+        """
+        Adds a value and returns the average.
+        """
+        buffer = self._buffer
+        index = self._index
+        if self._count == self.size:
+            self._sum += value - buffer[index]
+        else:
+            self._count += 1
+            self._sum += value
+        buffer[index] = value
+        index += 1
+        if index == self.size:
+            index = 0
+            self._laps += 1
+            if self._laps % RESUM_LAPS == 0:
+                self._sum = sum(buffer)
+        self._index = index
+        return self._sum / self._count
+
+    @property
+    def value(self):
+        return self._sum / self._count if self._count else None
+
+    def reset(self):
+        self._index = 0
+        self._count = 0
+        self._sum = 0
+        self._laps = 0
+
+
+class ExponentialAverage:
+    """
+    Exponential moving average, the first value is taken as is.
+
+    Args:
+        alpha (float): Weight of the newest value, in (0, 1].
+    """
+
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = float(value)
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class MedianFilter:
+    """
+    Median of the last `size` values.
+
+    Args:
+        size (int): Window size, odd sizes give a true median.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self._window = deque()
+        self._sorted = []
+
+    def update(self, value):
+        """
+        Adds a value and returns the median of the window.
+        """
+        if len(self._window) == self.size:
+            oldest = self._window.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._window.append(value)
+        bisect.insort(self._sorted, value)
+        return self._sorted[len(self._sorted) // 2]
+
+    def reset(self):
+        self._window.clear()
+        self._sorted.clear()
+
+
+class StabilityDetector:
+    """
+    Decides whether a filtered value is worth acting on and how long to wait for the next one.
+
+    The value is stable while it stays within threshold of the last value that moved. A change
+    resets the cooldown to 1 second, once the value was stable for duration seconds the cooldown
+    doubles on every update up to max_cooldown and adjustments stop until the value moves again.
+
+    Args:
+        threshold (float): Largest change still considered stable.
+        duration (float): Seconds the value has to be stable before backing off.
+        max_cooldown (float): Longest cooldown, in seconds.
+        clock (callable): Monotonic clock in seconds.
+    """
+
+    def __init__(self, threshold, duration, max_cooldown=MAX_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.duration = duration
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.stable_value = None
+        self.last_change_time = clock()
+        self.cooldown = 1
+
+    def update(self, value):
+        """
+        Returns:
+            bool: True if the brightness should be adjusted for this value.
+        """
+        now = self.clock()
+        if self.stable_value is None or abs(value - self.stable_value) > self.threshold:
+            self.stable_value = value
+            self.last_change_time = now
+            self.cooldown = 1
+        elif now - self.last_change_time >= self.duration:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        return self.cooldown == 1 or now - self.last_change_time < self.duration
+
+    def hold(self, value):
+        """
+        Treats value as stable for long enough already, so nothing is adjusted until the value
+        moves past the threshold. Used when the brightness was changed by hand.
+        """
+        if value is not None:
+            self.stable_value = value
+        self.last_change_time = self.clock() - self.duration
+        self.cooldown = self.max_cooldown
+
+    @property
+    def stable_for(self):
+        return self.clock() - self.last_change_time
+
+    def reset(self):
+        self.stable_value = None
+        self.cooldown = 1
+
+
+class SensorFilter:
+    """
+    Median filter (optional), then a moving average or an EMA, then the stability detector.
+
+    Args:
+        num_readings (int): Moving average window.
+        stability_threshold (float): See StabilityDetector.
+        stability_duration (float): See StabilityDetector.
+        ema_alpha (float): Use an EMA with this weight instead of the moving average.
+        median_size (int): Median filter window, 0 or 1 to disable.
+        clock (callable): Monotonic clock in seconds.
+    """
+
+    def __init__(self, num_readings, stability_threshold, stability_duration, ema_alpha=None, median_size=0, clock=time.monotonic):
+        self.median = MedianFilter(median_size) if median_size > 1 else None
+        self.average = ExponentialAverage(ema_alpha) if ema_alpha else MovingAverage(num_readings)
+        self.stability = StabilityDetector(stability_threshold, stability_duration, clock=clock)
+        self.value = None
+
+    def update(self, reading):
+        """
+        Returns:
+            tuple: (filtered value, whether to adjust the brightness)
+        """
+        if self.median is not None:
+            reading = self.median.update(reading)
+        self.value = self.average.update(reading)
+        return self.value, self.stability.update(self.value)
+
+    def update_many(self, readings):
+        """
+        Feeds a batch of readings (i.e. from the IIO buffer) through the filters and runs the
+        stability detector once on the result.
+
+        The batch is everything that arrived during one cooldown, so it enters the average as
+        its mean: the window stays num_readings cooldowns long whatever the sensor's rate.
+        The median filter still sees every reading, it is there to drop single sample spikes.
+
+        Returns:
+            tuple: (filtered value, whether to adjust the brightness)
+        """
+        median = self.median
+        if median is not None:
+            readings = [median.update(reading) for reading in readings]
+        self.value = self.average.update(sum(readings) / len(readings))
+        return self.value, self.stability.update(self.value)
+
+    @property
+    def cooldown(self):
+        return self.stability.cooldown
+
+    def reset(self):
+        if self.median is not None:
+            self.median.reset()
+        self.average.reset()
+        self.stability.reset()
+
+
+def benchmark(samples, num_readings=10):
+    readings = [(index * 7919) % 2753 for index in range(samples)]
+
+    start = time.perf_counter()
+    window = []
+    for reading in readings:
+        window.append(reading)
+        window = window[-num_readings:]
+        sum(window) / len(window)
+    list_time = time.perf_counter() - start
+
+    filters = {
+        'MovingAverage': MovingAverage(num_readings),
+        'ExponentialAverage': ExponentialAverage(0.2),
+        'MedianFilter(5)': MedianFilter(5),
+    }
+    print(f"Samples: {samples}, window: {num_readings}")
+    print(f"{'list slice + sum':>24}: {list_time / samples * 1e9:.0f} ns/sample")
+    for name, sample_filter in filters.items():
+        update = sample_filter.update
+        start = time.perf_counter()
+        for reading in readings:
+            update(reading)
+        print(f"{name:>24}: {(time.perf_counter() - start) / samples * 1e9:.0f} ns/sample")
+
+    sensor_filter = SensorFilter(num_readings, 5, 60, median_size=3)
+    start = time.perf_counter()
+    for reading in readings:
+        sensor_filter.update(reading)
+    print(f"{'SensorFilter (full)':>24}: {(time.perf_counter() - start) / samples * 1e9:.0f} ns/sample")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming sensor statistics')
+    parser.add_argument('--benchmark', type=int, metavar='N', default=1000000, help='Number of samples to time.')
+    parser.add_argument('--num_readings', type=int, default=10, help='Moving average window.')
+    args = parser.parse_args()
+    benchmark(args.benchmark, args.num_readings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Device state cache for the Legion Go.
+
+Description:
+    Remembers the last value read from or written to a device setting, so writes of a value
+    the firmware (or sysfs) already holds can be dropped. ACPI settings are keyed by their
+    wmi_codec feature name (i.e. 'steady_tdp', 'full_fan_speed'), sysfs settings by their path.
+    Settings in UNCACHED_KEYS change behind the scripts' back and are always written.
+
+    The cache is cleared when the system resumed from suspend (CLOCK_BOOTTIME moved ahead of
+    CLOCK_MONOTONIC), when the AC adapter was plugged in or out, or when invalidate() is called.
+    The firmware resets some values on those events, i.e. the TDP limits depend on ADPT.
+
+    Hits, misses and suppressed writes are counted, see CacheStats.
+"""
+
+import logging
+import threading
+import time
+
+AC_ONLINE_PATH = '/sys/class/power_supply/ACAD/online'
+
+# Time spent in suspend only shows up in CLOCK_BOOTTIME
+_HAS_BOOTTIME = hasattr(time, 'CLOCK_BOOTTIME')
+
+# Ignore clock drift below this when looking for a suspend, in seconds
+SUSPEND_DETECTION_THRESHOLD = 1.0
+
+# Re-read the AC status at most this often, in seconds
+AC_CHECK_INTERVAL = 1.0
+
+MISSING = object()
+
+# Returned by write_through when the write was dropped
+UNCHANGED = 'Unchanged'
+
+# Never cached: Legion L + Y switches the smart fan mode without going through these scripts,
+# see wmi_interface.md
+UNCACHED_KEYS = frozenset({'smart_fan_mode'})
+
+
+def _suspended_time():
+    if not _HAS_BOOTTIME:
+        return 0.0
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - time.monotonic()
+
+
+class CacheStats:
+    """
+    Cache counters since the cache was created.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.suppressed_writes = 0
+        self.invalidations = 0
+        self.start_time = time.monotonic()
+
+    def per_hour(self, count):
+        hours = (time.monotonic() - self.start_time) / 3600
+        return count / hours if hours > 0 else 0.0
+
+    def __str__(self):
+        return (f"hits: {self.hits}, misses: {self.misses}, writes: {self.writes}, "
+                f"suppressed writes: {self.suppressed_writes} ({self.per_hour(self.suppressed_writes):.1f}/h), "
+                f"invalidations: {self.invalidations}")
+
+
+class DeviceStateCache:
+    """
+    Write-through cache of device settings.
+
+    Args:
+        ac_online_path (str): AC adapter status file, None to not watch AC plug events.
+    """
+
+    def __init__(self, ac_online_path=AC_ONLINE_PATH):
+        self.ac_online_path = ac_online_path
+        self.stats = CacheStats()
+        self._values = {}
+        self._lock = threading.Lock()
+        self._suspended_time = _suspended_time()
+        self._ac_online = self._read_ac_online()
+        self._ac_checked = time.monotonic()
+
+    def _read_ac_online(self):
+        if not self.ac_online_path:
+            return None
+        try:
+            with open(self.ac_online_path, 'r') as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    def _check_events(self):
+        # Called with the lock held
+        suspended_time = _suspended_time()
+        if suspended_time - self._suspended_time > SUSPEND_DETECTION_THRESHOLD:
+            logging.debug("Resume from suspend detected, clearing the device state cache.")
+            self._clear()
+        self._suspended_time = suspended_time
+
+        now = time.monotonic()
+        if now - self._ac_checked < AC_CHECK_INTERVAL:
+            return
+        self._ac_checked = now
+        ac_online = self._read_ac_online()
+        if ac_online != self._ac_online:
+            logging.debug(f"AC status changed ({self._ac_online} -> {ac_online}), clearing the device state cache.")
+            self._clear()
+        self._ac_online = ac_online
+
+    def _clear(self):
+        if self._values:
+            self._values.clear()
+            self.stats.invalidations += 1
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or MISSING.
+        """
+        with self._lock:
+            self._check_events()
+            value = self._values.get(key, MISSING)
+            if value is MISSING:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            return value
+
+    def update(self, key, value):
+        """
+        Records a value that was just read from or written to the device.
+        """
+        if key in UNCACHED_KEYS:
+            return
+        with self._lock:
+            self._values[key] = value
+
+    def record_write(self, key, value):
+        """
+        Records a value that was just written to the device and counts the write.
+        """
+        self.update(key, value)
+        with self._lock:
+            self.stats.writes += 1
+
+    def should_write(self, key, value):
+        """
+        Checks whether value needs to be written, counts the miss or the suppressed write.
+        Call record_write() once the write succeeded.
+
+        Returns:
+            bool: False if the device is known to hold value already.
+        """
+        with self._lock:
+            self._check_events()
+            if self._values.get(key, MISSING) == value:
+                self.stats.hits += 1
+                self.stats.suppressed_writes += 1
+                return False
+            self.stats.misses += 1
+            return True
+
+    def write_through(self, key, value, write):
+        """
+        Runs write() unless the device already holds value, and records value if it succeeded.
+
+        Args:
+            key (str): The setting, a wmi_codec feature name or a sysfs path.
+            value: The value being written.
+            write (callable): Does the write, returns None or False on failure.
+
+        Returns:
+            The result of write(), or UNCHANGED if the write was dropped.
+        """
+        if not self.should_write(key, value):
+            logging.debug(f"Skipping write of {key}, already {value}.")
+            return UNCHANGED
+        result = write()
+        if result is not None and result is not False:
+            self.record_write(key, value)
+        return result
+
+    def invalidate(self, key=None):
+        """
+        Forgets one key, or everything when key is None, i.e. after an explicit refresh.
+        """
+        with self._lock:
+            if key is None:
+                self._clear()
+            elif self._values.pop(key, MISSING) is not MISSING:
+                self.stats.invalidations += 1
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process wide device state cache.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = DeviceStateCache()
+        return _default_cache
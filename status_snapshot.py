@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Batched status reads for the Legion Go.
+
+Description:
+    Reads fan speed, temperatures, Smart Fan Mode, power button lighting and the custom TDP
+    values in one batch over the shared ACPI transport, instead of one call (and, before the
+    in-process transport, one shell pipeline) per value.
+
+    read_status_snapshot() returns a StatusSnapshot with the decoded values, the time spent
+    on each read and the total time of the batch.
+
+Usage:
+    ./status_snapshot.py                      # One snapshot
+    ./status_snapshot.py --rate 10 --count 50 # 10 Hz refresh, prints the timings
+"""
+
+import argparse
+import logging
+import time
+from collections import namedtuple
+
+import acpi_transport
+import state_cache
+import wmi_codec
+
+StatusRead = namedtuple('StatusRead', ['name', 'command', 'decode'])
+
+
+def _decode_lighting(response):
+    value = wmi_codec.decode_response(response)
+    return tuple(value) if isinstance(value, (bytes, bytearray)) else value
+
+
+# Settings the device state cache tracks, values read here refresh it
+CACHED_FIELDS = ('full_fan_speed', 'slow_tdp', 'steady_tdp', 'fast_tdp')
+
+# The reads the Legacy status screen shows, in the order they are issued
+STATUS_READS = (
+    StatusRead('fan_speed', wmi_codec.encode_get_feature('fan_speed'), wmi_codec.decode_int),
+    StatusRead('cpu_temperature', wmi_codec.encode_get_feature('cpu_temperature'), wmi_codec.decode_int),
+    StatusRead('gpu_temperature', wmi_codec.encode_get_feature('gpu_temperature'), wmi_codec.decode_int),
+    StatusRead('smart_fan_mode', wmi_codec.GET_SMART_FAN_MODE_COMMAND, wmi_codec.decode_int),
+    StatusRead('full_fan_speed', wmi_codec.encode_get_feature('full_fan_speed'), wmi_codec.decode_int),
+    StatusRead('power_button_lighting', wmi_codec.encode_get_lighting(wmi_codec.LIGHTING_POWER_BUTTON), _decode_lighting),
+    StatusRead('slow_tdp', wmi_codec.encode_get_feature('slow_tdp'), wmi_codec.decode_int),
+    StatusRead('steady_tdp', wmi_codec.encode_get_feature('steady_tdp'), wmi_codec.decode_int),
+    StatusRead('fast_tdp', wmi_codec.encode_get_feature('fast_tdp'), wmi_codec.decode_int),
+)
+STATUS_FIELDS = tuple(read.name for read in STATUS_READS)
+
+_StatusSnapshotBase = namedtuple('StatusSnapshot', STATUS_FIELDS + ('latencies', 'total_time', 'timestamp'))
+
+
+class StatusSnapshot(_StatusSnapshotBase):
+    """
+    One status refresh. Values that were not read or failed to decode are None.
+    latencies maps each read name to its time in seconds, total_time covers the whole batch.
+    """
+    __slots__ = ()
+
+    def format_timings(self):
+        per_read = ', '.join(f"{name}: {elapsed * 1000:.2f}" for name, elapsed in self.latencies.items())
+        return f"Total: {self.total_time * 1000:.2f} ms ({per_read})"
+
+
+def read_status_snapshot(reads=STATUS_READS, transport=None):
+    """
+    Runs the given reads as one batch and decodes the responses.
+
+    Args:
+        reads (tuple): StatusRead entries, their names must be StatusSnapshot fields.
+        transport: The ACPI transport, defaults to acpi_transport.get_transport().
+
+    Returns:
+        StatusSnapshot: The decoded values and timings.
+
+    Raises:
+        AcpiCallError: If the batch could not be run.
+    """
+    transport = transport or acpi_transport.get_transport()
+    start = time.perf_counter()
+    results = transport.call_batch([read.command for read in reads])
+    total_time = time.perf_counter() - start
+
+    cache = state_cache.get_cache()
+    values = dict.fromkeys(STATUS_FIELDS)
+    latencies = {}
+    for read, (response, elapsed) in zip(reads, results):
+        latencies[read.name] = elapsed
+        try:
+            values[read.name] = read.decode(response)
+        except wmi_codec.WmiDecodeError as e:
+            logging.debug(f"Failed to decode {read.name}: {e}")
+            continue
+        if read.name in CACHED_FIELDS:
+            cache.update(read.name, values[read.name])
+    return StatusSnapshot(latencies=latencies, total_time=total_time, timestamp=time.time(), **values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go status snapshot')
+    parser.add_argument('--rate', type=float, default=1.0, help='Snapshots per second.')
+    parser.add_argument('--count', type=int, default=1, help='Number of snapshots to take.')
+    parser.add_argument('--fake', action='store_true', help='Read from a fake /proc/acpi/call, no hardware needed.')
+    args = parser.parse_args()
+
+    if args.fake:
+        import fake_acpi_call
+        acpi_transport.set_transport(fake_acpi_call.FakeAcpiCall())
+
+    total_times = []
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    for index in range(args.count):
+        snapshot = read_status_snapshot()
+        total_times.append(snapshot.total_time)
+        print(' | '.join(f"{name}: {getattr(snapshot, name)}" for name in STATUS_FIELDS))
+        print(snapshot.format_timings())
+        if index + 1 < args.count:
+            time.sleep(max(0.0, 1 / args.rate - snapshot.total_time))
+    wall_time = time.monotonic() - wall_start
+
+    if args.count > 1:
+        print(f"Snapshots: {args.count}, avg: {sum(total_times) / len(total_times) * 1000:.2f} ms, "
+              f"max: {max(total_times) * 1000:.2f} ms, CPU: {(time.process_time() - cpu_start) / wall_time * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+File and sysfs change notifications for selector based loops.
+
+Description:
+    Both watchers have a fileno() that becomes readable when something changed, so they can be
+    registered with a selectors selector next to sockets and device nodes, no polling needed.
+
+    - FileWatch:            a file being created or removed, i.e. a flag file in /tmp (inotify)
+    - PatternWatch:         any file matching a glob being created or removed, i.e. a new log
+    - SysfsAttributeWatch:  sysfs_notify() on an attribute, i.e. a backlight's actual_brightness
+                            after a brightness key press. sysfs signals it with POLLPRI, which
+                            the selectors API can not ask for, so the attribute sits in its own
+                            epoll instance and that instance's fd is what the selector watches.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import logging
+import os
+import select
+import struct
+
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    return _libc
+
+
+class FileWatch:
+    """
+    Notices a file being created, removed or renamed, by watching its directory with inotify.
+
+    Args:
+        path (str): The file to watch, it does not need to exist.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        libc = _get_libc()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        if libc.inotify_add_watch(self._fd, os.fsencode(os.path.dirname(path) or '.'), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"inotify_add_watch failed for {path}: {os.strerror(error)}")
+
+    def fileno(self):
+        return self._fd
+
+    def read_events(self):
+        """
+        Drains the pending events.
+
+        Returns:
+            bool: True if one of them was about the watched file.
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0')
+                changed = changed or self._matches(name)
+                offset += _EVENT_HEADER.size + length
+
+    def _matches(self, name):
+        return name == self.name
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PatternWatch(FileWatch):
+    """
+    FileWatch for every file of a directory matching a glob, i.e. /home/deck/*.csv.
+
+    Raises:
+        OSError: If inotify is not available or the directory does not exist.
+    """
+
+    def _matches(self, name):
+        return fnmatch.fnmatchcase(name, self.name)
+
+    def exists(self):
+        return bool(glob.glob(self.path))
+
+
+class SysfsAttributeWatch:
+    """
+    Notices sysfs_notify() on an attribute.
+
+    Args:
+        path (str): The sysfs attribute.
+
+    Raises:
+        OSError: If the attribute can not be opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._epoll = select.epoll()
+        self._epoll.register(self._fd, select.EPOLLPRI | select.EPOLLERR)
+        # The first read arms the notification
+        self.read()
+
+    def fileno(self):
+        return self._epoll.fileno()
+
+    def read(self):
+        """
+        Returns the attribute's content and re-arms the notification.
+        """
+        return os.pread(self._fd, 4096, 0).decode().strip()
+
+    def consume(self):
+        """
+        Clears the pending notification.
+
+        Returns:
+            str: The attribute's content.
+        """
+        self._epoll.poll(0)
+        return self.read()
+
+    def close(self):
+        self._epoll.close()
+        os.close(self._fd)
+
+
+def open_file_watch(path):
+    """
+    Returns a FileWatch for path, or None if inotify is not available.
+    """
+    try:
+        return FileWatch(path)
+    except (OSError, AttributeError) as e:
+        logging.info(f"Can not watch {path} ({e}), polling it instead")
+        return None
+
+
+def open_sysfs_attribute_watch(path):
+    """
+    Returns a SysfsAttributeWatch for path, or None if it can not be opened.
+    """
+    try:
+        return SysfsAttributeWatch(path)
+    except OSError as e:
+        logging.info(f"Can not watch {path} ({e})")
+        return None
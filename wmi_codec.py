@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+WMI method codec for the Legion Go GZFD device.
+
+Description:
+    Builds the ACPI call strings for the WMAA (Gamezone), WMAB (fan table), WMAE (get/set feature)
+    and WMAF (lighting) methods and decodes the acpi_call responses into Python values.
+    See wmi_interface.md for the tables the constants below come from.
+
+    The request strings for every known feature are built once at import, a get is a dictionary
+    lookup and a set only formats the value bytes.
+
+    acpi_call prints results as:
+    - integers: 0x1e (or 0 for zero)
+    - buffers: {0x0a, 0x00, 0x00, 0x00}
+    - strings: "text"
+    - packages: [0x1, {0x00}]
+
+Usage:
+    ./wmi_codec.py --benchmark 10000
+"""
+
+import argparse
+import struct
+import time
+from collections import namedtuple
+
+GZFD = '\\_SB.GZFD'
+
+# Gamezone (WMAA) method ids
+WMAA_SET_THERMAL_TABLE_ID = 0x03
+WMAA_GET_THERMAL_TABLE_ID = 0x02
+WMAA_GET_CPU_TEMPERATURE = 0x12
+WMAA_SET_SMART_FAN_MODE = 0x2C
+WMAA_GET_SMART_FAN_MODE = 0x2D
+WMAA_GET_SMART_FAN_SETTING_MODE = 0x2E
+WMAA_GET_POWER_CHARGE_MODE = 0x2F
+WMAA_GET_REAL_THERMAL_MODE = 0x37
+
+# Fan table (WMAB) method ids
+WMAB_GET_FAN_TABLE = 0x05
+WMAB_SET_FAN_TABLE = 0x06
+
+# Get/Set feature (WMAE) method ids
+WMAE_GET_FEATURE = 0x11
+WMAE_SET_FEATURE = 0x12
+
+# Lighting (WMAF) method ids
+WMAF_GET_LIGHTING = 0x01
+WMAF_SET_LIGHTING = 0x02
+
+# Known Smart Fan Mode values (WMAA 0x2C/0x2D)
+SMART_FAN_MODES = {1: 'Quiet', 2: 'Balanced', 3: 'Performance', 224: 'Extreme', 255: 'Custom'}
+
+# Lighting ids (WMAF)
+LIGHTING_POWER_BUTTON = 0x03
+
+# Fan table temperatures, ignored by the firmware but required
+FAN_TABLE_TEMPERATURES = (10, 20, 30, 40, 50, 60, 70, 80, 90, 100)
+
+
+class WmiFeature(namedtuple('WmiFeature', ['device', 'feature', 'type'])):
+    """
+    WMAE feature key, destructured by the firmware as {TYP0:2b, FEA0, DEV0} (little endian).
+    """
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return (self.device << 24) | (self.feature << 16) | self.type
+
+
+FEATURES = {
+    'flip_to_start': WmiFeature(0x00, 0x03, 0x0000),
+    'slow_tdp': WmiFeature(0x01, 0x01, 0xFF00),
+    'steady_tdp': WmiFeature(0x01, 0x02, 0xFF00),
+    'fast_tdp': WmiFeature(0x01, 0x03, 0xFF00),
+    'max_steady_tdp': WmiFeature(0x01, 0x06, 0xFF00),
+    'boot_on_ac': WmiFeature(0x03, 0x01, 0x0001),
+    'boot_on_pd': WmiFeature(0x03, 0x01, 0x0002),
+    'full_fan_speed': WmiFeature(0x04, 0x02, 0x0000),
+    'fan_speed': WmiFeature(0x04, 0x03, 0x0001),
+    'crts_temperature': WmiFeature(0x05, 0x01, 0x0000),
+    'amts_temperature': WmiFeature(0x05, 0x03, 0x0000),
+    'cpu_temperature': WmiFeature(0x05, 0x04, 0x0000),
+    'gpu_temperature': WmiFeature(0x05, 0x05, 0x0000),
+    'chts_temperature': WmiFeature(0x05, 0x08, 0x0000),
+    'ctts_temperature': WmiFeature(0x05, 0x0B, 0x0000),
+}
+
+# TDP mode names as used by the scripts, mapped to their features
+TDP_FEATURES = {'slow': 'slow_tdp', 'steady': 'steady_tdp', 'fast': 'fast_tdp'}
+
+
+class WmiDecodeError(ValueError):
+    """
+    Raised when an acpi_call response can not be decoded, i.e. "Error: AE_NOT_FOUND".
+    """
+
+
+_HEX_BYTES = tuple(f'0x{value:02x}' for value in range(256))
+
+
+def format_buffer(data):
+    """
+    Formats bytes as an acpi_call buffer argument, i.e. {0x00, 0xff}.
+    """
+    return '{' + ', '.join([_HEX_BYTES[value] for value in data]) + '}'
+
+
+def encode_call(method, method_id, arg=None):
+    """
+    Builds a GZFD method call.
+
+    Args:
+        method (str): The method name, WMAA, WMAB, WMAE or WMAF.
+        method_id (int): The WMI method id (Arg1).
+        arg (int, bytes or str): Arg2, an integer, a byte buffer or a preformatted string.
+
+    Returns:
+        str: The ACPI call, i.e. "\\_SB.GZFD.WMAA 0 0x2C 0xff".
+    """
+    command = f"{GZFD}.{method} 0 0x{method_id:02X}"
+    if arg is None:
+        return command
+    if isinstance(arg, int):
+        return f"{command} 0x{arg:02x}"
+    if isinstance(arg, (bytes, bytearray, memoryview)):
+        return f"{command} {format_buffer(arg)}"
+    return f"{command} {arg}"
+
+
+def _build_get_feature(feature):
+    return encode_call('WMAE', WMAE_GET_FEATURE, f"0x{feature.id:08X}")
+
+
+def _build_set_feature_prefix(feature):
+    # The feature id half of the set buffer never changes, only the value bytes are formatted per call
+    return f"{GZFD}.WMAE 0 0x{WMAE_SET_FEATURE:02X} {{" + ', '.join(_HEX_BYTES[value] for value in struct.pack('<I', feature.id)) + ', '
+
+
+# Precompiled request templates
+GET_FEATURE_COMMANDS = {name: _build_get_feature(feature) for name, feature in FEATURES.items()}
+SET_FEATURE_PREFIXES = {name: _build_set_feature_prefix(feature) for name, feature in FEATURES.items()}
+GET_SMART_FAN_MODE_COMMAND = encode_call('WMAA', WMAA_GET_SMART_FAN_MODE)
+GET_SMART_FAN_SETTING_MODE_COMMAND = encode_call('WMAA', WMAA_GET_SMART_FAN_SETTING_MODE)
+GET_THERMAL_TABLE_ID_COMMAND = encode_call('WMAA', WMAA_GET_THERMAL_TABLE_ID)
+GET_FAN_TABLE_COMMAND = encode_call('WMAB', WMAB_GET_FAN_TABLE, '0x0000')
+
+
+def encode_get_feature(name):
+    """
+    Returns the WMAE get call for a named feature, see FEATURES.
+    """
+    return GET_FEATURE_COMMANDS[name]
+
+
+def encode_set_feature(name, value):
+    """
+    Returns the WMAE set call for a named feature.
+
+    Args:
+        name (str): The feature name, see FEATURES.
+        value (int): The uint32 value to set.
+
+    Returns:
+        str: The ACPI call with an 8 byte little endian buffer {id, value}.
+    """
+    if not 0 <= value <= 0xFFFFFFFF:
+        raise ValueError(f"Feature value out of range: {value}")
+    return SET_FEATURE_PREFIXES[name] + ', '.join([_HEX_BYTES[byte] for byte in struct.pack('<I', value)]) + '}'
+
+
+def encode_set_smart_fan_mode(mode_value):
+    return encode_call('WMAA', WMAA_SET_SMART_FAN_MODE, mode_value)
+
+
+def encode_set_thermal_table_id(mode_id):
+    return encode_call('WMAA', WMAA_SET_THERMAL_TABLE_ID, mode_id)
+
+
+def encode_set_fan_table(speeds, temperatures=FAN_TABLE_TEMPERATURES):
+    """
+    Builds the WMAB set fan table call.
+    Unlike the get, the set takes null terminated uint16 arrays, see wmi_interface.md.
+
+    Args:
+        speeds (list): Fan speeds in %, one per temperature step.
+        temperatures (list): Temperature steps, ignored by the firmware.
+
+    Returns:
+        str: The ACPI call.
+    """
+    for speed in speeds:
+        if not 0 <= speed <= 100:
+            raise ValueError(f"Fan speed out of range: {speed}")
+    buffer = bytearray(b'\x00\x00')  # Fan ID, Sensor ID (ignored)
+    buffer += struct.pack(f'<I{len(speeds)}H', len(speeds), *speeds) + b'\x00'
+    buffer += struct.pack(f'<I{len(temperatures)}H', len(temperatures), *temperatures) + b'\x00'
+    return encode_call('WMAB', WMAB_SET_FAN_TABLE, buffer)
+
+
+def encode_get_lighting(lighting_id):
+    return encode_call('WMAF', WMAF_GET_LIGHTING, lighting_id)
+
+
+def encode_set_lighting(lighting_id, state_type, brightness_level):
+    return encode_call('WMAF', WMAF_SET_LIGHTING, bytes((lighting_id, state_type, brightness_level)))
+
+
+# Strips everything but the hex digits of a buffer body, "0x0a, 0x00" -> "0a00"
+_BUFFER_STRIP = str.maketrans('', '', ' ,\n\t')
+
+
+def decode_buffer(body):
+    """
+    Decodes the inside of an acpi_call buffer, i.e. "0x0a, 0x00", into bytes.
+    """
+    try:
+        return bytes.fromhex(body.translate(_BUFFER_STRIP).replace('0x', ''))
+    except ValueError:
+        # Not every byte was printed with two digits, fall back to per token parsing
+        return bytes(int(token, 16) for token in body.replace('\n', ' ').split(',') if token.strip())
+
+
+def decode_response(response):
+    """
+    Decodes an acpi_call response.
+
+    Args:
+        response (str): The acpi_call output.
+
+    Returns:
+        int, bytes, str or list: Integers for integer results, bytes for buffers, str for strings
+        and a list of decoded elements for packages.
+
+    Raises:
+        WmiDecodeError: If the response is an acpi_call error or can not be parsed.
+    """
+    text = response.strip().strip('\x00')
+    if not text:
+        raise WmiDecodeError("Empty ACPI response")
+    first = text[0]
+    if first == '{':
+        end = text.find('}')
+        if end == -1:
+            raise WmiDecodeError(f"Unterminated buffer in ACPI response: {text[:32]}")
+        try:
+            return decode_buffer(text[1:end])
+        except ValueError as e:
+            raise WmiDecodeError(f"Invalid buffer in ACPI response: {e}") from e
+    if first == '"':
+        return text.strip('"')
+    if first == '[':
+        return [decode_response(element) for element in _split_package(text[1:text.rfind(']')])]
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise WmiDecodeError(f"Unexpected ACPI response: {text}") from None
+
+
+def _split_package(body):
+    elements = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(body):
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            elements.append(body[start:index])
+            start = index + 1
+    if body[start:].strip():
+        elements.append(body[start:])
+    return elements
+
+
+def parse_call(command):
+    """
+    Splits a GZFD method call back into its parts, the inverse of encode_call.
+
+    Args:
+        command (str): The ACPI call, i.e. "\\_SB.GZFD.WMAE 0 0x11 0x05040000".
+
+    Returns:
+        tuple: (method, method_id, arg) where arg is None, an int or bytes.
+
+    Raises:
+        WmiDecodeError: If the command is not a GZFD method call.
+    """
+    parts = command.strip().split(' ', 3)
+    if len(parts) < 3 or not parts[0].startswith(GZFD + '.'):
+        raise WmiDecodeError(f"Not a GZFD method call: {command}")
+    method = parts[0][len(GZFD) + 1:]
+    try:
+        method_id = int(parts[2], 0)
+        arg = decode_response(parts[3]) if len(parts) == 4 else None
+    except (ValueError, WmiDecodeError) as e:
+        raise WmiDecodeError(f"Invalid GZFD method call: {command}: {e}") from None
+    return method, method_id, arg
+
+
+def decode_int(response):
+    """
+    Decodes a response into an int, buffers are read as little endian.
+    """
+    value = decode_response(response)
+    if isinstance(value, (bytes, bytearray)):
+        return int.from_bytes(value, 'little')
+    if not isinstance(value, int):
+        raise WmiDecodeError(f"Expected an integer ACPI response, got: {value!r}")
+    return value
+
+
+def decode_uint32_array(data):
+    """
+    Unpacks a little endian byte buffer into a tuple of uint32 values.
+    """
+    return struct.unpack(f'<{len(data) // 4}I', data[:len(data) - len(data) % 4])
+
+
+def decode_fan_table(response):
+    """
+    Decodes the WMAB get fan table response.
+
+    Args:
+        response (str): The acpi_call output, an 88 byte buffer on the Legion Go.
+
+    Returns:
+        tuple: (fan_speeds, temperatures), both lists of ints.
+    """
+    data = decode_response(response)
+    if not isinstance(data, (bytes, bytearray)):
+        raise WmiDecodeError(f"Expected a buffer for the fan table, got: {data!r}")
+    values = decode_uint32_array(data)
+    speeds_length = values[0]
+    fan_speeds = list(values[1:speeds_length + 1])
+    temps_length = values[speeds_length + 1]
+    temperatures = list(values[speeds_length + 2:speeds_length + 2 + temps_length])
+    return fan_speeds, temperatures
+
+
+# Fan table response from wmi_interface.md, used by the benchmark
+SAMPLE_FAN_TABLE_RESPONSE = '{' + ', '.join(_HEX_BYTES[byte] for byte in struct.pack(
+    '<22I', 10, 44, 48, 55, 60, 71, 79, 87, 87, 100, 100, 10, *FAN_TABLE_TEMPERATURES)) + '}'
+
+
+def _decode_fan_table_per_token(response):
+    # The parsing legiongo_control.get_fan_curve used to do, kept as the benchmark baseline
+    hex_data = response[response.find('{') + 1:response.find('}')]
+    byte_values = [int(val.split(',')[0].strip(), 16) for val in hex_data.split(', ') if val.strip()]
+    values = [byte_values[i] | byte_values[i + 1] << 8 | byte_values[i + 2] << 16 | byte_values[i + 3] << 24 for i in range(0, len(byte_values), 4)]
+    return values[1:11], values[12:22]
+
+
+def benchmark(iterations=10000):
+    """
+    Times decoding the 88 byte fan table response with the codec and with per token parsing.
+
+    Returns:
+        dict: Decoder name to microseconds per decode.
+    """
+    assert decode_fan_table(SAMPLE_FAN_TABLE_RESPONSE) == _decode_fan_table_per_token(SAMPLE_FAN_TABLE_RESPONSE)
+    results = {}
+    for name, decoder in (('codec', decode_fan_table), ('per-token', _decode_fan_table_per_token)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decoder(SAMPLE_FAN_TABLE_RESPONSE)
+        results[name] = (time.perf_counter() - start) / iterations * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Legion Go WMI codec')
+    parser.add_argument('--benchmark', type=int, metavar='N', default=10000, help='Decode the fan table response N times with each decoder.')
+    args = parser.parse_args()
+
+    for name, microseconds in benchmark(args.benchmark).items():
+        print(f"{name:>10}: {microseconds:.2f} us per fan table decode")
+
+
+if __name__ == "__main__":
+    main()